@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bench.synthetic import add_spec_arguments, generate_tree, spec_from_args
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def run_traverse(root: Path, processes: int) -> dict:
+    from util.traversal import traverse_file_tree
+
+    return {'results': len(traverse_file_tree(root, include_gitignore=True, workers=processes))}
+
+
+def run_hash_map(root: Path, processes: int) -> dict:
+    from util.hashing import get_dir_hash_map
+
+    hash_map = get_dir_hash_map(root, include_gitignore=True, processes=processes, workers=processes)
+    return {'results': sum(len(paths) for paths in hash_map.values())}
+
+
+def run_duplicates(root: Path, processes: int) -> dict:
+    from util.duplicates import find_duplicate_files
+
+    duplicates = find_duplicate_files(root, include_gitignore=True, processes=processes, workers=processes)
+    return {'results': sum(len(paths) for paths in duplicates.values()), 'groups': len(duplicates)}
+
+
+def run_offending(root: Path, processes: int) -> dict:
+    from util.naming import get_offending_paths
+
+    return {'results': len(list(get_offending_paths(root, include_gitignore=True, workers=processes)))}
+
+
+# what is benchmarked, hashes are never cached, so every run does the same work
+BENCHMARKS = {
+    'traverse': run_traverse,
+    'hash_map': run_hash_map,
+    'duplicates': run_duplicates,
+    'offending': run_offending,
+}
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Benchmarks walking, hashing, finding duplicates and checking '
+                                                 'names on a synthetic tree. Prints one json object per run, '
+                                                 'with wall and cpu time, throughput, syscalls and peak memory')
+
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f'which benchmarks to run, any of {", ".join(BENCHMARKS)}, defaults to all of them')
+    parser.add_argument('-t', '--tree', type=Path, default=REPO / 'bench_tree',
+                        help='where to generate the tree, it is reused by later runs with the same spec')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='how many times to run each benchmark')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='how many threads to walk and hash with')
+    parser.add_argument('-o', '--output', type=Path, help='append the results to this file as well')
+    parser.add_argument('-b', '--baseline', type=Path,
+                        help='results of an earlier run to compare against, fails if a benchmark got slower')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='by how much the median wall time may exceed the baseline, defaults to 0.1')
+    # used internally, to run a single benchmark in a fresh process
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    add_spec_arguments(parser)
+
+    args = parser.parse_args(args)
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error(f'unknown benchmark "{benchmark}", choose from {", ".join(BENCHMARKS)}')
+
+    return args
+
+
+def read_proc_io() -> dict[str, int]:
+    """
+    Read the io counters of this process, they include the number of read and write syscalls.
+
+    :return: dict of counters like syscr, syscw, rchar and wchar, empty where /proc is not available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return {}
+
+
+def measure(benchmark: str, root: Path, processes: int) -> dict:
+    """
+    Run a single benchmark in this process, and measure it.
+
+    :param benchmark: name of the benchmark, see BENCHMARKS
+    :param root: the tree to run it on
+    :param processes: how many threads to walk and hash with
+    :return: result of the benchmark, with wall and cpu time, syscalls, peak memory and the stats of the run
+    """
+    from util.stats import collect_stats
+
+    io_before, usage_before = read_proc_io(), resource.getrusage(resource.RUSAGE_SELF)
+    with collect_stats() as stats:
+        start = time.perf_counter()
+        result = BENCHMARKS[benchmark](root, processes)
+        wall = time.perf_counter() - start
+    io_after, usage_after = read_proc_io(), resource.getrusage(resource.RUSAGE_SELF)
+
+    counters = stats.as_dict()['counters']
+    result.update({
+        # entries the walk listed, including pruned ones, throughput is measured in these
+        'entries': counters.get('walk:entries_listed', 0),
+        'wall_s': round(wall, 6),
+        'user_s': round(usage_after.ru_utime - usage_before.ru_utime, 6),
+        'system_s': round(usage_after.ru_stime - usage_before.ru_stime, 6),
+        # /proc/self/io only counts reads and writes, directory listings and stat calls are counted by the walk
+        'syscalls': {'read': io_after.get('syscr', 0) - io_before.get('syscr', 0),
+                     'write': io_after.get('syscw', 0) - io_before.get('syscw', 0),
+                     'listdir': counters.get('walk:dirs_listed', 0),
+                     'stat': counters.get('walk:entries_listed', 0)},
+        'bytes_read': io_after.get('rchar', 0) - io_before.get('rchar', 0),
+        # linux reports kibibytes, macos bytes
+        'peak_rss_kib': usage_after.ru_maxrss // (1024 if sys.platform == 'darwin' else 1),
+        'context_switches': (usage_after.ru_nvcsw - usage_before.ru_nvcsw)
+                            + (usage_after.ru_nivcsw - usage_before.ru_nivcsw),
+        'stats': stats.as_dict(),
+    })
+    return result
+
+
+def run_in_child(benchmark: str, args: argparse.Namespace) -> dict:
+    """
+    Run a single benchmark in a fresh interpreter, so its peak memory is its own and imports are not shared.
+
+    :param benchmark: name of the benchmark, see BENCHMARKS
+    :param args: arguments of this run
+    :return: result of the benchmark, see measure
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(REPO), str(REPO / 'src'), env.get('PYTHONPATH')]))
+
+    output = subprocess.run([sys.executable, '-m', 'bench.benchmark', '--child', benchmark,
+                             '--tree', str(args.tree), '--processes', str(args.processes)],
+                            cwd=REPO, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def get_commit() -> str | None:
+    """
+    :return: the commit that is checked out, None if that is unknown
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs: list[dict]) -> dict:
+    """
+    :param runs: results of the runs of a single benchmark
+    :return: summary with the median and the minimum wall time, and the throughput at the median
+    """
+    wall = statistics.median(run['wall_s'] for run in runs)
+    entries = runs[0]['entries']
+    return {'wall_s_median': round(wall, 6),
+            'wall_s_min': min(run['wall_s'] for run in runs),
+            'entries_per_s': round(entries / wall, 1) if wall else None,
+            'bytes_per_s': round(statistics.median(run['bytes_read'] for run in runs) / wall, 1) if wall else None,
+            'peak_rss_kib': max(run['peak_rss_kib'] for run in runs)}
+
+
+def read_baseline(path: Path) -> dict[tuple[str, str], dict]:
+    """
+    :param path: file with results, one json object per line
+    :return: the latest summary of every benchmark, by benchmark and spec
+    """
+    baseline = {}
+    with path.open() as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('type') == 'summary':
+                baseline[(record['benchmark'], json.dumps(record['spec'], sort_keys=True))] = record
+    return baseline
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    if args.child is not None:
+        print(json.dumps(measure(args.child, args.tree.resolve(), args.processes)))
+        return
+
+    spec = spec_from_args(args)
+    manifest = generate_tree(args.tree, spec)
+    baseline = {} if args.baseline is None else read_baseline(args.baseline)
+
+    context = {'commit': get_commit(),
+               'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'spec': manifest['spec'],
+               'tree': manifest['counts'],
+               'processes': args.processes}
+
+    output = None if args.output is None else args.output.open('a')
+    regressions = []
+    try:
+        for benchmark in args.benchmarks or BENCHMARKS:
+            runs = []
+            for _ in range(args.repeat):
+                runs.append(run_in_child(benchmark, args))
+
+            summary = {'type': 'summary', 'benchmark': benchmark, 'runs': args.repeat, **context, **summarize(runs)}
+            previous = baseline.get((benchmark, json.dumps(summary['spec'], sort_keys=True)))
+            if previous is not None:
+                summary['baseline_wall_s_median'] = previous['wall_s_median']
+                summary['regression'] = summary['wall_s_median'] > previous['wall_s_median'] * (1 + args.tolerance)
+                if summary['regression']:
+                    regressions.append(benchmark)
+
+            records = [{'type': 'run', 'benchmark': benchmark, 'run': i, **context, **run}
+                       for i, run in enumerate(runs)] + [summary]
+            for record in records:
+                line = json.dumps(record)
+                print(line)
+                if output is not None:
+                    print(line, file=output)
+    finally:
+        if output is not None:
+            output.close()
+
+    if regressions:
+        print(f'{", ".join(regressions)} got slower than the baseline by more than {args.tolerance:.0%}',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
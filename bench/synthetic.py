@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+
+from pathlib import Path
+from typing import NamedTuple
+
+from util.naming import compile_name_validator
+
+# written into the root of a generated tree, so an existing tree can be reused if it was built the same way
+MANIFEST_NAME = '.synthetic.json'
+
+# names files are built from, extensions are picked at random, gitignore rules refer to some of them
+EXTENSIONS = ['.txt', '.dat', '.bin', '.log', '.tmp']
+GITIGNORE_RULES = ['*.log', '*.tmp', 'cache/', '/build/']
+
+# names with characters that are not POSIX portable, to give get_offending_paths something to find
+OFFENDING_SUFFIXES = [' copy', 'ü', ' (1)', '€']
+
+
+class TreeSpec(NamedTuple):
+    """
+    How to build a synthetic tree, see generate_tree.
+
+    The tree is a complete tree of directories, with fanout subdirectories per directory down to depth,
+    and files_per_dir files in every directory, so it has sum(fanout ** d for d in range(depth + 1)) directories.
+    """
+    depth: int = 3
+    fanout: int = 4
+    files_per_dir: int = 10
+    # size distribution of files: 'empty', 'fixed' always uses mean_size, 'uniform' is between 0 and 2 * mean_size,
+    # 'lognormal' has its median at mean_size and a long tail, as real trees do
+    size_distribution: str = 'lognormal'
+    mean_size: int = 4096
+    max_size: int = 64 * 1024 * 1024
+    # fraction of files that copy the content of an earlier file
+    duplicate_ratio: float = 0.1
+    # fraction of files that are hardlinks to an earlier file
+    hardlink_ratio: float = 0.02
+    # fraction of directories with a .gitignore file
+    gitignore_density: float = 0.1
+    # fraction of names that are not POSIX portable
+    offending_ratio: float = 0.01
+    seed: int = 0
+
+    @property
+    def dir_count(self) -> int:
+        return sum(self.fanout ** d for d in range(self.depth + 1))
+
+    @property
+    def file_count(self) -> int:
+        return self.dir_count * self.files_per_dir
+
+
+# specs for trees of about a thousand, a hundred thousand and a million entries
+PRESETS = {
+    'small': TreeSpec(depth=3, fanout=4, files_per_dir=10),
+    'medium': TreeSpec(depth=4, fanout=8, files_per_dir=20),
+    'large': TreeSpec(depth=5, fanout=10, files_per_dir=8, mean_size=512),
+}
+
+SIZE_DISTRIBUTIONS = ['empty', 'fixed', 'uniform', 'lognormal']
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Generates a synthetic file tree to benchmark with. '
+                                                 'An existing tree is reused if it was generated the same way')
+
+    add_spec_arguments(parser)
+    parser.add_argument('path', type=Path, help='where to generate the tree')
+    parser.add_argument('-f', '--force', action='store_true', help='regenerate the tree even if it can be reused')
+
+    return parser.parse_args(args)
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser):
+    """
+    Add arguments for the fields of a TreeSpec to a parser, see spec_from_args.
+
+    :param parser: the parser
+    """
+    group = parser.add_argument_group('synthetic tree')
+    group.add_argument('--preset', choices=PRESETS, default='small',
+                       help='spec to start from, the other arguments override it, defaults to small')
+    group.add_argument('--depth', type=int, help='how many levels of directories below the root')
+    group.add_argument('--fanout', type=int, help='how many subdirectories per directory')
+    group.add_argument('--files-per-dir', type=int, help='how many files per directory')
+    group.add_argument('--size-distribution', choices=SIZE_DISTRIBUTIONS, help='distribution of file sizes')
+    group.add_argument('--mean-size', type=int, help='mean, or for lognormal median, size of files in bytes')
+    group.add_argument('--max-size', type=int, help='largest size of a file in bytes')
+    group.add_argument('--duplicate-ratio', type=float, help='fraction of files that are duplicates')
+    group.add_argument('--hardlink-ratio', type=float, help='fraction of files that are hardlinks')
+    group.add_argument('--gitignore-density', type=float, help='fraction of directories with a .gitignore')
+    group.add_argument('--offending-ratio', type=float, help='fraction of names that are not POSIX portable')
+    group.add_argument('--seed', type=int, help='seed of the random generator')
+
+
+def spec_from_args(args: argparse.Namespace) -> TreeSpec:
+    """
+    :param args: arguments parsed by a parser with add_spec_arguments
+    :return: the preset, with the fields that were given overridden
+    """
+    spec = PRESETS[args.preset]
+    return spec._replace(**{field: getattr(args, field) for field in spec._fields if getattr(args, field) is not None})
+
+
+def get_size(rng: random.Random, spec: TreeSpec) -> int:
+    """
+    :param rng: random generator
+    :param spec: spec with the size distribution
+    :return: a random file size
+    """
+    if spec.size_distribution == 'empty':
+        return 0
+    if spec.size_distribution == 'fixed':
+        size = spec.mean_size
+    elif spec.size_distribution == 'uniform':
+        size = rng.randint(0, 2 * spec.mean_size)
+    elif spec.size_distribution == 'lognormal':
+        # the median of lognormvariate(mu, sigma) is e ** mu
+        size = int(rng.lognormvariate(0, 1.5) * spec.mean_size)
+    else:
+        raise ValueError(f'Size distribution "{spec.size_distribution}" is not one of {", ".join(SIZE_DISTRIBUTIONS)}.')
+
+    return min(size, spec.max_size)
+
+
+def get_name(rng: random.Random, spec: TreeSpec, prefix: str, i: int, extension: str = '') -> str:
+    """
+    :param rng: random generator
+    :param spec: spec with the ratio of offending names
+    :param prefix: what the name starts with
+    :param i: number of the file or directory within its directory, keeps names unique
+    :param extension: what the name ends with
+    :return: a name, which contains characters that are not POSIX portable every now and then
+    """
+    suffix = rng.choice(OFFENDING_SUFFIXES) if rng.random() < spec.offending_ratio else ''
+    return f'{prefix}{i}{suffix}{extension}'
+
+
+def write_file(path: Path, size: int, rng: random.Random):
+    """
+    Write a file of random content, random so that files of the same size only collide if they are meant to.
+
+    :param path: path of the file, must not exist
+    :param size: size in bytes
+    :param rng: random generator
+    """
+    with path.open('xb') as f:
+        # written in chunks, so large files don't have to fit into memory
+        while size > 0:
+            chunk = min(size, 1024 * 1024)
+            f.write(rng.randbytes(chunk))
+            size -= chunk
+
+
+def generate_tree(root: str | bytes | os.PathLike | Path, spec: TreeSpec, force: bool = False) -> dict:
+    """
+    Generate a synthetic tree for benchmarks. The same spec always gives the same tree.
+
+    Duplicates are copies of earlier files, with shutil, so copying stays in kernel space where it can.
+    Hardlinks link to earlier files. Both pick from a bounded pool of recent files, so memory stays flat,
+    no matter how many millions of files are generated.
+
+    :param root: directory to generate the tree in, it is created if it does not exist
+    :param spec: how to build the tree
+    :param force: whether to regenerate the tree, even if root holds a tree that was generated from the same spec
+    :return: manifest of the tree, with the spec and the counts of what was generated
+    """
+    root = Path(os.fsdecode(root)).resolve()
+    manifest_path = root / MANIFEST_NAME
+
+    if not force and manifest_path.is_file():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest['spec'] == spec._asdict():
+            return manifest
+
+    if root.exists():
+        shutil.rmtree(root)
+    root.mkdir(parents=True)
+
+    is_offending = compile_name_validator()
+    rng = random.Random(spec.seed)
+    counts = {'dirs': 0, 'files': 0, 'bytes': 0, 'duplicates': 0, 'hardlinks': 0, 'gitignores': 0, 'offending': 0}
+    # recent files with unique content, duplicates and hardlinks are made of these
+    pool: list[tuple[Path, int]] = []
+    pool_size = 1024
+
+    stack = [(root, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        counts['dirs'] += 1
+
+        if rng.random() < spec.gitignore_density:
+            (directory / '.gitignore').write_text('\n'.join(rng.sample(GITIGNORE_RULES, 2)) + '\n')
+            counts['gitignores'] += 1
+
+        for i in range(spec.files_per_dir):
+            path = directory / get_name(rng, spec, 'file', i, rng.choice(EXTENSIONS))
+            counts['offending'] += is_offending(path.name)
+
+            roll = rng.random()
+            if pool and roll < spec.hardlink_ratio:
+                source, size = rng.choice(pool)
+                os.link(source, path)
+                counts['hardlinks'] += 1
+            elif pool and roll < spec.hardlink_ratio + spec.duplicate_ratio:
+                source, size = rng.choice(pool)
+                shutil.copyfile(source, path)
+                counts['duplicates'] += 1
+            else:
+                size = get_size(rng, spec)
+                write_file(path, size, rng)
+                if len(pool) < pool_size:
+                    pool.append((path, size))
+                else:
+                    pool[rng.randrange(pool_size)] = (path, size)
+
+            counts['files'] += 1
+            counts['bytes'] += size
+
+        if depth < spec.depth:
+            for i in range(spec.fanout):
+                # some directories are called like the ones gitignore rules refer to
+                prefix = 'cache' if i == 0 and depth % 2 else 'build' if i == 1 and depth % 2 else 'dir'
+                subdirectory = directory / get_name(rng, spec, prefix, i)
+                subdirectory.mkdir()
+                counts['offending'] += is_offending(subdirectory.name)
+                stack.append((subdirectory, depth + 1))
+
+    manifest = {'spec': spec._asdict(), 'counts': counts}
+    manifest_path.write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    manifest = generate_tree(args.path, spec_from_args(args), force=args.force)
+    print(json.dumps(manifest, indent=2))
+
+
+if __name__ == '__main__':
+    main()
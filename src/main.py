@@ -1,2 +1,98 @@
+#!/usr/bin/env python3
+
+import time
+
+# taken first thing, so --time-startup covers our own imports as well
+START = time.perf_counter()
+
+import argparse
+import importlib
+import sys
+
+from pathlib import Path
+
+# subcommands and the modules that implement them, modules are only imported once their subcommand is run,
+# so e.g. walking never pays for hashing, sqlite or multiprocessing
+SUBCOMMANDS = {
+    'walk': ('util.traversal', 'print paths under a directory'),
+    'dupes': ('util.duplicates', 'find duplicate files'),
+    'resolve': ('util.resolve', 'replace duplicate files by links, or delete them'),
+    'names': ('util.naming', 'find paths with names that are not POSIX portable'),
+    'rename': ('util.rename', 'rename paths with names that are not POSIX portable'),
+    'merge': ('util.merge', 'merge a directory into another one'),
+}
+
+# how long parsing the arguments of a subcommand may take, including imports, see --time-startup
+STARTUP_BUDGET_MS = 50
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog='fileutils', description='Some utilities to manage files.',
+                                     epilog='run "fileutils COMMAND --help" for help on a command')
+
+    parser.add_argument('--time-startup', action='store_true',
+                        help='only parse the arguments of the command, and report how long that took, including '
+                             f'imports, fails if it took longer than {STARTUP_BUDGET_MS} ms')
+    parser.add_argument('--stats', action='store_true', help='print counters and timers of the run as json to stderr')
+    parser.add_argument('--stats-file', type=Path, metavar='PATH',
+                        help='write counters and timers of the run as json to this file instead')
+    parser.add_argument('command', choices=SUBCOMMANDS, metavar='COMMAND',
+                        help=', '.join(f'{name}: {description}' for name, (_, description) in SUBCOMMANDS.items()))
+    # everything after the command, including --help, is left for the command to parse
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+    return parser.parse_args(args)
+
+
+def run_with_stats(module, args: list[str], path: Path | None = None):
+    """
+    Run a subcommand, while collecting stats, and write them as json once it is done, even if it exits or fails.
+
+    :param module: module that implements the subcommand
+    :param args: arguments for the subcommand
+    :param path: where to write the stats, None for stderr
+    """
+    from util.stats import collect_stats
+
+    with collect_stats() as stats:
+        try:
+            module.main(args)
+        finally:
+            if path is None:
+                print(stats.to_json(), file=sys.stderr)
+            else:
+                path.write_text(stats.to_json())
+
+
+def main():
+    args = parse_args()
+
+    # the subcommands report themselves as e.g. "fileutils walk" in their usage
+    sys.argv[0] = f'fileutils {args.command}'
+    module = importlib.import_module(SUBCOMMANDS[args.command][0])
+
+    if args.stats or args.stats_file is not None:
+        run_with_stats(module, args.args, args.stats_file)
+        return
+
+    if not args.time_startup:
+        module.main(args.args)
+        return
+
+    # parse only, --help exits on its own after printing
+    try:
+        module.parse_args(args.args)
+    except SystemExit:
+        pass
+
+    elapsed_ms = (time.perf_counter() - START) * 1000
+    print(f'startup of "fileutils {args.command}" took {elapsed_ms:.1f} ms, '
+          f'the budget is {STARTUP_BUDGET_MS} ms', file=sys.stderr)
+    sys.exit(1 if elapsed_ms > STARTUP_BUDGET_MS else 0)
+
+
 if __name__ == '__main__':
-    print('here be code')
+    main()
@@ -0,0 +1,270 @@
+import asyncio
+import os
+import re
+import threading
+
+from contextlib import aclosing
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterable, NamedTuple
+
+from util import stats
+from util.algorithms import resolve_algorithm
+from util.cache import HashCache
+from util.hashing import get_entry_hash
+from util.store import HashStore
+from util.traversal import FileEntry, GitignoreScope, compile_directory_scan
+
+# how many directories are listed at once by default, listing mostly means waiting on the filesystem
+DEFAULT_CONCURRENCY = 4
+# how many listed directories may wait for the consumer by default, before listing pauses
+DEFAULT_MAX_PENDING = 64
+
+# events progress is reported on
+LISTED, HASHED = 'listed', 'hashed'
+
+# marks the end of a walk in the queue of listed directories
+_DONE = object()
+
+
+class Progress(NamedTuple):
+    """
+    Progress of an async walk or hash map, reported whenever a directory was listed or a file was hashed.
+    Counts are totals so far.
+    """
+    event: str
+    path: Path
+    dirs: int
+    entries: int
+    files: int = 0
+    bytes: int = 0
+
+
+async def atraverse(root: str | bytes | os.PathLike | Path,
+                    regard_patterns: list[str] = None,
+                    regard_patterns_concern_dirs: bool = False,
+                    ignore_patterns: list[str] = None,
+                    include_gitignore: bool = False,
+                    regex_flags: list[re.RegexFlag] = None,
+                    with_stat: bool = True,
+                    concurrency: int = DEFAULT_CONCURRENCY,
+                    max_pending: int = DEFAULT_MAX_PENDING,
+                    excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None,
+                    progress: Callable[[Progress], None] | None = None) -> AsyncIterator[FileEntry]:
+    """
+    Asynchronously traverse a file tree, this is the async counterpart of iter_file_entries.
+    Directories are scanned with the same rules, so the same entries are yielded, but in no particular order.
+
+    Directories are listed in threads, at most concurrency at once, so the event loop never waits on the filesystem.
+    Listed directories queue up for the consumer, once max_pending of them are waiting, listing pauses until the
+    consumer catches up, so a slow consumer does not make the walk pile up entries in memory.
+    Leaving the loop early or cancelling the task that runs it stops the walk,
+    listings that are still running in threads are discarded once they are done.
+
+    :param root: directory under which to start
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param with_stat: whether entries should carry size, modification time and device, see FileEntry.from_dir_entry
+    :param concurrency: how many directories to list at once
+    :param max_pending: how many listed directories may wait for the consumer
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :param progress: called in the event loop after every listed directory, must not block
+    :return: async iterator over entries for all paths under root in accordance with the passed rules
+    """
+
+    # resolve the starting point, symlinks are not followed, so paths below it stay resolved
+    root = Path(root).resolve()
+
+    # guard against non-directory starting points
+    if not root.is_dir():
+        raise NotADirectoryError(f'{root} is not a directory')
+
+    scan = compile_directory_scan(regard_patterns=regard_patterns,
+                                  regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                  ignore_patterns=ignore_patterns,
+                                  include_gitignore=include_gitignore,
+                                  regex_flags=regex_flags,
+                                  with_stat=with_stat,
+                                  excluded_paths=excluded_paths)
+
+    # directories that still have to be listed, each with the gitignore scope of its parent
+    # like the stack of a synchronous walk this is unbounded, but it only holds paths
+    directories: asyncio.Queue = asyncio.Queue()
+    directories.put_nowait((str(root), GitignoreScope()))
+    # entries of listed directories, or the exception a listing failed with, bounded for backpressure
+    listed: asyncio.Queue = asyncio.Queue(maxsize=max(max_pending, 1))
+    dir_count, entry_count = 0, 0
+
+    async def list_directories():
+        nonlocal dir_count, entry_count
+
+        while True:
+            dirpath, gitignore_scope = await directories.get()
+            try:
+                entries, subdirs = await asyncio.to_thread(scan, dirpath, gitignore_scope)
+                # subdirs are queued first, so the other listers keep going while this one waits on the consumer
+                for subdir in subdirs:
+                    directories.put_nowait(subdir)
+                await listed.put(entries)
+
+                dir_count, entry_count = dir_count + 1, entry_count + len(entries)
+                if progress is not None:
+                    progress(Progress(LISTED, Path(dirpath), dir_count, entry_count))
+            except Exception as e:
+                await listed.put(e)
+            finally:
+                directories.task_done()
+
+    async def finish():
+        # every directory is done once its subdirs are queued, so the queue only drains at the end of the walk
+        await directories.join()
+        await listed.put(_DONE)
+
+    tasks = [asyncio.create_task(list_directories()) for _ in range(max(concurrency, 1))]
+    tasks.append(asyncio.create_task(finish()))
+    try:
+        while (item := await listed.get()) is not _DONE:
+            if isinstance(item, Exception):
+                raise item
+            for entry in item:
+                yield entry
+    finally:
+        # the consumer is done, failed or was cancelled, either way the walk stops here
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def ahash_map(root: str | bytes | os.PathLike | Path,
+                    regard_patterns: list[str] = None,
+                    regard_patterns_concern_dirs: bool = False,
+                    ignore_patterns: list[str] = None,
+                    include_gitignore: bool = False,
+                    regex_flags: list[re.RegexFlag] = None,
+                    name: str = 'sha256',
+                    cache: HashCache | None = None,
+                    concurrency: int = DEFAULT_CONCURRENCY,
+                    hash_concurrency: int | None = None,
+                    max_pending: int = DEFAULT_MAX_PENDING,
+                    block_size: int | None = None,
+                    use_mmap: bool = False,
+                    drop_page_cache: bool = False,
+                    progress: Callable[[Progress], None] | None = None,
+                    batch_size: int = 256) -> HashStore:
+    """
+    Asynchronously compute a map of file hashes to files that produced those hashes under a directory,
+    this is the async counterpart of get_dir_hash_map, see atraverse for the walk.
+    Symlinks are not followed, only regular files are hashed.
+
+    Files are hashed in threads while the walk is still running, at most hash_concurrency at once.
+    While all of those are busy, the walk is not consumed, so backpressure reaches the directory listings as well.
+    Cancelling the task stops both, files that are being hashed stop at their next block, see get_entry_hash.
+    Cache lookups happen in the event loop, they are single indexed reads.
+
+    :param root: directory under which to search
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
+    :param name: name of the hash algorithm, see available_algorithms
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param concurrency: how many directories to list at once
+    :param hash_concurrency: how many files to hash at once, defaults to the cpu count
+    :param max_pending: how many listed directories may wait for hashing
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :param progress: called in the event loop after every listed directory and hashed file, must not block
+    :param batch_size: how many computed hashes to add to the cache at once
+    :return: compact map of file hashes to the files that produced them, see HashStore
+    """
+
+    # the cache must not mix up hashes, if the alias resolves differently on the next run
+    name = resolve_algorithm(name)
+
+    register = HashStore()
+    slots = asyncio.Semaphore(hash_concurrency or os.cpu_count() or 1)
+    # set once the run fails or is cancelled, hashing threads check it between blocks
+    cancelled = threading.Event()
+    pending: set[asyncio.Task] = set()
+    computed: list[tuple[FileEntry, str, str]] = []
+    walked = Progress(LISTED, Path(root), 0, 0)
+    file_count, byte_count = 0, 0
+
+    def on_listed(event: Progress):
+        nonlocal walked
+        walked = event
+        if progress is not None:
+            progress(event._replace(files=file_count, bytes=byte_count))
+
+    async def hash_entry(entry: FileEntry):
+        nonlocal file_count, byte_count
+
+        try:
+            file_hash = await asyncio.to_thread(get_entry_hash, entry, name, block_size, use_mmap, drop_page_cache,
+                                                cancelled)
+        finally:
+            slots.release()
+
+        register.add(entry.path, file_hash)
+        file_count, byte_count = file_count + 1, byte_count + (entry.size or 0)
+        if progress is not None:
+            progress(Progress(HASHED, entry.path, walked.dirs, walked.entries, file_count, byte_count))
+
+        if cache is not None:
+            computed.append((entry, name, file_hash))
+            if len(computed) >= batch_size:
+                cache.put_many(computed)
+                computed.clear()
+
+    walk = atraverse(root=root,
+                     regard_patterns=regard_patterns,
+                     regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                     ignore_patterns=ignore_patterns,
+                     include_gitignore=include_gitignore,
+                     regex_flags=regex_flags,
+                     concurrency=concurrency,
+                     max_pending=max_pending,
+                     progress=on_listed)
+
+    try:
+        # closed right away if hashing fails, so the walk stops as well
+        async with aclosing(walk) as entries:
+            async for entry in entries:
+                # symlinks are skipped, they don't take up space
+                if not entry.is_file:
+                    continue
+
+                if cache is not None:
+                    cached_hash = cache.get(entry, name)
+                    if cached_hash is not None:
+                        stats.count(f'cache:hits:{name}')
+                        register.add(entry.path, cached_hash)
+                        continue
+                    stats.count(f'cache:misses:{name}')
+
+                # waits while all slots are busy, which pauses the walk
+                await slots.acquire()
+
+                # fail early, instead of only once everything else was hashed
+                for task in [task for task in pending if task.done()]:
+                    pending.discard(task)
+                    task.result()
+
+                pending.add(asyncio.create_task(hash_entry(entry)))
+
+        await asyncio.gather(*pending)
+    except BaseException:
+        cancelled.set()
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        raise
+    finally:
+        if cache is not None:
+            cache.put_many(computed)
+
+    return register
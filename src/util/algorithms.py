@@ -0,0 +1,89 @@
+import hashlib
+
+from typing import Callable, Protocol
+
+
+class HashObject(Protocol):
+    """The part of the hashlib interface we rely on, third party hashes provide it as well."""
+    digest_size: int
+
+    def update(self, data: bytes) -> None: ...
+
+    def hexdigest(self) -> str: ...
+
+
+# factories for hash objects, by algorithm name, see register_algorithm
+ALGORITHMS: dict[str, Callable[[], HashObject]] = {}
+
+# non-cryptographic or fast algorithms in order of preference, the first available one is used for 'fast'
+# blake2b is part of the standard library, so there always is a fallback
+FAST_ALGORITHMS = ['xxh3_128', 'blake3', 'blake2b']
+
+
+def register_algorithm(name: str, factory: Callable[[], HashObject]):
+    """
+    Make a hash algorithm available under a name, for use with get_file_hash and friends.
+    When hashing with the process backend, algorithms registered at runtime must be registered in the workers as well,
+    which happens automatically on platforms that fork, but not on those that spawn.
+
+    :param name: name to register the algorithm under
+    :param factory: callable without arguments, that returns a new hash object
+    """
+    ALGORITHMS[name] = factory
+
+
+def available_algorithms() -> list[str]:
+    """
+    List the names of all hash algorithms that can be used.
+
+    :return: sorted list of algorithm names, including the 'fast' alias
+    """
+    return sorted({*hashlib.algorithms_available, *ALGORITHMS, 'fast'})
+
+
+def resolve_algorithm(name: str) -> str:
+    """
+    Resolve the 'fast' alias to the fastest installed algorithm, other names are returned as is.
+
+    :param name: name of the hash algorithm
+    :return: name of the algorithm that will actually be used
+    """
+    if name == 'fast':
+        return next(algorithm for algorithm in FAST_ALGORITHMS
+                    if algorithm in ALGORITHMS or algorithm in hashlib.algorithms_available)
+    return name
+
+
+def new_hash(name: str) -> HashObject:
+    """
+    Create a new hash object, for registered algorithms, and everything hashlib offers.
+
+    :param name: name of the hash algorithm, or 'fast'
+    :return: a new hash object
+    """
+    name = resolve_algorithm(name)
+
+    if name in ALGORITHMS:
+        return ALGORITHMS[name]()
+    elif name in hashlib.algorithms_available:
+        return hashlib.new(name)
+    else:
+        raise ValueError(f'Hash algorithm "{name}" is not available on this system.')
+
+
+# register optional third party algorithms, if they are installed
+try:
+    import xxhash
+
+    register_algorithm('xxh64', xxhash.xxh64)
+    register_algorithm('xxh3_64', xxhash.xxh3_64)
+    register_algorithm('xxh3_128', xxhash.xxh3_128)
+except ImportError:
+    pass
+
+try:
+    import blake3
+
+    register_algorithm('blake3', blake3.blake3)
+except ImportError:
+    pass
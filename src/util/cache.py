@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+from util.traversal import FileEntry
+
+# where the cache lives if no path is given, follows the XDG base directory spec
+DEFAULT_CACHE_PATH = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'fileutils', 'hashes.sqlite')
+# roughly 100 bytes per row, so the default cap amounts to a few hundred MB at most
+DEFAULT_MAX_ENTRIES = 5_000_000
+
+
+class HashCache:
+    """
+    Persistent cache of file hashes, backed by SQLite.
+
+    Entries are keyed on the identity of a file (device and inode) and the name of the hash algorithm.
+    A cached hash is only considered valid, if size and modification time of the file still match,
+    so any change to the file invalidates its entry.
+    Once the cache holds more than max_entries hashes, the least recently used ones are evicted on close.
+
+    Lookups happen in the calling process, so the cache is never sent to worker processes.
+    """
+
+    def __init__(self,
+                 path: str | bytes | os.PathLike | Path = DEFAULT_CACHE_PATH,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 rebuild: bool = False):
+        """
+        :param path: where the cache database is stored, created if it does not exist
+        :param max_entries: how many hashes to keep at most
+        :param rebuild: whether to drop all cached hashes and start over
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        # the cache is expendable, so we trade durability for speed
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = OFF')
+
+        if rebuild:
+            self.connection.execute('DROP TABLE IF EXISTS hashes')
+
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (dev, ino, algorithm)
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)')
+        self.connection.commit()
+
+        # keys of entries that were hit, their last_used is refreshed in bulk on flush
+        self._hits: list[tuple[int, int, str]] = []
+
+    def get(self, entry: FileEntry, algorithm: str) -> str | None:
+        """
+        Look up the hash of a file.
+
+        :param entry: entry of the file with stat info, e.g. from iter_file_entries or FileEntry.from_path
+        :param algorithm: name of the hash algorithm
+        :return: the cached hash, or None if there is no valid entry
+        """
+        key = (entry.dev, entry.inode, algorithm)
+        row = self.connection.execute('SELECT size, mtime_ns, hash FROM hashes '
+                                      'WHERE dev = ? AND ino = ? AND algorithm = ?', key).fetchone()
+
+        # a changed size or modification time means the cached hash is stale
+        if row is None or row[0] != entry.size or row[1] != entry.mtime_ns:
+            return None
+
+        self._hits.append(key)
+        return row[2]
+
+    def put(self, entry: FileEntry, algorithm: str, file_hash: str):
+        """
+        Store the hash of a file, replacing stale entries.
+
+        :param entry: entry of the file with stat info, taken before hashing it
+        :param algorithm: name of the hash algorithm
+        :param file_hash: the hash to store
+        """
+        self.put_many([(entry, algorithm, file_hash)])
+
+    def put_many(self, entries: list[tuple[FileEntry, str, str]]):
+        """
+        Store the hashes of several files at once, see put.
+
+        :param entries: tuples of file entry, algorithm name and file hash
+        """
+        now = int(time.time())
+        self.connection.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(entry.dev, entry.inode, algorithm, entry.size, entry.mtime_ns, file_hash, now)
+                                     for entry, algorithm, file_hash in entries])
+
+    def flush(self):
+        """Refresh usage of hit entries, evict the least recently used entries if necessary, and commit."""
+        now = int(time.time())
+        self.connection.executemany('UPDATE hashes SET last_used = ? WHERE dev = ? AND ino = ? AND algorithm = ?',
+                                    [(now, *key) for key in self._hits])
+        self._hits.clear()
+
+        count, = self.connection.execute('SELECT count(*) FROM hashes').fetchone()
+        if count > self.max_entries:
+            self.connection.execute('DELETE FROM hashes WHERE rowid IN '
+                                    '(SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)',
+                                    (count - self.max_entries,))
+
+        self.connection.commit()
+
+    def clear(self):
+        """Drop all cached hashes."""
+        self._hits.clear()
+        self.connection.execute('DELETE FROM hashes')
+        self.connection.commit()
+
+    def close(self):
+        """Flush and close the underlying database."""
+        self.flush()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT count(*) FROM hashes').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
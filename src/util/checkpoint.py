@@ -0,0 +1,277 @@
+import json
+import os
+import re
+import sys
+import time
+
+from functools import reduce
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from util import stats
+from util.cache import HashCache
+from util.traversal import FileEntry, GitignoreScope, compile_directory_scan, distinct_roots
+
+# where checkpoints live if no path is given, next to the hash cache
+DEFAULT_CHECKPOINT_PATH = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'),
+                               'fileutils', 'checkpoint.sqlite')
+# how many seconds may pass between checkpoints by default, the work of at most that long is lost on a crash
+DEFAULT_INTERVAL = 10.0
+
+
+class ScanCheckpoint(HashCache):
+    """
+    Persistent state of a long running scan, so it can be resumed after it was killed, backed by SQLite.
+
+    The walk logs its frontier, the directories that still have to be listed, together with the entries of those
+    that were listed, and hashes are logged like they are in a HashCache, so files that were hashed are not read again.
+    Writes are batched, and committed at most every interval seconds, each commit is a consistent snapshot.
+    A hash cache can be chained by setting cache, it is consulted on a miss and gets every hash that is computed,
+    so using a checkpoint does not change what a scan caches.
+
+    Unlike a hash cache, a checkpoint belongs to a single scan, it is started over unless the scan is resumed.
+    """
+
+    def __init__(self,
+                 path: str | bytes | os.PathLike | Path = DEFAULT_CHECKPOINT_PATH,
+                 resume: bool = False,
+                 interval: float = DEFAULT_INTERVAL):
+        """
+        :param path: where the checkpoint database is stored, created if it does not exist
+        :param resume: whether to continue from what was logged, otherwise the checkpoint is started over
+        :param interval: how many seconds may pass between commits
+        """
+        # hashes of a scan are never evicted, the checkpoint only lives as long as the scan
+        super().__init__(path, max_entries=sys.maxsize, rebuild=not resume)
+        # set by the scan that uses the checkpoint, see get_duplicate_map
+        self.cache: HashCache | None = None
+        self.interval = interval
+        self.last_commit = time.monotonic()
+
+        # unlike the cache, a checkpoint has to survive a crash of the machine as well
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+
+        if not resume:
+            for table in ('options', 'frontier', 'entries'):
+                self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS options (options TEXT NOT NULL, walked INTEGER NOT NULL)')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS frontier (
+                dirpath BLOB NOT NULL,
+                rules TEXT NOT NULL
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                path BLOB NOT NULL,
+                is_dir INTEGER NOT NULL,
+                is_file INTEGER NOT NULL,
+                is_symlink INTEGER NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                dev INTEGER
+            )
+        ''')
+        self.connection.commit()
+
+    def get(self, entry: FileEntry, algorithm: str) -> str | None:
+        file_hash = super().get(entry, algorithm)
+        if file_hash is None and self.cache is not None:
+            file_hash = self.cache.get(entry, algorithm)
+        return file_hash
+
+    def put_many(self, entries: list[tuple[FileEntry, str, str]]):
+        super().put_many(entries)
+        if self.cache is not None:
+            self.cache.put_many(entries)
+        if self.is_due():
+            self.commit()
+
+    def is_due(self) -> bool:
+        """
+        :return: whether the interval since the last commit has passed
+        """
+        return time.monotonic() - self.last_commit >= self.interval
+
+    def commit(self):
+        """Commit everything that was logged so far."""
+        with stats.timed('checkpoint:commit'):
+            self.connection.commit()
+        self.last_commit = time.monotonic()
+
+    def start_walk(self, options: dict) -> bool:
+        """
+        Start a walk, or check that a logged one was taken with the same options.
+
+        :param options: json serializable options of the walk, the root and the traversal rules
+        :return: whether a walk was logged already
+        :raise ValueError: if the logged walk was taken with different options
+        """
+        row = self.connection.execute('SELECT options FROM options').fetchone()
+        if row is None:
+            self.connection.execute('INSERT INTO options VALUES (?, 0)', (json.dumps(options),))
+            self.commit()
+            return False
+
+        if row[0] != json.dumps(options):
+            raise ValueError(f'Checkpoint {self.path} was taken of another scan, with options {row[0]}.')
+        return True
+
+    @property
+    def walked(self) -> bool:
+        """
+        :return: whether the logged walk is complete
+        """
+        row = self.connection.execute('SELECT walked FROM options').fetchone()
+        return row is not None and bool(row[0])
+
+    def read_walk(self,
+                  regex_flags: list[re.RegexFlag] = None) -> tuple[list[FileEntry], list[tuple[str, GitignoreScope]]]:
+        """
+        Read the logged walk.
+
+        :param regex_flags: flags the gitignore rules of the frontier are compiled with
+        :return: tuple of the entries of listed directories, and the directories that still have to be listed,
+                 each with the gitignore scope of its parent
+        """
+        entries = [FileEntry(Path(os.fsdecode(path)), bool(is_dir), bool(is_file), bool(is_symlink),
+                             size, mtime_ns, inode, dev)
+                   for path, is_dir, is_file, is_symlink, size, mtime_ns, inode, dev
+                   in self.connection.execute('SELECT * FROM entries ORDER BY rowid')]
+
+        frontier = []
+        for dirpath, rules in self.connection.execute('SELECT dirpath, rules FROM frontier ORDER BY rowid'):
+            scope = GitignoreScope(tuple((pattern, negated) for pattern, negated in json.loads(rules)), regex_flags)
+            frontier.append((os.fsdecode(dirpath), scope))
+
+        return entries, frontier
+
+    def log_walk(self, entries: list[FileEntry], frontier: list[tuple[str, GitignoreScope]], walked: bool = False):
+        """
+        Log the progress of the walk and commit, so the entries and the frontier always match.
+
+        :param entries: entries of directories that were listed since the last call
+        :param frontier: all directories that still have to be listed, each with the gitignore scope of its parent
+        :param walked: whether the walk is complete
+        """
+        # paths are stored as bytes, sqlite can't encode names that are not valid utf-8 as text
+        self.connection.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    [(os.fsencode(entry.path), *entry[1:]) for entry in entries])
+        # the frontier is small compared to the entries, a depth first walk only keeps the siblings of its ancestors
+        self.connection.execute('DELETE FROM frontier')
+        self.connection.executemany('INSERT INTO frontier VALUES (?, ?)',
+                                    [(os.fsencode(dirpath), json.dumps(scope.rules)) for dirpath, scope in frontier])
+        self.connection.execute('UPDATE options SET walked = ?', (int(walked),))
+        self.commit()
+
+    def close(self):
+        """Commit and close the underlying database, the chained cache is left open."""
+        self.commit()
+        super().close()
+
+
+def iter_checkpointed_entries(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+                              checkpoint: ScanCheckpoint,
+                              regard_patterns: list[str] = None,
+                              regard_patterns_concern_dirs: bool = False,
+                              ignore_patterns: list[str] = None,
+                              include_gitignore: bool = False,
+                              regex_flags: list[re.RegexFlag] = None,
+                              workers: int = 1) -> Iterator[FileEntry]:
+    """
+    Traverse a file tree like iter_file_entries, logging the progress to a checkpoint.
+    If the checkpoint holds a walk of the same tree with the same rules, the entries it logged are yielded first,
+    and the walk continues from the logged frontier, so directories that were listed are not listed again.
+
+    With more than one worker, directories are listed by a pool of threads, see iter_file_entries.
+    Their frontier is the set of directories that were submitted, but whose entries were not yielded yet.
+
+    :param root: directory under which to start, or several, see iter_entries_under_roots
+    :param checkpoint: checkpoint to log to, and to resume from
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param workers: how many threads to list directories with
+    :return: iterator over entries with stat info for all paths under root in accordance with the passed rules
+    :raise ValueError: if the checkpoint holds a walk with other options
+    """
+
+    # resolve the starting points, symlinks are not followed, so paths below them stay resolved
+    roots = distinct_roots(root)
+
+    # guard against non-directory starting points
+    for root in roots:
+        if not root.is_dir():
+            raise NotADirectoryError(f'{root} is not a directory')
+
+    options = dict(roots=[os.fsdecode(root) for root in roots],
+                   regard_patterns=regard_patterns,
+                   regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                   ignore_patterns=ignore_patterns,
+                   include_gitignore=include_gitignore,
+                   regex_flags=int(reduce(lambda x, y: x | y, regex_flags)) if regex_flags else 0)
+
+    # reversed, so a depth first walk takes the roots in order
+    frontier = [(str(root), GitignoreScope()) for root in reversed(roots)]
+    if checkpoint.start_walk(options):
+        entries, frontier = checkpoint.read_walk(regex_flags)
+        stats.count('checkpoint:resumed_entries', len(entries))
+        yield from entries
+        if checkpoint.walked:
+            return
+    else:
+        # a walk killed before its first checkpoint resumes from the roots
+        checkpoint.log_walk([], frontier)
+
+    scan = compile_directory_scan(regard_patterns=regard_patterns,
+                                  regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                  ignore_patterns=ignore_patterns,
+                                  include_gitignore=include_gitignore,
+                                  regex_flags=regex_flags)
+    # entries of directories that were listed since the last checkpoint
+    listed: list[FileEntry] = []
+
+    if workers <= 1:
+        # popped from the end for a depth first walk, like iter_file_entries does
+        stack = frontier
+        while stack:
+            entries, subdirs = scan(*stack.pop())
+            stack.extend(reversed(subdirs))
+            listed.extend(entries)
+            yield from entries
+
+            if checkpoint.is_due():
+                checkpoint.log_walk(listed, stack)
+                listed.clear()
+
+        checkpoint.log_walk(listed, [], walked=True)
+        return
+
+    # concurrent.futures pulls in logging and threading, single threaded walks don't need to pay for that on startup
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {executor.submit(scan, *directory): directory for directory in frontier}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                del pending[future]
+                # queue up the subdirs before yielding, so the workers don't idle while the consumer works
+                pending.update((executor.submit(scan, *subdir), subdir) for subdir in subdirs)
+                listed.extend(entries)
+                yield from entries
+
+                if checkpoint.is_due():
+                    checkpoint.log_walk(listed, list(pending.values()))
+                    listed.clear()
+
+        checkpoint.log_walk(listed, [], walked=True)
+    finally:
+        # if the consumer stops early, there is no need to finish the walk
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,315 @@
+import functools
+import os
+import random
+import re
+
+from collections import defaultdict
+from itertools import combinations
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from util import stats
+from util.algorithms import new_hash, resolve_algorithm
+from util.duplicates import group_hardlinks, print_csv
+from util.executor import BoundedExecutor
+from util.hashing import advise
+from util.traversal import FileEntry, iter_entries_under_roots
+
+# numpy scans for chunk boundaries a whole block at a time, without it every byte passes through the interpreter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# chunk sizes in bytes, chunks are cut where the content allows it, so they are only this big on average
+DEFAULT_MIN_CHUNK_SIZE = 2 * 1024
+DEFAULT_AVG_CHUNK_SIZE = 8 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 64 * 1024
+# how many bytes to read and scan for boundaries at once
+CHUNK_BLOCK_SIZE = 1024 * 1024
+# how many bytes numpy scans at once, see find_candidates_numpy
+NUMPY_PIECE_SIZE = 64 * 1024
+# files below this size are not chunked, near duplicates are interesting for large files
+DEFAULT_MIN_FILE_SIZE = 1024 * 1024
+# chunks found in more files than this are skipped when pairing files, e.g. runs of zeros in disk images,
+# otherwise every one of them adds to the count of pairs quadratically
+DEFAULT_MAX_OCCURRENCES = 64
+
+# the gear hash of a position depends on this many bytes up to and including it
+WINDOW = 32
+# random values for every byte, fixed, so the same content is always cut at the same places
+GEAR = random.Random(0x67656172).choices(range(1 << 32), k=256)
+
+
+class Chunk(NamedTuple):
+    """A piece of a file, cut where its content allows it, see iter_chunks."""
+    offset: int
+    size: int
+    # the first 64 bits of the hash of the chunk
+    digest: int
+
+
+class SimilarFiles(NamedTuple):
+    """A pair of files that share chunks, see find_similar_files."""
+    # shared bytes relative to the larger of the two files
+    ratio: float
+    shared: int
+    path: Path
+    other: Path
+
+
+def find_candidates_python(data: bytes, context: int, threshold: int) -> list[int]:
+    """
+    Find the positions after which the gear hash allows to cut a chunk, byte by byte.
+
+    :param data: bytes to scan, starting with up to WINDOW - 1 bytes of context from before
+    :param context: how many bytes of context data starts with, positions in those are not reported
+    :param threshold: a cut is allowed where the gear hash is below this
+    :return: positions of the bytes after which a cut is allowed, relative to the end of the context
+    """
+    gear, candidates = GEAR, []
+    h = 0
+    for i, byte in enumerate(data):
+        # bits that are shifted out of the 32 bits are dropped, so only the last WINDOW bytes count
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        if h < threshold and i >= context:
+            candidates.append(i - context)
+    return candidates
+
+
+def find_candidates_numpy(data: bytes, context: int, threshold: int) -> list[int]:
+    """
+    Find the positions after which the gear hash allows to cut a chunk, see find_candidates_python.
+    The results are the same, but they are computed for a whole block at once.
+
+    The hash of a position is the sum of the gear values of the last WINDOW bytes, each shifted left by its distance,
+    so sums over the last 2m bytes can be computed from those over the last m bytes with a single shift and add,
+    which takes log2(WINDOW) passes over the block, instead of one pass per byte of the window.
+    """
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    candidates = []
+
+    # the block is processed in pieces whose arrays fit into the cpu cache, that is several times faster than
+    # passing over arrays of the whole block, pieces overlap by a window, so every hash sees all of its bytes
+    for start in range(0, len(raw), NUMPY_PIECE_SIZE):
+        piece_start = max(start - (WINDOW - 1), 0)
+        h = _GEAR_ARRAY[raw[piece_start:start + NUMPY_PIECE_SIZE]]
+
+        span = 1
+        while span < WINDOW:
+            # uint32 arithmetic drops the bits that overflow, like the byte by byte version does
+            h[span:] += h[:-span] << span
+            span *= 2
+
+        first = max(start, context) - piece_start
+        candidates.extend((numpy.flatnonzero(h[first:] < threshold) + (piece_start + first - context)).tolist())
+
+    return candidates
+
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32)
+    find_candidates: Callable[[bytes, int, int], list[int]] = find_candidates_numpy
+else:
+    find_candidates = find_candidates_python
+
+
+def iter_chunks(file: str | bytes | os.PathLike | Path,
+                name: str = 'fast',
+                min_size: int = DEFAULT_MIN_CHUNK_SIZE,
+                avg_size: int = DEFAULT_AVG_CHUNK_SIZE,
+                max_size: int = DEFAULT_MAX_CHUNK_SIZE,
+                block_size: int = CHUNK_BLOCK_SIZE) -> Iterator[Chunk]:
+    """
+    Split a file into chunks, at places that depend on the content around them, not on their offset.
+    Inserting or removing bytes only changes the chunks around the change, the others are cut the same way,
+    so files that share most of their content share most of their chunks as well.
+
+    Cuts are allowed where a gear hash over the last WINDOW bytes falls below a threshold,
+    and chunks are cut at the first allowed place once they have min_size, or at max_size if there is none.
+    The threshold makes chunks avg_size bytes on average. Where chunks are cut does not depend on block_size.
+
+    :param file: path to the file
+    :param name: name of the hash algorithm to hash the chunks with, see available_algorithms
+    :param min_size: how many bytes a chunk has at least, unless it is the last one
+    :param avg_size: how many bytes a chunk has on average
+    :param max_size: how many bytes a chunk has at most
+    :param block_size: how many bytes to read and scan at once
+    :return: iterator over the chunks, in order
+    """
+    if not 0 < min_size < avg_size <= max_size:
+        raise ValueError(f'Chunk sizes must be ordered, but got {min_size}, {avg_size} and {max_size}.')
+
+    # after min_size, a cut is allowed with a probability of 1 / (avg_size - min_size) per byte
+    threshold = (1 << 32) // (avg_size - min_size)
+
+    def make_chunk(data: memoryview, offset: int) -> Chunk:
+        hash_object = new_hash(name)
+        hash_object.update(data)
+        return Chunk(offset, len(data), int(hash_object.hexdigest()[:16], 16))
+
+    with open(file, 'rb', buffering=0) as f:
+        advise(f.fileno(), 'SEQUENTIAL')
+
+        # the last bytes of the previous block, the hash needs them, and the uncut rest of the previous block
+        context, pending = b'', b''
+        # offset of the rest in the file
+        offset = 0
+
+        while block := f.read(block_size):
+            buffer = pending + block
+            view = memoryview(buffer)
+            start = 0
+
+            for candidate in find_candidates(context + block, len(context), threshold):
+                end = len(pending) + candidate + 1
+                # no cut was allowed for too long
+                while end - start > max_size:
+                    yield make_chunk(view[start:start + max_size], offset + start)
+                    start += max_size
+                if end - start >= min_size:
+                    yield make_chunk(view[start:end], offset + start)
+                    start = end
+
+            while len(buffer) - start >= max_size:
+                yield make_chunk(view[start:start + max_size], offset + start)
+                start += max_size
+
+            context = (context + block)[-(WINDOW - 1):]
+            pending, offset = buffer[start:], offset + start
+
+        if pending:
+            yield make_chunk(memoryview(pending), offset)
+
+
+def get_chunk_sizes(entry: FileEntry,
+                    name: str = 'fast',
+                    min_size: int = DEFAULT_MIN_CHUNK_SIZE,
+                    avg_size: int = DEFAULT_AVG_CHUNK_SIZE,
+                    max_size: int = DEFAULT_MAX_CHUNK_SIZE,
+                    sample: int = 1) -> tuple[FileEntry, dict[int, int]]:
+    """
+    Chunk a file, and collect its distinct chunks, see iter_chunks.
+
+    :param entry: entry of the file, as produced by iter_file_entries
+    :param name: name of the hash algorithm to hash the chunks with
+    :param min_size: how many bytes a chunk has at least
+    :param avg_size: how many bytes a chunk has on average
+    :param max_size: how many bytes a chunk has at most
+    :param sample: only keep chunks whose digest is divisible by this, all files keep the same chunks,
+                   so ratios of shared bytes can be estimated from a fraction of the chunks
+    :return: tuple of the entry and a map of its distinct chunk digests to their sizes
+    """
+    chunks = {}
+    count = 0
+    for chunk in iter_chunks(entry.path, name=name, min_size=min_size, avg_size=avg_size, max_size=max_size):
+        count += 1
+        if chunk.digest % sample == 0:
+            chunks[chunk.digest] = chunk.size
+
+    stats.count('chunking:files')
+    stats.count('chunking:bytes', entry.size or 0)
+    stats.count('chunking:chunks', count)
+
+    return entry, chunks
+
+
+def find_similar_files(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+                       regard_patterns: list[str] = None,
+                       regard_patterns_concern_dirs: bool = False,
+                       ignore_patterns: list[str] = None,
+                       include_gitignore: bool = False,
+                       regex_flags: list[re.RegexFlag] = None,
+                       name: str = 'fast',
+                       min_ratio: float = 0.5,
+                       min_file_size: int = DEFAULT_MIN_FILE_SIZE,
+                       min_chunk_size: int = DEFAULT_MIN_CHUNK_SIZE,
+                       avg_chunk_size: int = DEFAULT_AVG_CHUNK_SIZE,
+                       max_chunk_size: int = DEFAULT_MAX_CHUNK_SIZE,
+                       sample: int = 1,
+                       max_occurrences: int = DEFAULT_MAX_OCCURRENCES,
+                       processes: int = 1,
+                       workers: int = 1,
+                       print_results: bool = False) -> list[SimilarFiles]:
+    """
+    Find pairs of files under a directory that share much of their content, even if they are not identical,
+    like disk images, logs or database dumps that only differ in a few places.
+    Parameters largely correspond to the ones for find_duplicate_files.
+
+    Files are split into content defined chunks, see iter_chunks, and an index of chunks to the files that contain
+    them is built. Pairs of files are scored by the bytes of the distinct chunks they share,
+    relative to the distinct bytes of the larger file, so identical files score 1.
+    Hardlinks are only considered once, since they don't take up space.
+
+    :param root: directory under which to search, or several
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
+    :param name: name of the hash algorithm to hash the chunks with, see available_algorithms
+    :param min_ratio: how much two files need to share to be reported, between 0 and 1
+    :param min_file_size: files below this size are skipped
+    :param min_chunk_size: how many bytes a chunk has at least
+    :param avg_chunk_size: how many bytes a chunk has on average
+    :param max_chunk_size: how many bytes a chunk has at most
+    :param sample: only index one in this many chunks, to save memory on huge trees, see get_chunk_sizes
+    :param max_occurrences: chunks that are found in more files than this are not counted, see DEFAULT_MAX_OCCURRENCES
+    :param processes: how many threads to chunk files with, a single one chunks in this thread
+    :param workers: how many threads to list directories with
+    :param print_results: whether to print the pairs as csv, with the ratio in the first column
+    :return: list of the pairs of similar files, most similar first
+    """
+
+    name = resolve_algorithm(name)
+
+    with stats.timed('similar:walk'):
+        walk = iter_entries_under_roots(root,
+                                        regard_patterns=regard_patterns,
+                                        regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                        ignore_patterns=ignore_patterns,
+                                        include_gitignore=include_gitignore,
+                                        regex_flags=regex_flags,
+                                        workers=workers)
+        entries, _ = group_hardlinks(entry for entry in walk if entry.size >= min_file_size)
+
+    files: list[Path] = []
+    # distinct bytes per file, and the size of every chunk
+    file_sizes: list[int] = []
+    chunk_sizes: dict[int, int] = {}
+    # the index, chunk digests to the indices of the files that contain them
+    occurrences: dict[int, list[int]] = defaultdict(list)
+
+    with stats.timed('similar:chunk'):
+        work = functools.partial(get_chunk_sizes, name=name, min_size=min_chunk_size, avg_size=avg_chunk_size,
+                                 max_size=max_chunk_size, sample=sample)
+        with BoundedExecutor(workers=processes, chunksize=1) as executor:
+            for entry, chunks in executor.map_unordered(work, entries):
+                file = len(files)
+                files.append(entry.path)
+                file_sizes.append(sum(chunks.values()))
+                chunk_sizes.update(chunks)
+                for digest in chunks:
+                    occurrences[digest].append(file)
+
+    with stats.timed('similar:pairs'):
+        shared: dict[tuple[int, int], int] = defaultdict(int)
+        for digest, containing in occurrences.items():
+            if 1 < len(containing) <= max_occurrences:
+                for pair in combinations(containing, 2):
+                    shared[pair] += chunk_sizes[digest]
+
+        similar = []
+        for (file, other), shared_bytes in shared.items():
+            ratio = shared_bytes / max(file_sizes[file], file_sizes[other])
+            if ratio >= min_ratio:
+                similar.append(SimilarFiles(ratio, shared_bytes, *sorted((files[file], files[other]))))
+
+    similar.sort(key=lambda pair: (-pair.ratio, pair.path, pair.other))
+    stats.count('similar:pairs', len(similar))
+
+    if print_results:
+        for pair in similar:
+            print_csv([[pair.path, pair.other]], prefix=f'{pair.ratio:.3f}')
+
+    return similar
@@ -1,98 +1,682 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
 import os
 import sys
 import re
 
 from pathlib import Path
-from util.hashing import get_dir_hash_map
+from collections import defaultdict
+from typing import Callable, Iterable
+
+from util import stats
+from util.cache import HashCache, DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES
+from util.checkpoint import ScanCheckpoint, DEFAULT_CHECKPOINT_PATH, iter_checkpointed_entries
+from util.executor import BoundedExecutor, BACKENDS, ORDERS, create_executor
+from util.index import DuplicateIndex, DEFAULT_INDEX_PATH
+from util.extents import extents_supported, get_first_extent
+from util.algorithms import available_algorithms, resolve_algorithm
+from util.hashing import compute_hashes, get_entry_hash_tuple, get_partial_entry_hash_tuple, \
+    PARTIAL_HASH_SIZE, DEFAULT_BLOCK_SIZE
+from util.traversal import FileEntry, distinct_roots, iter_entries_under_roots
+
+
+def verify_option(value: str) -> str:
+    """
+    Check a --verify option while parsing arguments, instead of once the whole search is done.
+
+    :param value: 'bytes' or the name of a hash algorithm, see available_algorithms
+    :return: the value itself
+    :raises argparse.ArgumentTypeError: if it is neither
+    """
+    if value != 'bytes' and value not in available_algorithms():
+        raise argparse.ArgumentTypeError(f'expected "bytes" or one of {", ".join(available_algorithms())}, '
+                                         f'got "{value}"')
+    return value
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Prints files under a directory that are duplicates '
+                                                 'of one another as csv, one group of duplicates per line')
+
+    parser.add_argument('path', nargs='*', type=Path, default=[Path(os.getcwd())],
+                        help='the paths under which to search, duplicates across them are found as well, '
+                             'defaults to cwd')
+    parser.add_argument('-r', '--regard', nargs='+', help='only consider files matching these glob patterns')
+    parser.add_argument('-i', '--ignore', nargs='+', help='ignore files and dirs matching these glob patterns')
+    parser.add_argument('-g', '--gitignore', action='store_true', help='respect .gitignore files')
+    parser.add_argument('-a', '--algorithm', choices=available_algorithms(), default='sha256', metavar='ALGORITHM',
+                        help='hash algorithm to use, "fast" picks the fastest one installed, defaults to sha256')
+    parser.add_argument('--verify', type=verify_option, metavar='bytes|ALGORITHM',
+                        help='confirm duplicates by comparing bytes, or by hashing with another algorithm')
+    parser.add_argument('--hardlinks', action='store_true',
+                        help='print groups of hardlinks to the same inode instead of duplicates')
+    parser.add_argument('--skip-reflinks', action='store_true',
+                        help='do not report copies that already share their data on disk, only works on linux')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                        help='how many workers to hash with, defaults to the cpu count')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, default='thread',
+                        help='whether to hash with threads or processes, processes may do better for tiny files')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='how many threads to list directories with, helps on network filesystems')
+
+    io_group = parser.add_argument_group('file reading')
+    io_group.add_argument('--block-size', type=int, help='how many bytes to read at once when hashing')
+    io_group.add_argument('--mmap', action='store_true', help='memory map large files instead of reading them')
+    io_group.add_argument('--drop-page-cache', action='store_true',
+                          help='advise the kernel to drop hashed files from the page cache')
+
+    device_group = parser.add_argument_group('scheduling')
+    device_group.add_argument('--per-device', action='store_true',
+                              help='hash with a pool of --processes workers per disk, '
+                                   'so several disks are read at once')
+    device_group.add_argument('--device-workers', nargs='+', metavar='PATH=N', default=[],
+                              help='how many workers to hash with on the disk a path is on, e.g. 1 for spinning disks, '
+                                   'implies --per-device')
+    device_group.add_argument('--order', choices=ORDERS, default='inode',
+                              help='how to order files within a disk, by inode or by physical offset, '
+                                   'which is exact but costs an extra call per file, defaults to inode')
+
+    cache_group = parser.add_argument_group('hash cache')
+    cache_group.add_argument('--cache', type=Path, default=DEFAULT_CACHE_PATH,
+                             help=f'where to keep the hash cache, defaults to {DEFAULT_CACHE_PATH}')
+    cache_group.add_argument('--cache-size', type=int, default=DEFAULT_MAX_ENTRIES,
+                             help='how many hashes to keep in the cache at most')
+    cache_group.add_argument('--no-cache', action='store_true', help='bypass the hash cache')
+    cache_group.add_argument('--rebuild-cache', action='store_true', help='drop all cached hashes before searching')
+
+    index_group = parser.add_argument_group('duplicate index')
+    index_group.add_argument('--index', nargs='?', type=Path, const=DEFAULT_INDEX_PATH, metavar='PATH',
+                             help='only print groups of duplicates that changed since the last run with an index, '
+                                  f'defaults to {DEFAULT_INDEX_PATH}')
+    index_group.add_argument('--rebuild-index', action='store_true', help='drop all indexed groups before searching')
+
+    checkpoint_group = parser.add_argument_group('checkpoints')
+    checkpoint_group.add_argument('--checkpoint', nargs='?', type=Path, const=DEFAULT_CHECKPOINT_PATH, metavar='PATH',
+                                  help='log progress of the walk and of hashing, so a killed run can be resumed, '
+                                       f'defaults to {DEFAULT_CHECKPOINT_PATH}')
+    checkpoint_group.add_argument('--resume', action='store_true',
+                                  help='resume the run logged in the checkpoint, instead of starting over')
 
+    similar_group = parser.add_argument_group('near duplicates')
+    similar_group.add_argument('--similar', nargs='?', type=float, const=0.5, metavar='RATIO',
+                               help='print pairs of files that share at least this ratio of their content instead, '
+                                    'with the ratio in the first column, defaults to 0.5')
+    similar_group.add_argument('--min-file-size', type=int, default=1024 * 1024,
+                               help='skip smaller files when looking for near duplicates, defaults to 1 MiB')
+    similar_group.add_argument('--sample', type=int, default=1,
+                               help='only index one in this many chunks, saves memory on huge trees')
+
+    args = parser.parse_args(args)
+
+    # workers are keyed on the device, the path only tells which one is meant
+    device_workers = {}
+    for spec in args.device_workers:
+        path, _, workers = spec.rpartition('=')
+        if not path or not workers.isdigit() or int(workers) < 1:
+            parser.error(f'--device-workers expects PATH=N with N at least 1, got "{spec}"')
+        try:
+            device_workers[os.stat(path).st_dev] = int(workers)
+        except OSError as e:
+            parser.error(f'--device-workers: {e}')
+    args.device_workers = device_workers
+
+    # resuming makes no sense without a checkpoint, so it implies the default one
+    if args.resume and args.checkpoint is None:
+        args.checkpoint = DEFAULT_CHECKPOINT_PATH
+
+    return args
+
+
+def group_hardlinks(entries: Iterable[FileEntry]) -> tuple[list[FileEntry], dict[tuple[int, int], list[Path]]]:
+    """
+    Collapse hardlinks, i.e. regular files that share device and inode, so each inode is only hashed once.
+    Anything that is not a regular file, including symlinks, is skipped.
+
+    :param entries: entries with stat info, as produced by iter_file_entries
+    :return: tuple of one entry per inode, the first one encountered,
+             and a map of (device, inode) to the paths of all hardlinks of inodes that have more than one
+    """
+    representatives: dict[tuple[int, int], FileEntry] = {}
+    links: dict[tuple[int, int], list[Path]] = defaultdict(list)
+    for entry in entries:
+        # symlinks are not followed, they don't take up space, and would show up as duplicates of their target
+        if not entry.is_file:
+            continue
+
+        key = (entry.dev, entry.inode)
+        if key in representatives:
+            links[key].append(entry.path)
+        else:
+            representatives[key] = entry
+
+    hardlinks = {key: [representatives[key].path, *paths] for key, paths in links.items()}
+    return list(representatives.values()), hardlinks
+
+
+def get_first_extent_tuple(entry: FileEntry) -> tuple[FileEntry, tuple[int, bool] | None]:
+    """
+    Uses get_first_extent to look up where the data of a file starts on disk, but returns the entry as well.
+
+    :param entry: entry of the file
+    :return: tuple of the entry and its first extent, see get_first_extent
+    """
+    return entry, get_first_extent(entry.path)
+
+
+def skip_shared_extents(duplicates: dict[str, list[FileEntry]],
+                        executor: BoundedExecutor) -> dict[str, list[FileEntry]]:
+    """
+    Collapse duplicates that already share their data on disk, like reflinked copies, so only one of them remains.
+    Files are considered shared, if their first extent is flagged as shared and starts at the same physical offset.
+    Does nothing where extents can't be queried, see extents_supported.
+
+    :param duplicates: map of hashes to entries of files that are duplicates of one another
+    :param executor: executor to query extents with
+    :return: map of hashes to entries, only containing groups that still have more than one entry
+    """
+    if not extents_supported():
+        return duplicates
+
+    entries = [entry for group in duplicates.values() for entry in group]
+    extents = dict(executor.map_unordered(get_first_extent_tuple, entries))
+
+    collapsed: dict[str, list[FileEntry]] = {}
+    for file_hash, group in duplicates.items():
+        seen, remaining = set(), []
+        for entry in group:
+            extent = extents[entry]
+            # unshared or unknown extents always count as separate copies
+            if extent is not None and extent[1]:
+                if (entry.dev, extent[0]) in seen:
+                    continue
+                seen.add((entry.dev, extent[0]))
+            remaining.append(entry)
+
+        if len(remaining) > 1:
+            collapsed[file_hash] = remaining
+
+    return collapsed
+
+
+def group_files_by_size(entries: Iterable[FileEntry]) -> dict[int, list[FileEntry]]:
+    """
+    Group regular files by their size. Anything that is not a regular file, including symlinks, is skipped.
+
+    :param entries: entries with stat info, as produced by iter_file_entries or group_hardlinks
+    :return: map of file sizes to the entries of files that have that size
+    """
+    groups: dict[int, list[FileEntry]] = defaultdict(list)
+    for entry in entries:
+        # symlinks are not followed, they don't take up space, and would show up as duplicates of their target
+        if entry.is_file:
+            groups[entry.size].append(entry)
+
+    return groups
+
+
+def get_hash_tuple_if_readable(entry: FileEntry,
+                               work: Callable[[FileEntry], tuple[FileEntry, str]]) -> tuple[FileEntry, str | None]:
+    """
+    Hash a file with work, but return None as its hash if it can't be hashed anymore.
+    Files are hashed long after the walk took their stat info, so they may have vanished, shrunk or become unreadable,
+    and a single one of those should not abort the whole search.
+
+    :param entry: entry of the file
+    :param work: function taking an entry and returning a tuple of the entry and its hash
+    :return: tuple of the entry and its hash, or None
+    """
+    try:
+        return work(entry)
+    # mmap raises ValueError for files that became empty
+    except (OSError, ValueError):
+        return entry, None
+
+
+def split_groups_by_hash(groups: Iterable[list[FileEntry]],
+                         work: Callable[[FileEntry], tuple[FileEntry, str]],
+                         executor: BoundedExecutor,
+                         cache: HashCache | None = None,
+                         algorithm: str | None = None) -> list[tuple[str, list[FileEntry]]]:
+    """
+    Split groups of candidate files further by a hash, keeping only the subgroups that still collide.
+    Files of different groups never end up in the same subgroup, even if their hashes match,
+    so the same hash may show up for several subgroups, e.g. partial hashes of files with different sizes.
+    Files that can't be hashed anymore are dropped from their group, see get_hash_tuple_if_readable.
+
+    :param groups: groups of entries of files that might be duplicates of one another
+    :param work: function taking an entry and returning a tuple of the entry and its hash
+    :param executor: executor to compute the hashes with
+    :param cache: hash cache to consult, None to bypass caching
+    :param algorithm: key of the hash in the cache, see compute_hashes
+    :return: list of tuples of a hash and the entries of files that produced it, only containing collisions
+    """
+    groups = list(groups)
+    entries = [entry for group in groups for entry in group]
+    hashes = compute_hashes(entries, functools.partial(get_hash_tuple_if_readable, work=work), executor,
+                            cache=cache, algorithm=algorithm)
+
+    subgroups: list[tuple[str, list[FileEntry]]] = []
+    for group in groups:
+        register: dict[str, list[FileEntry]] = defaultdict(list)
+        for entry in group:
+            if hashes[entry] is None:
+                stats.count('duplicates:unreadable')
+                continue
+            register[hashes[entry]].append(entry)
+
+        subgroups.extend((file_hash, entry_list)
+                         for file_hash, entry_list in register.items()
+                         if len(entry_list) > 1)
+
+    return subgroups
+
+
+def files_are_equal(file: Path, other: Path, block_size: int = DEFAULT_BLOCK_SIZE) -> bool:
+    """
+    Compare two files byte by byte, stopping at the first difference.
 
-def find_duplicate_files(root: str | bytes | os.PathLike | Path,
+    :param file: path to a file
+    :param other: path to the file to compare it to
+    :param block_size: how many bytes to compare at once
+    :return: whether the files have the same content
+    """
+    with open(file, 'rb') as f, open(other, 'rb') as o:
+        while True:
+            block, other_block = f.read(block_size), o.read(block_size)
+            if block != other_block:
+                return False
+            if not block:
+                return True
+
+
+def split_group_by_content(group: tuple[str, list[FileEntry]]) -> list[tuple[str, list[FileEntry]]]:
+    """
+    Split a group of files with the same hash by comparing their content, to rule out hash collisions.
+    Every file is compared to one representative of each subgroup found so far, so a group of actual duplicates
+    costs one comparison per file.
+
+    :param group: tuple of the hash and the entries of the files that produced it
+    :return: list of tuples of hash and the entries that are actual duplicates of one another,
+             if a collision splits the group, the hashes of further subgroups get a numbered suffix to stay unique
+    """
+    file_hash, entries = group
+
+    subgroups: list[list[FileEntry]] = []
+    for entry in entries:
+        for subgroup in subgroups:
+            try:
+                equal = files_are_equal(subgroup[0].path, entry.path)
+            except OSError:
+                # either file may have vanished since it was hashed, it ends up alone and is dropped with the others
+                equal = False
+            if equal:
+                subgroup.append(entry)
+                break
+        else:
+            subgroups.append([entry])
+
+    subgroups = [subgroup for subgroup in subgroups if len(subgroup) > 1]
+    return [(file_hash if i == 0 else f'{file_hash}:{i}', subgroup) for i, subgroup in enumerate(subgroups)]
+
+
+def verify_duplicates(duplicates: dict[str, list[FileEntry]],
+                      verify: str,
+                      executor: BoundedExecutor,
+                      cache: HashCache | None = None,
+                      block_size: int | None = None,
+                      use_mmap: bool = False,
+                      drop_page_cache: bool = False) -> dict[str, list[FileEntry]]:
+    """
+    Confirm duplicates that were found with a fast, possibly non-cryptographic hash.
+
+    :param duplicates: map of hashes to entries of files that produced them
+    :param verify: 'bytes' to compare files byte by byte, or the name of a hash algorithm to hash them with again
+    :param executor: executor to do the work with
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :return: map of hashes to entries of files that are confirmed duplicates, keyed on the verifying hash if any
+    """
+    if verify == 'bytes':
+        return {file_hash: entries
+                for subgroups in executor.map_unordered(split_group_by_content, duplicates.items())
+                for file_hash, entries in subgroups}
+
+    verify = resolve_algorithm(verify)
+    work = functools.partial(get_entry_hash_tuple, name=verify, block_size=block_size,
+                             use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+    # files with the same full hash have the same content, so the verifying hashes of different groups differ
+    return dict(split_groups_by_hash(duplicates.values(), work, executor, cache=cache, algorithm=verify))
+
+
+def get_duplicate_map(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+                      regard_patterns: list[str] = None,
+                      regard_patterns_concern_dirs: bool = False,
+                      ignore_patterns: list[str] = None,
+                      include_gitignore: bool = False,
+                      regex_flags: list[re.RegexFlag] = None,
+                      name: str = 'sha256',
+                      processes: int = 1,
+                      partial_size: int = PARTIAL_HASH_SIZE,
+                      cache: HashCache | None = None,
+                      workers: int = 1,
+                      backend: str = 'thread',
+                      block_size: int | None = None,
+                      use_mmap: bool = False,
+                      drop_page_cache: bool = False,
+                      verify: str | None = None,
+                      skip_reflinks: bool = False,
+                      hardlinks: dict[tuple[int, int], list[Path]] | None = None,
+                      checkpoint: ScanCheckpoint | None = None,
+                      per_device: bool = False,
+                      device_workers: dict[int, int] | None = None,
+                      order: str = 'inode') -> dict[str, list[Path]]:
+    """
+    Compute a map of file hashes to files that are duplicates of one another under a directory.
+    Parameters largely correspond to the ones for get_dir_hash_map.
+
+    Unlike get_dir_hash_map this does not hash every file. Candidates are narrowed down in stages:
+    hardlinks take up no extra space, so only one path per inode is considered, and the others are reported separately.
+    Files are grouped by size next, and files with a unique size are never opened.
+    The remaining candidates are compared by a hash of their first and last few bytes,
+    and only those that still collide get hashed completely.
+    When hashing with a fast, non-cryptographic algorithm, the results can be confirmed in a last stage.
+
+    :param root: directory under which to search, or several, whose duplicates are merged into one map
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
+    :param name: name of the hash algorithm, see available_algorithms
+    :param processes: how many workers to hash files with, a single one hashes in this process
+    :param partial_size: how many bytes from the start and the end of a file go into the partial hash
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param workers: how many threads to list directories with
+    :param backend: whether to hash with a pool of 'thread's or 'process'es, see BoundedExecutor
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :param verify: None to trust the hash, 'bytes' to confirm duplicates by comparing them byte by byte,
+                   or the name of a hash algorithm to confirm them with, the result is keyed on that hash then
+    :param skip_reflinks: whether to collapse duplicates that already share their data on disk, see skip_shared_extents
+    :param hardlinks: if a dict is passed, it is filled with groups of paths that are hardlinks to the same inode,
+                      keyed on (device, inode), only the first of those paths is considered for duplicates
+    :param checkpoint: checkpoint to log the walk and the hashes to, and to resume from, see ScanCheckpoint,
+                       hashes are looked up in the checkpoint first, and then in the cache
+    :param per_device: whether to hash with a pool per device, so several disks are read at once, see DeviceExecutor,
+                       processes is the number of workers per device then
+    :param device_workers: how many workers to hash with per device, keyed on st_dev, implies per_device
+    :param order: how to order files within a device, 'inode', 'offset' or 'none', see DeviceExecutor
+    :return: map of file hashes to lists of files that are duplicates of one another
+    """
+
+    # the cache must not mix up hashes, if the alias resolves differently on the next run
+    name = resolve_algorithm(name)
+
+    # stage zero: collapse hardlinks, each inode only needs to be looked at once
+    with stats.timed('duplicates:walk'):
+        walk_options = dict(regard_patterns=regard_patterns,
+                            regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                            ignore_patterns=ignore_patterns,
+                            include_gitignore=include_gitignore,
+                            regex_flags=regex_flags,
+                            workers=workers)
+        if checkpoint is None:
+            walk = iter_entries_under_roots(root, **walk_options)
+        else:
+            walk = iter_checkpointed_entries(root, checkpoint, **walk_options)
+            # the checkpoint falls back on the cache, and passes computed hashes on to it
+            checkpoint.cache, cache = cache, checkpoint
+        entries, hardlink_groups = group_hardlinks(walk)
+    if hardlinks is not None:
+        hardlinks.update(hardlink_groups)
+
+    # stage one: group by size, this only needs the stat info the walk already gathered
+    with stats.timed('duplicates:size'):
+        size_groups = group_files_by_size(entries)
+        # files with a unique size can't have duplicates
+        size_groups = {size: files for size, files in size_groups.items() if len(files) > 1}
+    stats.count('duplicates:files', len(entries))
+    stats.count('duplicates:size_candidates', sum(len(files) for files in size_groups.values()))
+
+    with create_executor(workers=processes, backend=backend, per_device=per_device,
+                         device_workers=device_workers, order=order) as executor:
+        # stage two: partial hashes, for small files these already cover the whole file
+        with stats.timed('duplicates:partial'):
+            partial_work = functools.partial(get_partial_entry_hash_tuple, name=name, size=partial_size)
+            small_groups = [files for size, files in size_groups.items() if size <= 2 * partial_size]
+            large_groups = [files for size, files in size_groups.items() if size > 2 * partial_size]
+
+            # partial hashes of small files are full hashes, so they share a cache key with those
+            # and since they cover the whole file, files of different sizes can't share them
+            duplicates = dict(split_groups_by_hash(small_groups, partial_work, executor,
+                                                   cache=cache, algorithm=name))
+            # partial hashes of large files of different sizes may collide, so these are kept apart as groups
+            partial_duplicates = [files for _, files in split_groups_by_hash(
+                large_groups, partial_work, executor, cache=cache, algorithm=f'{name}:partial:{partial_size}')]
+        stats.count('duplicates:partial_candidates', sum(len(files) for files in partial_duplicates))
+
+        # stage three: full hashes for large files that still collide
+        with stats.timed('duplicates:full'):
+            full_work = functools.partial(get_entry_hash_tuple, name=name, block_size=block_size,
+                                          use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+            duplicates.update(split_groups_by_hash(partial_duplicates, full_work, executor,
+                                                   cache=cache, algorithm=name))
+
+        # stage four: confirm the duplicates, if the hash alone is not trusted
+        if verify is not None:
+            with stats.timed('duplicates:verify'):
+                duplicates = verify_duplicates(duplicates, verify, executor, cache=cache, block_size=block_size,
+                                               use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+
+        # copies that already share their data on disk take up no extra space either
+        if skip_reflinks:
+            with stats.timed('duplicates:reflinks'):
+                duplicates = skip_shared_extents(duplicates, executor)
+
+    stats.count('duplicates:groups', len(duplicates))
+
+    return {file_hash: [entry.path for entry in entry_list] for file_hash, entry_list in duplicates.items()}
+
+
+def find_duplicate_files(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
                          regard_patterns: list[str] = None,
                          regard_patterns_concern_dirs: bool = False,
                          ignore_patterns: list[str] = None,
                          include_gitignore: bool = False,
                          regex_flags: list[re.RegexFlag] = None,
+                         name: str = 'sha256',
                          processes: int = 1,
-                         print_results: bool = False) -> dict[str, list[Path]]:
+                         print_results: bool = False,
+                         cache: HashCache | None = None,
+                         workers: int = 1,
+                         backend: str = 'thread',
+                         block_size: int | None = None,
+                         use_mmap: bool = False,
+                         drop_page_cache: bool = False,
+                         verify: str | None = None,
+                         skip_reflinks: bool = False,
+                         hardlinks: dict[tuple[int, int], list[Path]] | None = None,
+                         index: DuplicateIndex | None = None,
+                         checkpoint: ScanCheckpoint | None = None,
+                         per_device: bool = False,
+                         device_workers: dict[int, int] | None = None,
+                         order: str = 'inode') -> dict[str, list[Path]]:
     """
     Find duplicate files under a directory by hash.
     Parameters largely correspond to the ones for traverse_file_tree.
 
-    :param root: directory under which to search
+    :param root: directory under which to search, or several, see get_duplicate_map
     :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
     :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
     :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
     :param include_gitignore: whether to include .gitignore files in the ignore_patterns
     :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
-    :param processes: how many processes to fork for file hashing
+    :param name: name of the hash algorithm, see available_algorithms, e.g. 'fast' on trusted storage
+    :param processes: how many workers to hash files with, a single one hashes in this process
     :param print_results: whether to print duplicates as csv, where each line contains files that are duplicates of one another
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param workers: how many threads to list directories with
+    :param backend: whether to hash with a pool of 'thread's or 'process'es, see BoundedExecutor
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :param verify: None to trust the hash, 'bytes' to confirm duplicates by comparing them byte by byte,
+                   or the name of a hash algorithm to confirm them with, the result is keyed on that hash then
+    :param skip_reflinks: whether to collapse duplicates that already share their data on disk, see skip_shared_extents
+    :param hardlinks: if a dict is passed, it is filled with groups of paths that are hardlinks to the same inode,
+                      keyed on (device, inode), only the first of those paths is considered for duplicates
+    :param index: duplicate index to update with the results, if passed only the groups that changed since its
+                  last update are printed, prefixed with a column of + for added and - for removed groups
+    :param checkpoint: checkpoint to log progress to, and to resume from, see get_duplicate_map
+    :param per_device: whether to hash with a pool per device, see get_duplicate_map
+    :param device_workers: how many workers to hash with per device, keyed on st_dev, implies per_device
+    :param order: how to order files within a device, see DeviceExecutor
     :return: list of lists, where each sublist represents files that are duplicates of one another
     """
 
+    # the roots are used twice, by the search and by the index, so an iterator of them must only be consumed once
+    root = distinct_roots(root)
+
     # find all duplicate files that match the given criteria
     # file hash is kept, so we can extend the results later
-    duplicates = {
-        file_hash: file_list
-        for file_hash, file_list
-        in get_dir_hash_map(root=root,
-                            regard_patterns=regard_patterns,
-                            regard_patterns_concern_dirs=regard_patterns_concern_dirs,
-                            ignore_patterns=ignore_patterns,
-                            include_gitignore=include_gitignore,
-                            regex_flags=regex_flags,
-                            name='sha256',
-                            processes=processes).items()
-        if len(file_list) > 1
-    }
+    duplicates = get_duplicate_map(root=root,
+                                   regard_patterns=regard_patterns,
+                                   regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                   ignore_patterns=ignore_patterns,
+                                   include_gitignore=include_gitignore,
+                                   regex_flags=regex_flags,
+                                   name=name,
+                                   processes=processes,
+                                   cache=cache,
+                                   workers=workers,
+                                   backend=backend,
+                                   block_size=block_size,
+                                   use_mmap=use_mmap,
+                                   drop_page_cache=drop_page_cache,
+                                   verify=verify,
+                                   skip_reflinks=skip_reflinks,
+                                   hardlinks=hardlinks,
+                                   checkpoint=checkpoint,
+                                   per_device=per_device,
+                                   device_workers=device_workers,
+                                   order=order)
 
-    # output results as csv if requested
-    if print_results:
-        for file_list in duplicates.values():
-            # if " in name it's gotta be doubled, or invalid csv will be produced
-            double_quote, escaped_double_quote = '"', '""'
-            csv_row = ', '.join(
-                [f'"{str(file).replace(double_quote, escaped_double_quote)}"' for file in file_list])
+    if index is not None:
+        # groups are keyed on the verifying hash, if there is one
+        algorithm = resolve_algorithm(verify if verify not in (None, 'bytes') else name)
+        changes = index.update(root, algorithm, duplicates)
 
-            # issue a warning for all files with potential naming issues to stderr
-            naming_issues = [file for file in file_list if '"' in str(file)]
-            if naming_issues:
-                print('WARNING: double quote found in', *naming_issues, file=sys.stderr)
+        # output only what changed since the last run, removals first
+        if print_results:
+            print_csv(changes.removed.values(), prefix='-')
+            print_csv(changes.added.values(), prefix='+')
 
-            # output the hopefully valid csv
-            print(csv_row)
+    # output results as csv if requested
+    elif print_results:
+        print_csv(duplicates.values())
 
     return duplicates
 
 
+def print_csv(groups: Iterable[list[Path]], prefix: str | None = None):
+    """
+    Print groups of files as csv, one group per line.
+
+    :param groups: groups of files, e.g. duplicates or hardlinks of one another
+    :param prefix: value of an extra first column, e.g. to mark groups as added or removed
+    """
+    for file_list in groups:
+        # if " in name it's gotta be doubled, or invalid csv will be produced
+        double_quote, escaped_double_quote = '"', '""'
+        csv_row = ', '.join(
+            ([f'"{prefix}"'] if prefix is not None else []) +
+            [f'"{str(file).replace(double_quote, escaped_double_quote)}"' for file in file_list])
+
+        # issue a warning for all files with potential naming issues to stderr
+        naming_issues = [file for file in file_list if '"' in str(file)]
+        if naming_issues:
+            print('WARNING: double quote found in', *naming_issues, file=sys.stderr)
+
+        # output the hopefully valid csv
+        print(csv_row)
+
+
 def compute_duplicate_statistics(duplicates: list[list[Path]]) -> ():
     pass
 
 
-def destructive_shallow_merge_folders(dir_source, dir_target):
-    """Merge source into target. Move files, remove duplicates, rename on conflict. Do not recurse! Chokes on dirs"""
-
-    source_path = Path(dir_source).resolve()
-    target_path = Path(dir_target).resolve()
-
-    for file in source_path.iterdir():
-        target_file = target_path / file.name
-
-        if target_file.exists():
-            # compare file hashes with sum
-            # only take first two fields, third is path
-            source_sum = ''
-            target_sum = '$(sum @ (target_path / file.name)).split()[:2]'
-
-            if source_sum == target_sum:
-                print('removing duplicate', file, target_file)
-                # rm @ (file)
-            else:
-                i = 0
-                while True:
-                    candidate = Path(f'{target_file}_{i}')
-                    if not candidate.exists():
-                        target_file = candidate
-                        break
-                    i += 1
-                print('moving', file, 'to', target_file)
-                # mv @ (file) @ (target_file)
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    if args.similar is not None:
+        # chunking pulls in numpy, if it is installed, so it is only imported when it is needed
+        from util.chunking import find_similar_files
+        similar = find_similar_files(args.path,
+                                     regard_patterns=args.regard,
+                                     ignore_patterns=args.ignore,
+                                     include_gitignore=args.gitignore,
+                                     name=args.algorithm,
+                                     min_ratio=args.similar,
+                                     min_file_size=args.min_file_size,
+                                     sample=args.sample,
+                                     processes=args.processes,
+                                     workers=args.workers,
+                                     print_results=True)
+        sys.exit(1 if similar else 0)
+
+    cache = None if args.no_cache else HashCache(args.cache, max_entries=args.cache_size, rebuild=args.rebuild_cache)
+    index = DuplicateIndex(args.index, rebuild=args.rebuild_index) if args.index is not None else None
+    checkpoint = ScanCheckpoint(args.checkpoint, resume=args.resume) if args.checkpoint is not None else None
+    hardlinks = {}
+    try:
+        duplicates = find_duplicate_files(args.path,
+                                          regard_patterns=args.regard,
+                                          ignore_patterns=args.ignore,
+                                          include_gitignore=args.gitignore,
+                                          name=args.algorithm,
+                                          processes=args.processes,
+                                          print_results=not args.hardlinks,
+                                          cache=cache,
+                                          workers=args.workers,
+                                          backend=args.backend,
+                                          block_size=args.block_size,
+                                          use_mmap=args.mmap,
+                                          drop_page_cache=args.drop_page_cache,
+                                          verify=args.verify,
+                                          skip_reflinks=args.skip_reflinks,
+                                          hardlinks=hardlinks,
+                                          index=index,
+                                          checkpoint=checkpoint,
+                                          per_device=args.per_device,
+                                          device_workers=args.device_workers,
+                                          order=args.order)
+    finally:
+        # committed, if the run was interrupted, it can be resumed from here
+        if checkpoint is not None:
+            checkpoint.close()
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
+
+    # the run is complete, there is nothing left to resume
+    if checkpoint is not None:
+        checkpoint.path.unlink(missing_ok=True)
+
+    if args.hardlinks:
+        print_csv(hardlinks.values())
+        sys.exit(1 if hardlinks else 0)
+
+    sys.exit(1 if duplicates else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+import functools
+import itertools
+
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Iterable, Iterator
+
+from util import stats
+
+BACKENDS = ('thread', 'process')
+# how files are ordered within a device, see DeviceExecutor
+ORDERS = ('inode', 'offset', 'none')
+
+# items per task, processes pay for pickling every task, so they get bigger chunks
+DEFAULT_CHUNKSIZES = {'thread': 8, 'process': 64}
+# how many chunks per worker may be queued or running at once
+DEFAULT_CHUNKS_PER_WORKER = 4
+
+
+def map_chunk(func: Callable[[Any], Any], chunk: list) -> list:
+    """
+    Apply a function to every item of a chunk, this is what runs in the workers.
+
+    :param func: function to apply
+    :param chunk: items to apply it to
+    :return: list of the results
+    """
+    return [func(item) for item in chunk]
+
+
+class BoundedExecutor:
+    """
+    Maps functions over iterables with a pool of workers, handing out results as they complete.
+
+    Unlike Pool.map, the input is consumed lazily and only a bounded number of chunks is in flight at once,
+    so memory stays flat no matter how long the input is, and the input may still be produced while results come in.
+    With a single worker, everything runs in the calling process, without any pool.
+
+    Threads are the default backend, because hashlib releases the GIL while hashing, so they scale well for hashing
+    larger files without the cost of pickling. Processes may do better for lots of tiny files, where per file
+    interpreter overhead dominates, so the backend can be chosen per host.
+    """
+
+    def __init__(self,
+                 workers: int = 1,
+                 backend: str = 'thread',
+                 chunksize: int | None = None,
+                 max_in_flight: int | None = None):
+        """
+        :param workers: how many threads or processes to run work in
+        :param backend: either 'thread' or 'process'
+        :param chunksize: how many items make up one task, defaults depend on the backend
+        :param max_in_flight: how many items may be queued or running at once, defaults to a few chunks per worker
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Backend "{backend}" is not one of {", ".join(BACKENDS)}.')
+
+        self.workers = max(workers, 1)
+        self.backend = backend
+        self.chunksize = chunksize if chunksize is not None else DEFAULT_CHUNKSIZES[backend]
+        # at least one chunk must fit, or we could never submit anything
+        max_in_flight = max_in_flight if max_in_flight is not None \
+            else self.workers * self.chunksize * DEFAULT_CHUNKS_PER_WORKER
+        self.max_chunks_in_flight = max(max_in_flight // self.chunksize, 1)
+
+        # the pool is only started on first use, and never for a single worker
+        self._executor: Executor | None = None
+        # items handed in one by one, that don't make up a chunk yet, and chunks in flight, see submit
+        self._queued: list = []
+        self._queued_func: Callable[[Any], Any] | None = None
+        self._pending: set[Future] = set()
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.backend == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                # this pulls in multiprocessing, so it is only imported once processes are actually used
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def map_unordered(self, func: Callable[[Any], Any], items: Iterable) -> Iterator:
+        """
+        Lazily apply a function to all items, see the class docstring.
+        For the process backend, the function and items must be picklable.
+
+        :param func: function to apply
+        :param items: items to apply it to, consumed lazily in the calling thread
+        :return: iterator over the results, in order of completion
+        """
+
+        # no need for any pool, if there is only one worker
+        if self.workers == 1:
+            yield from map(func, items)
+            return
+
+        items = iter(items)
+        pending: set[Future] = set()
+        try:
+            while chunk := list(itertools.islice(items, self.chunksize)):
+                pending.add(self.executor.submit(map_chunk, func, chunk))
+
+                # block only if the window is full, otherwise just hand out what is done already
+                if len(pending) >= self.max_chunks_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                else:
+                    done = {future for future in pending if future.done()}
+                    pending -= done
+
+                for future in done:
+                    yield from future.result()
+
+            # the input is exhausted, hand out the rest as it completes
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            # if the consumer stopped early, queued work is pointless
+            for future in pending:
+                future.cancel()
+
+    def submit(self, func: Callable[[Any], Any], item) -> list:
+        """
+        Queue a single item, for callers that are handed items one by one instead of iterating over them,
+        like visitors of a walk, see map_unordered for iterables. Items are submitted in chunks,
+        and no more are in flight than map_unordered allows, so this blocks while the window is full.
+        The same function has to be passed until the queue is drained.
+
+        :param func: function to apply
+        :param item: item to apply it to
+        :return: list of the results that completed so far, the others are handed out by later calls and by drain
+        """
+
+        # no need for any pool, if there is only one worker
+        if self.workers == 1:
+            return [func(item)]
+
+        self._queued.append(item)
+        self._queued_func = func
+        if len(self._queued) < self.chunksize:
+            return []
+
+        self._pending.add(self.executor.submit(map_chunk, func, self._queued))
+        self._queued = []
+
+        # block only if the window is full, otherwise just hand out what is done already
+        if len(self._pending) >= self.max_chunks_in_flight:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+        else:
+            done = {future for future in self._pending if future.done()}
+            self._pending -= done
+
+        return [result for future in done for result in future.result()]
+
+    def drain(self) -> Iterator:
+        """
+        Submit what is left of the items queued with submit, and wait for all of them.
+
+        :return: iterator over the results that were not handed out by submit, in order of completion
+        """
+        if self._queued:
+            self._pending.add(self.executor.submit(map_chunk, self._queued_func, self._queued))
+            self._queued = []
+
+        while self._pending:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+    def shutdown(self):
+        """Shut down the pool, if one was started."""
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._queued.clear()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+
+def get_device(item) -> int | None:
+    """
+    Find the device an item of work reads from.
+
+    :param item: a file entry, or a group of those, like the (hash, entries) tuples groups of duplicates come in
+    :return: the st_dev of the file, of the last one for groups, None for anything else
+    """
+    if hasattr(item, 'dev'):
+        return item.dev
+    if isinstance(item, (tuple, list)) and item:
+        return get_device(item[-1])
+    return None
+
+
+def get_sort_key(item, order: str) -> tuple:
+    """
+    :param item: an item of work, see get_device
+    :param order: 'inode' or 'offset', see DeviceExecutor
+    :return: key that sorts the items of a device in the order they should be read
+    """
+    while not hasattr(item, 'dev') and isinstance(item, (tuple, list)) and item:
+        item = item[-1]
+    inode = getattr(item, 'inode', None) or 0
+
+    if order == 'offset' and hasattr(item, 'path'):
+        # extents pull in fcntl and struct, so they are only imported if files are ordered by them
+        from util.extents import get_first_extent
+        extent = get_first_extent(item.path)
+        # files without extents, e.g. empty ones, or all of them where the filesystem can't tell, go by inode
+        return (0, 0, inode) if extent is None else (1, extent[0], inode)
+
+    return 0, 0, inode
+
+
+class DeviceExecutor(BoundedExecutor):
+    """
+    Maps functions over file entries like BoundedExecutor, but schedules them per device.
+
+    With a single pool, workers pile onto whatever disk the next files happen to be on, so one spinning disk thrashes
+    between several reads, while the others sit idle. Here every device (st_dev) gets a pool of its own,
+    with its own number of workers, e.g. one for a spinning disk, where concurrent reads only mean seeks,
+    and many for an ssd. Devices are worked on at the same time, so the total throughput is that of all disks.
+
+    Within a device, files are handed out by inode, which mostly follows their placement on disk on ext4 and xfs,
+    or by the physical offset of their first extent, which costs an ioctl per file, but is exact where supported.
+    Ordering needs all items of a device, so unlike BoundedExecutor, the input is consumed up front.
+    Items without a device share a pool of the default size, as do items that are submitted one by one, see submit.
+    """
+
+    def __init__(self,
+                 workers: int = 1,
+                 backend: str = 'thread',
+                 chunksize: int | None = None,
+                 device_workers: dict[int, int] | None = None,
+                 order: str = 'inode'):
+        """
+        :param workers: how many threads or processes to run work in per device, unless given in device_workers
+        :param backend: either 'thread' or 'process'
+        :param chunksize: how many items make up one task, defaults depend on the backend
+        :param device_workers: how many workers to run per device, keyed on st_dev
+        :param order: 'inode' or 'offset' to order files within a device, 'none' to keep the input order
+        """
+        if order not in ORDERS:
+            raise ValueError(f'Order "{order}" is not one of {", ".join(ORDERS)}.')
+
+        super().__init__(workers=workers, backend=backend, chunksize=chunksize)
+        self.device_workers = device_workers or {}
+        self.order = order
+        # one executor per device, started once work for the device comes in
+        self.lanes: dict[int | None, BoundedExecutor] = {}
+
+    def get_lane(self, device: int | None) -> BoundedExecutor:
+        if device not in self.lanes:
+            self.lanes[device] = BoundedExecutor(workers=self.device_workers.get(device, self.workers),
+                                                 backend=self.backend, chunksize=self.chunksize)
+        return self.lanes[device]
+
+    def map_unordered(self, func: Callable[[Any], Any], items: Iterable) -> Iterator:
+        """
+        Apply a function to all items, see the class docstring.
+        For the process backend, the function and items must be picklable.
+
+        :param func: function to apply
+        :param items: items to apply it to, consumed up front in the calling thread
+        :return: iterator over the results, in order of completion
+        """
+        queues: dict[int | None, list] = {}
+        for item in items:
+            queues.setdefault(get_device(item), []).append(item)
+
+        if self.order != 'none':
+            for queue in queues.values():
+                queue.sort(key=functools.partial(get_sort_key, order=self.order))
+        stats.count('executor:devices', len(queues))
+
+        # a single device with a single worker needs no pool, like with BoundedExecutor
+        if len(queues) == 1 and self.get_lane(next(iter(queues))).workers == 1:
+            yield from map(func, next(iter(queues.values())))
+            return
+
+        # chunks are submitted in order, so the workers of a device move across it in one direction
+        chunks = {device: iter([queue[i:i + self.chunksize] for i in range(0, len(queue), self.chunksize)])
+                  for device, queue in queues.items()}
+        in_flight = dict.fromkeys(queues, 0)
+        pending: dict[Future, int | None] = {}
+
+        def fill(device: int | None):
+            lane = self.get_lane(device)
+            while in_flight[device] < lane.max_chunks_in_flight and (chunk := next(chunks[device], None)):
+                pending[lane.executor.submit(map_chunk, func, chunk)] = device
+                in_flight[device] += 1
+
+        try:
+            for device in queues:
+                fill(device)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                # refill first, so the devices don't idle while the consumer works
+                for future in done:
+                    device = pending.pop(future)
+                    in_flight[device] -= 1
+                    fill(device)
+                for future in done:
+                    yield from future.result()
+        finally:
+            # if the consumer stopped early, queued work is pointless
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        """Shut down the pools of all devices."""
+        for lane in self.lanes.values():
+            lane.shutdown()
+        self.lanes.clear()
+
+
+def create_executor(workers: int = 1,
+                    backend: str = 'thread',
+                    per_device: bool = False,
+                    device_workers: dict[int, int] | None = None,
+                    order: str = 'inode') -> BoundedExecutor:
+    """
+    Create the executor files are hashed with.
+
+    :param workers: how many threads or processes to run work in, per device if per_device is set
+    :param backend: either 'thread' or 'process'
+    :param per_device: whether to schedule work per device, see DeviceExecutor
+    :param device_workers: how many workers to run per device, keyed on st_dev, implies per_device
+    :param order: how to order files within a device, see DeviceExecutor
+    :return: a DeviceExecutor if work is scheduled per device, a BoundedExecutor otherwise
+    """
+    if per_device or device_workers:
+        return DeviceExecutor(workers=workers, backend=backend, device_workers=device_workers, order=order)
+    return BoundedExecutor(workers=workers, backend=backend)
@@ -0,0 +1,78 @@
+import errno
+import os
+import struct
+import sys
+
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # not available on windows
+    fcntl = None
+
+# _IOWR('f', 11, struct fiemap), see linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_FLAG_SYNC = 0x0001
+FIEMAP_EXTENT_SHARED = 0x2000
+# _IOW(0x94, 9, int), see linux/fs.h
+FICLONE = 0x40049409
+
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+FIEMAP_EXTENT = struct.Struct('=QQQ2QI3I')
+
+
+def extents_supported() -> bool:
+    """
+    Check whether physical extents of files can be queried on this platform, so far that is only Linux.
+
+    :return: whether get_first_extent can return anything but None
+    """
+    return fcntl is not None and sys.platform.startswith('linux')
+
+
+def get_first_extent(file: str | bytes | os.PathLike | Path) -> tuple[int, bool] | None:
+    """
+    Look up where the data of a file starts on disk, with the FIEMAP ioctl.
+    Reflinked copies share their extents with the original, so they start at the same physical offset.
+
+    :param file: path to the file
+    :return: tuple of the physical offset of the first extent and whether it is flagged as shared,
+             None if the file is empty, or the platform or filesystem does not support the query
+    """
+    if not extents_supported():
+        return None
+
+    # ask for a single extent over the whole file
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+
+    try:
+        with open(file, 'rb') as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request, True)
+    except OSError:
+        return None
+
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if mapped_extents == 0:
+        return None
+
+    _, physical, _, _, _, flags, *_ = FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)
+    return physical, bool(flags & FIEMAP_EXTENT_SHARED)
+
+
+def clone_file(source: str | bytes | os.PathLike | Path, target: str | bytes | os.PathLike | Path):
+    """
+    Create a reflinked copy of a file with the FICLONE ioctl, that shares all of its extents with the original.
+    Only works within a filesystem that supports it, like btrfs, xfs or bcachefs.
+
+    :param source: path to the file to clone
+    :param target: path to create the clone at, replaced if it exists
+    :raises OSError: if the platform or filesystem does not support reflinks
+    """
+    if not extents_supported():
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are only supported on linux.', str(target))
+
+    with open(source, 'rb') as s, open(target, 'wb') as t:
+        fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
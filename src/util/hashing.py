@@ -2,51 +2,196 @@ import functools
 import os
 import re
 import hashlib
+import mmap
+import threading
 
+from concurrent.futures import CancelledError
 from pathlib import Path
-from util.traversal import traverse_file_tree
-from multiprocessing import Pool
-from collections import defaultdict
+from util import stats
+from util.algorithms import new_hash, resolve_algorithm
+from util.cache import HashCache
+from util.checkpoint import ScanCheckpoint, iter_checkpointed_entries
+from util.executor import BoundedExecutor, create_executor
+from util.store import HashStore
+from util.traversal import FileEntry, Visitor, iter_entries_under_roots
+from collections import deque
+from typing import Callable, Iterable, Iterator
 
+# how many bytes to read from the start and the end of a file when computing partial hashes
+PARTIAL_HASH_SIZE = 4096
+# how many bytes to read at once when hashing complete files, if hashlib.file_digest is not used
+DEFAULT_BLOCK_SIZE = 256 * 1024
+# files of at least this size get memory mapped if requested, for smaller ones setting up the mapping doesn't pay off
+MMAP_THRESHOLD = 64 * 1024 * 1024
 
-def get_file_hash(file: str | bytes | os.PathLike | Path, name: str = 'sha256') -> str:
+# read buffers are reused per thread, see get_read_buffer
+_read_buffers = threading.local()
+
+
+def get_read_buffer(block_size: int) -> memoryview:
+    """
+    Get a buffer to read file blocks into, that is reused across calls in the same thread.
+
+    :param block_size: size of the buffer
+    :return: memoryview of the buffer, so slicing it does not copy
+    """
+    buffers = _read_buffers.__dict__.setdefault('buffers', {})
+    if block_size not in buffers:
+        buffers[block_size] = memoryview(bytearray(block_size))
+    return buffers[block_size]
+
+
+def advise(fd: int, advice: str):
+    """
+    Hint the kernel about how a file is going to be accessed, where that is supported.
+
+    :param fd: file descriptor of the whole file
+    :param advice: name of the advice without prefix, e.g. 'SEQUENTIAL' for os.POSIX_FADV_SEQUENTIAL
+    """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, getattr(os, f'POSIX_FADV_{advice}'))
+
+
+def get_entry_hash(entry: FileEntry,
+                   name: str = 'sha256',
+                   block_size: int | None = None,
+                   use_mmap: bool = False,
+                   drop_page_cache: bool = False,
+                   cancelled: threading.Event | None = None) -> str:
+    """
+    Compute the hash of a file, that is known to be a regular file from a walk.
+    Unlike get_file_hash, this does not stat the file again.
+
+    By default hashlib.file_digest is used where available (>= 3.11), otherwise the file is read in blocks into a
+    reused buffer, so no new bytes object is allocated per block. Passing a block size always uses the latter.
+    Files of at least MMAP_THRESHOLD bytes can be memory mapped instead, and hashed in one go.
+    Passing an event to cancel with also reads in blocks, and checks the event between them.
+
+    :param entry: entry of the file, as produced by iter_file_entries
+    :param name: name of the hash algorithm
+    :param block_size: how many bytes to read at once, None to let hashlib decide if possible
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop the file from the page cache after hashing,
+                            so hashing a huge tree does not evict everything else
+    :param cancelled: event that stops hashing once it is set, so huge files don't hold up a cancelled run
+    :return: string corresponding to the hex digest of the file hash
+    :raises CancelledError: if the event was set before the file was hashed completely
+    """
+
+    # raises if the requested algorithm is not available
+    hash_object = new_hash(name)
+    # compute the hash, unbuffered, because we read in large blocks anyway
+    with open(entry.path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        # we read front to back, so the kernel may read ahead more aggressively
+        advise(fd, 'SEQUENTIAL')
+
+        # empty files can't be mapped
+        if use_mmap and entry.size and entry.size >= MMAP_THRESHOLD:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+                hash_object.update(mapped)
+        elif block_size is None and cancelled is None and hasattr(hashlib, 'file_digest'):
+            # file_digest is only available in >= 3.11, it reads into a reused buffer without holding the GIL
+            hash_object = hashlib.file_digest(f, lambda: hash_object)
+        else:
+            buffer = get_read_buffer(block_size or DEFAULT_BLOCK_SIZE)
+            while size := f.readinto(buffer):
+                if cancelled is not None and cancelled.is_set():
+                    raise CancelledError(f'Hashing "{entry.path}" was cancelled.')
+                hash_object.update(buffer[:size])
+
+        if drop_page_cache:
+            advise(fd, 'DONTNEED')
+
+        file_hash = hash_object.hexdigest()
+
+    stats.count('hashing:files')
+    stats.count('hashing:bytes', entry.size or 0)
+
+    # sanity check the file hash and abort on mismatches -> better safe than sorry
+    # should be unnecessary here, only interesting when using xonsh shenanigans
+    assert len(file_hash) == 2 * hash_object.digest_size, 'Computed file hash failed sanity check, aborting.'
+
+    return file_hash
+
+
+def get_file_hash(file: str | bytes | os.PathLike | Path,
+                  name: str = 'sha256',
+                  block_size: int | None = None,
+                  use_mmap: bool = False,
+                  drop_page_cache: bool = False) -> str:
     """
     Compute the hash of a file.
 
     :param file: path to the file
     :param name: name of the hash algorithm
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop the file from the page cache after hashing
     :return: string corresponding to the hex digest of the file hash
     """
 
-    # make sure path is properly resolved Path object
-    path = Path(file).resolve()
+    # a single stat tells us whether this is a file, symlinks are followed
+    entry = FileEntry.from_path(file)
 
-    # ensure the requested algorithm is available
-    if name not in hashlib.algorithms_available:
-        raise ValueError(f'Hash algorithm "{name}" is not available on this system.')
     # guard against non files
-    elif not path.is_file():
+    if not entry.is_file:
         raise ValueError(f'Can only hash files. "{file}" is not a file.')
-    # hashing algorithm is available and a file was passed
-    else:
-        hash_object = hashlib.new(name)
-        # compute the hash
-        with path.open('rb') as f:
-            # file_digest is only available in >= 3.11
-            # file_hash = hashlib.file_digest(f, name).hexdigest()
 
-            # read the file in 64 kib chunks and update the hash
-            CHUNK_SIZE = 65536
-            while chunk := f.read(CHUNK_SIZE):
-                hash_object.update(chunk)
+    return get_entry_hash(entry, name=name, block_size=block_size, use_mmap=use_mmap, drop_page_cache=drop_page_cache)
 
-            file_hash = hash_object.hexdigest()
 
-        # sanity check the file hash and abort on mismatches -> better safe than sorry
-        # should be unnecessary here, only interesting when using xonsh shenanigans
-        assert len(file_hash) == 2 * hash_object.digest_size, 'Computed file hash failed sanity check, aborting.'
+def get_partial_entry_hash(entry: FileEntry, name: str = 'sha256', size: int = PARTIAL_HASH_SIZE) -> str:
+    """
+    Compute a cheap hash of a file, that only takes its first and last few bytes into account.
+    Files that are no larger than twice the partial size are read completely,
+    so in that case the result is identical to the one of get_entry_hash.
+
+    :param entry: entry of the file, as produced by iter_file_entries
+    :param name: name of the hash algorithm
+    :param size: how many bytes to read from the start and from the end of the file
+    :return: string corresponding to the hex digest of the partial file hash
+    """
+
+    # raises if the requested algorithm is not available
+    hash_object = new_hash(name)
+
+    # small files are cheaper to hash completely, and doing so lets callers skip the full hash later on
+    if entry.size <= 2 * size:
+        return get_entry_hash(entry, name=name)
+
+    with open(entry.path, 'rb') as f:
+        hash_object.update(f.read(size))
+        # the file may have shrunk since the walk, so the end is taken from the open file, not from the entry
+        f.seek(max(0, os.fstat(f.fileno()).st_size - size))
+        hash_object.update(f.read(size))
+
+    stats.count('hashing:partial_files')
+    stats.count('hashing:bytes', 2 * size)
+
+    return hash_object.hexdigest()
 
-    return file_hash
+
+def get_partial_file_hash(file: str | bytes | os.PathLike | Path,
+                          name: str = 'sha256',
+                          size: int = PARTIAL_HASH_SIZE) -> str:
+    """
+    Compute a cheap hash of a file, that only takes its first and last few bytes into account,
+    see get_partial_entry_hash.
+
+    :param file: path to the file
+    :param name: name of the hash algorithm
+    :param size: how many bytes to read from the start and from the end of the file
+    :return: string corresponding to the hex digest of the partial file hash
+    """
+
+    entry = FileEntry.from_path(file)
+
+    # guard against non files
+    if not entry.is_file:
+        raise ValueError(f'Can only hash files. "{file}" is not a file.')
+
+    return get_partial_entry_hash(entry, name=name, size=size)
 
 
 def get_hash_tuple(file: str | bytes | os.PathLike | Path,
@@ -62,47 +207,301 @@ def get_hash_tuple(file: str | bytes | os.PathLike | Path,
     return file, get_file_hash(file, name=name)
 
 
-def get_dir_hash_map(root: Path,
+def get_entry_hash_tuple(entry: FileEntry,
+                         name: str = 'sha256',
+                         block_size: int | None = None,
+                         use_mmap: bool = False,
+                         drop_page_cache: bool = False) -> tuple[FileEntry, str]:
+    """
+    Like get_hash_tuple, but uses get_entry_hash.
+
+    :param entry: entry of the file, as produced by iter_file_entries
+    :param name: name of the hash algorithm
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :return: tuple with first element being the hashed entry and second the file hash
+    """
+    return entry, get_entry_hash(entry, name=name, block_size=block_size,
+                                 use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+
+
+def get_partial_entry_hash_tuple(entry: FileEntry,
+                                 name: str = 'sha256',
+                                 size: int = PARTIAL_HASH_SIZE) -> tuple[FileEntry, str]:
+    """
+    Like get_hash_tuple, but uses get_partial_entry_hash.
+
+    :param entry: entry of the file, as produced by iter_file_entries
+    :param name: name of the hash algorithm
+    :param size: how many bytes to read from the start and from the end of the file
+    :return: tuple with first element being the hashed entry and second the partial file hash
+    """
+    return entry, get_partial_entry_hash(entry, name=name, size=size)
+
+
+def iter_hashes(entries: Iterable[FileEntry],
+                work: Callable[[FileEntry], tuple[FileEntry, str]],
+                executor: BoundedExecutor,
+                cache: HashCache | None = None,
+                algorithm: str | None = None,
+                batch_size: int = 256) -> Iterator[tuple[FileEntry, str]]:
+    """
+    Lazily compute hashes for files with an executor, consulting a cache first if one is passed.
+    Entries are consumed lazily and hashed while the iterable is still being consumed,
+    so hashing can start while e.g. a directory walk is still running.
+    Only files without a valid cache entry are hashed, their results are added to the cache,
+    unless work returns None as the hash, e.g. for a file that could not be read.
+
+    :param entries: entries of the files, with stat info if a cache is passed
+    :param work: function taking an entry and returning a tuple of the entry and its hash, or None
+    :param executor: executor to compute the hashes with
+    :param cache: hash cache to consult, None to bypass caching
+    :param algorithm: key of the hash in the cache, must identify work, e.g. the hash algorithm name
+    :param batch_size: how many computed hashes to add to the cache at once
+    :return: iterator over tuples of entries and their hashes, in no particular order
+    """
+
+    if cache is None:
+        yield from executor.map_unordered(work, entries)
+        return
+
+    # cache lookups happen in this thread, while the executor pulls the misses from the generator
+    hits: deque[tuple[FileEntry, str]] = deque()
+
+    def misses() -> Iterator[FileEntry]:
+        for entry in entries:
+            # the stat info was taken before hashing, so changes while hashing invalidate the entry next run
+            cached_hash = cache.get(entry, algorithm)
+            if cached_hash is None:
+                stats.count(f'cache:misses:{algorithm}')
+                yield entry
+            else:
+                stats.count(f'cache:hits:{algorithm}')
+                hits.append((entry, cached_hash))
+
+    computed = []
+    for entry, file_hash in executor.map_unordered(work, misses()):
+        if file_hash is not None:
+            computed.append((entry, algorithm, file_hash))
+        if len(computed) >= batch_size:
+            cache.put_many(computed)
+            computed.clear()
+
+        yield entry, file_hash
+        while hits:
+            yield hits.popleft()
+
+    cache.put_many(computed)
+    yield from hits
+
+
+def compute_hashes(entries: Iterable[FileEntry],
+                   work: Callable[[FileEntry], tuple[FileEntry, str]],
+                   executor: BoundedExecutor,
+                   cache: HashCache | None = None,
+                   algorithm: str | None = None) -> dict[FileEntry, str]:
+    """
+    Compute hashes for files with an executor, consulting a cache first if one is passed, see iter_hashes.
+
+    :param entries: entries of the files, with stat info if a cache is passed
+    :param work: function taking an entry and returning a tuple of the entry and its hash
+    :param executor: executor to compute the hashes with
+    :param cache: hash cache to consult, None to bypass caching
+    :param algorithm: key of the hash in the cache, must identify work, e.g. the hash algorithm name
+    :return: map of entries to their hashes
+    """
+    return dict(iter_hashes(entries, work, executor, cache=cache, algorithm=algorithm))
+
+
+def get_dir_hash_map(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
                      regard_patterns: list[str] = None,
                      regard_patterns_concern_dirs: bool = False,
                      ignore_patterns: list[str] = None,
                      include_gitignore: bool = False,
                      regex_flags: list[re.RegexFlag] = None,
                      name: str = 'sha256',
-                     processes: int = 1) -> dict[str, list[Path]]:
+                     processes: int = 1,
+                     cache: HashCache | None = None,
+                     workers: int = 1,
+                     backend: str = 'thread',
+                     block_size: int | None = None,
+                     use_mmap: bool = False,
+                     drop_page_cache: bool = False,
+                     checkpoint: ScanCheckpoint | None = None,
+                     per_device: bool = False,
+                     device_workers: dict[int, int] | None = None,
+                     order: str = 'inode') -> HashStore:
     """
     Compute a map of file hashes to files that produced those hashes under a directory.
     Parameters largely correspond to the ones for traverse_file_tree and get_file_hash.
+    Symlinks are not followed, only regular files are hashed.
 
-    :param root: directory under which to search
+    :param root: directory under which to search, or several, whose files end up in the same map
     :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
     :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
     :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
     :param include_gitignore: whether to include .gitignore files in the ignore_patterns
     :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
-    :param processes: how many processes to fork for file hashing
-    :param name: name of the hash algorithm
-    :return: list of lists, where each sublist represents files that are duplicates of one another
+    :param processes: how many workers to hash files with, a single one hashes in this process
+    :param name: name of the hash algorithm, see available_algorithms
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param workers: how many threads to list directories with
+    :param backend: whether to hash with a pool of 'thread's or 'process'es, see BoundedExecutor
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :param checkpoint: checkpoint to log the walk and the hashes to, and to resume from, see get_duplicate_map
+    :param per_device: whether to hash with a pool per device, so several disks are read at once, see DeviceExecutor,
+                       processes is the number of workers per device then
+    :param device_workers: how many workers to hash with per device, keyed on st_dev, implies per_device
+    :param order: how to order files within a device, 'inode', 'offset' or 'none', see DeviceExecutor
+    :return: compact map of file hashes to the files that produced them, see HashStore
     """
 
-    # find all file paths that match the criteria
-    files = [path for path in traverse_file_tree(root=root,
-                                                 regard_patterns=regard_patterns,
-                                                 regard_patterns_concern_dirs=regard_patterns_concern_dirs,
-                                                 ignore_patterns=ignore_patterns,
-                                                 include_gitignore=include_gitignore,
-                                                 regex_flags=regex_flags)
-             if path.is_file()]
+    # the cache must not mix up hashes, if the alias resolves differently on the next run
+    name = resolve_algorithm(name)
+
+    # lazily find all file paths that match the criteria, symlinks are skipped, they don't take up space
+    # the entries carry the stat info, so nothing downstream has to stat the files again
+    walk_options = dict(regard_patterns=regard_patterns,
+                        regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                        ignore_patterns=ignore_patterns,
+                        include_gitignore=include_gitignore,
+                        regex_flags=regex_flags,
+                        workers=workers)
+    if checkpoint is None:
+        walk = iter_entries_under_roots(root, **walk_options)
+    else:
+        walk = iter_checkpointed_entries(root, checkpoint, **walk_options)
+        # the checkpoint falls back on the cache, and passes computed hashes on to it
+        checkpoint.cache, cache = cache, checkpoint
+    entries = (entry for entry in walk if entry.is_file)
+
+    # compute the hashes in parallel, while the walk is still running
+    with stats.timed('hash_map'):
+        return get_hash_map(entries, name=name, processes=processes, cache=cache, backend=backend,
+                            block_size=block_size, use_mmap=use_mmap, drop_page_cache=drop_page_cache,
+                            per_device=per_device, device_workers=device_workers, order=order)
 
-    # compute the hashes in parallel
-    with Pool(processes=processes) as pool:
-        # partially apply the hash name
-        work = functools.partial(get_hash_tuple, name=name)
-        file_and_hash_pairs = pool.map(work, files)
 
-    # register the files to their hashes
-    register: dict[str, list[Path]] = defaultdict(list)
-    for file, file_hash in file_and_hash_pairs:
-        register[file_hash].append(file)
+def get_hash_map(entries: Iterable[FileEntry],
+                 name: str = 'sha256',
+                 processes: int = 1,
+                 cache: HashCache | None = None,
+                 backend: str = 'thread',
+                 block_size: int | None = None,
+                 use_mmap: bool = False,
+                 drop_page_cache: bool = False,
+                 per_device: bool = False,
+                 device_workers: dict[int, int] | None = None,
+                 order: str = 'inode') -> HashStore:
+    """
+    Compute a map of file hashes to files that produced those hashes, see get_dir_hash_map.
+
+    :param entries: entries of regular files with stat info, consumed lazily
+    :param name: name of the hash algorithm, already resolved, see resolve_algorithm
+    :param processes: how many workers to hash files with, a single one hashes in this process
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :param backend: whether to hash with a pool of 'thread's or 'process'es, see BoundedExecutor
+    :param block_size: how many bytes to read at once, see get_entry_hash
+    :param use_mmap: whether to memory map large files instead of reading them
+    :param drop_page_cache: whether to advise the kernel to drop files from the page cache after hashing them
+    :param per_device: whether to hash with a pool per device, see get_dir_hash_map
+    :param device_workers: how many workers to hash with per device, keyed on st_dev, implies per_device
+    :param order: how to order files within a device, see DeviceExecutor
+    :return: compact map of file hashes to the files that produced them, see HashStore
+    """
+    register = HashStore()
+    with create_executor(workers=processes, backend=backend, per_device=per_device,
+                         device_workers=device_workers, order=order) as executor:
+        # partially apply the hash name and io options
+        work = functools.partial(get_entry_hash_tuple, name=name, block_size=block_size,
+                                 use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+
+        # register the files to their hashes
+        for entry, file_hash in iter_hashes(entries, work, executor, cache=cache, algorithm=name):
+            register.add(entry.path, file_hash)
 
     return register
+
+
+class HashVisitor(Visitor):
+    """
+    Hashes regular files while a walk is still going on, see visit_file_tree and get_dir_hash_map.
+    Files are handed to a bounded pool of workers as they are visited, so memory does not grow with the tree,
+    only the results are collected until it is done. Symlinks are not followed, only regular files are hashed.
+    """
+
+    needs_stat = True
+
+    def __init__(self,
+                 name: str = 'sha256',
+                 processes: int = 1,
+                 cache: HashCache | None = None,
+                 backend: str = 'thread',
+                 block_size: int | None = None,
+                 use_mmap: bool = False,
+                 drop_page_cache: bool = False,
+                 batch_size: int = 256):
+        """
+        Parameters correspond to the ones for get_dir_hash_map.
+
+        :param batch_size: how many computed hashes to add to the cache at once, see iter_hashes
+        """
+        # the cache must not mix up hashes, if the alias resolves differently on the next run
+        self.name = resolve_algorithm(name)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.work = functools.partial(get_entry_hash_tuple, name=self.name, block_size=block_size,
+                                      use_mmap=use_mmap, drop_page_cache=drop_page_cache)
+        self.executor = BoundedExecutor(workers=processes, backend=backend)
+
+        self.register = HashStore()
+        # hashes that were computed, but not added to the cache yet
+        self.computed: list[tuple[FileEntry, str, str]] = []
+
+    def visit(self, entry: FileEntry):
+        if not entry.is_file:
+            return
+
+        # cache lookups happen in the thread of the walk, like they do in iter_hashes
+        if self.cache is not None:
+            cached_hash = self.cache.get(entry, self.name)
+            if cached_hash is not None:
+                stats.count(f'cache:hits:{self.name}')
+                self.register.add(entry.path, cached_hash)
+                return
+            stats.count(f'cache:misses:{self.name}')
+
+        self.add(self.executor.submit(self.work, entry))
+
+    def add(self, hashes: Iterable[tuple[FileEntry, str]]):
+        """
+        Register computed hashes, and pass them on to the cache in batches.
+
+        :param hashes: tuples of entries and their hashes
+        """
+        for entry, file_hash in hashes:
+            self.register.add(entry.path, file_hash)
+            if self.cache is not None:
+                self.computed.append((entry, self.name, file_hash))
+
+        if self.cache is not None and len(self.computed) >= self.batch_size:
+            self.cache.put_many(self.computed)
+            self.computed.clear()
+
+    def result(self) -> HashStore:
+        """
+        :return: map of file hashes to the files that produced them
+        """
+        try:
+            self.add(self.executor.drain())
+        finally:
+            self.executor.shutdown()
+
+        if self.cache is not None:
+            self.cache.put_many(self.computed)
+            self.computed.clear()
+
+        return self.register
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from util.traversal import distinct_roots
+
+# where the index lives if no path is given, next to the hash cache
+DEFAULT_INDEX_PATH = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'fileutils', 'duplicates.sqlite')
+
+
+class IndexChanges(NamedTuple):
+    """Duplicate groups that appeared or disappeared since the last update of a DuplicateIndex, keyed on hash."""
+    added: dict[str, list[Path]]
+    removed: dict[str, list[Path]]
+
+
+class DuplicateIndex:
+    """
+    Persistent index of the duplicates found under directories, backed by SQLite.
+
+    The groups found by a run are stored per root and algorithm, so the next run can report only what changed.
+    A group whose members changed shows up as removed with its old members, and as added with its new ones.
+    Hashes of unchanged files come from the HashCache, so together with one, a run only hashes what changed.
+
+    Paths are stored as bytes, so names that are not valid unicode survive the round trip.
+    """
+
+    def __init__(self, path: str | bytes | os.PathLike | Path = DEFAULT_INDEX_PATH, rebuild: bool = False):
+        """
+        :param path: where the index database is stored, created if it does not exist
+        :param rebuild: whether to drop all indexed groups and start over
+        """
+        self.path = Path(path)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+
+        if rebuild:
+            self.connection.execute('DROP TABLE IF EXISTS duplicates')
+
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS duplicates (
+                root BLOB NOT NULL,
+                algorithm TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                path BLOB NOT NULL,
+                PRIMARY KEY (root, algorithm, hash, path)
+            )
+        ''')
+        self.connection.commit()
+
+    @staticmethod
+    def _root_key(root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path]) -> bytes:
+        # searches of several directories are keyed on all of them, paths can't contain null bytes
+        return b'\0'.join(os.fsencode(root) for root in distinct_roots(root))
+
+    def get(self,
+            root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+            algorithm: str) -> dict[str, list[Path]]:
+        """
+        Look up the duplicates found under a directory by the last update.
+
+        :param root: directory that was searched, or several
+        :param algorithm: name of the hash algorithm the groups are keyed on
+        :return: map of file hashes to lists of files that are duplicates of one another, empty if never indexed
+        """
+        duplicates: dict[str, list[Path]] = defaultdict(list)
+        for file_hash, path in self.connection.execute('SELECT hash, path FROM duplicates '
+                                                       'WHERE root = ? AND algorithm = ? ORDER BY hash, path',
+                                                       (self._root_key(root), algorithm)):
+            duplicates[file_hash].append(Path(os.fsdecode(path)))
+
+        return dict(duplicates)
+
+    def update(self,
+               root: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+               algorithm: str,
+               duplicates: dict[str, list[Path]]) -> IndexChanges:
+        """
+        Replace the duplicates indexed for a directory, and report how they changed.
+        Only groups that differ are touched in the database, so an update costs about as much as what changed.
+
+        :param root: directory that was searched, or several
+        :param algorithm: name of the hash algorithm the groups are keyed on
+        :param duplicates: map of file hashes to lists of files that are duplicates of one another,
+                           e.g. from get_duplicate_map
+        :return: groups that were added and removed since the last update
+        """
+        root_key = self._root_key(root)
+        previous = self.get(root, algorithm)
+
+        # compare members as sets, the order of files within a group does not matter
+        current = {file_hash: set(files) for file_hash, files in duplicates.items()}
+        removed = {file_hash: files for file_hash, files in previous.items()
+                   if current.get(file_hash) != set(files)}
+        added = {file_hash: list(files) for file_hash, files in duplicates.items()
+                 if set(previous.get(file_hash, ())) != current[file_hash]}
+
+        with self.connection:
+            self.connection.executemany('DELETE FROM duplicates WHERE root = ? AND algorithm = ? AND hash = ?',
+                                        [(root_key, algorithm, file_hash) for file_hash in removed])
+            self.connection.executemany('INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?, ?)',
+                                        [(root_key, algorithm, file_hash, os.fsencode(file))
+                                         for file_hash, files in added.items() for file in files])
+
+        return IndexChanges(added=added, removed=removed)
+
+    def clear(self):
+        """Drop all indexed groups."""
+        self.connection.execute('DELETE FROM duplicates')
+        self.connection.commit()
+
+    def close(self):
+        """Close the underlying database."""
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import argparse
+import errno
+import functools
+import os
+import shutil
+import stat
+import sys
+
+from pathlib import Path
+from typing import NamedTuple
+
+from util.algorithms import available_algorithms, resolve_algorithm
+from util.cache import HashCache, DEFAULT_CACHE_PATH, DEFAULT_MAX_ENTRIES
+from util.duplicates import print_csv
+from util.executor import BoundedExecutor
+from util.hashing import compute_hashes, get_entry_hash_tuple
+from util.traversal import FileEntry
+
+# actions a merge is made up of
+MKDIR, MOVE, REMOVE = 'mkdir', 'move', 'remove'
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Merges a directory into another one. Files are moved over, '
+                                                 'duplicates of files that already exist are removed, '
+                                                 'and files that conflict with existing ones are renamed. '
+                                                 'Prints the operations as csv, one per line')
+
+    parser.add_argument('source', type=Path, help='the directory to merge, it is removed once empty')
+    parser.add_argument('target', type=Path, help='the directory to merge into')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only print what would be done')
+    parser.add_argument('-a', '--algorithm', choices=available_algorithms(), default='sha256', metavar='ALGORITHM',
+                        help='hash algorithm to compare conflicting files with, defaults to sha256')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                        help='how many threads to hash and move files with, defaults to the cpu count')
+
+    cache_group = parser.add_argument_group('hash cache')
+    cache_group.add_argument('--cache', type=Path, default=DEFAULT_CACHE_PATH,
+                             help=f'where to keep the hash cache, defaults to {DEFAULT_CACHE_PATH}')
+    cache_group.add_argument('--cache-size', type=int, default=DEFAULT_MAX_ENTRIES,
+                             help='how many hashes to keep in the cache at most')
+    cache_group.add_argument('--no-cache', action='store_true', help='bypass the hash cache')
+
+    return parser.parse_args(args)
+
+
+class MergeOperation(NamedTuple):
+    """
+    A single step of a merge.
+
+    mkdir creates target, as the counterpart of the directory source.
+    move renames source to target, which may be a directory, moving everything below it as well.
+    remove deletes source, because it is a duplicate of target.
+    """
+    action: str
+    source: Path
+    target: Path
+
+
+def get_free_path(path: Path, claimed: set[Path]) -> Path:
+    """
+    Find a path to rename a conflicting file to, by appending a number to its name.
+
+    :param path: path that is already taken
+    :param claimed: paths that are planned to be taken, but might not exist yet
+    :return: the first path with a numbered suffix that is neither claimed nor exists
+    """
+    i = 0
+    while True:
+        candidate = path.with_name(f'{path.name}_{i}')
+        if candidate not in claimed and not os.path.lexists(candidate):
+            return candidate
+        i += 1
+
+
+def plan_merge(source: Path,
+               target: Path,
+               executor: BoundedExecutor,
+               name: str = 'sha256',
+               cache: HashCache | None = None) -> list[MergeOperation]:
+    """
+    Plan the merge of a directory into another one, without touching either of them.
+
+    Entries that don't exist in the target are moved there, whole directories at once where possible,
+    across devices directories are recreated and their content is moved over file by file.
+    Directories that exist on both sides are merged recursively.
+    Conflicting files are compared by size first, and hashed only if their sizes match,
+    identical ones are removed from the source, others are moved next to their counterpart under a numbered name.
+
+    :param source: directory to merge
+    :param target: directory to merge into
+    :param executor: executor to hash conflicting files with
+    :param name: name of the hash algorithm to compare files with
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :return: list of operations, directories are created before anything is moved into them
+    """
+    operations: list[MergeOperation] = []
+    # files that exist on both sides with the same size, these need to be hashed
+    conflicts: list[tuple[FileEntry, FileEntry]] = []
+    # targets of planned operations, so no two operations pick the same one
+    claimed: set[Path] = set()
+
+    # every directory comes with the device of its target, subdirectories of the target may be mount points
+    stack = [(source, target, target.stat().st_dev)]
+    while stack:
+        source_dir, target_dir, target_dev = stack.pop()
+
+        with os.scandir(source_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                source_path, target_path = Path(dir_entry.path), target_dir / dir_entry.name
+                source_stat = dir_entry.stat(follow_symlinks=False)
+                try:
+                    target_stat = os.lstat(target_path)
+                except FileNotFoundError:
+                    target_stat = None
+
+                if target_stat is None and target_path not in claimed:
+                    claimed.add(target_path)
+                    # directories can only be renamed within a device, otherwise they have to be copied file by file
+                    if stat.S_ISDIR(source_stat.st_mode) and source_stat.st_dev != target_dev:
+                        operations.append(MergeOperation(MKDIR, source_path, target_path))
+                        # created within the target directory, so on its device
+                        stack.append((source_path, target_path, target_dev))
+                    else:
+                        operations.append(MergeOperation(MOVE, source_path, target_path))
+
+                elif target_stat is not None and stat.S_ISDIR(source_stat.st_mode) and stat.S_ISDIR(target_stat.st_mode):
+                    stack.append((source_path, target_path, target_stat.st_dev))
+
+                # only regular files of the same size can be duplicates, symlinks are never followed
+                elif target_stat is not None and stat.S_ISREG(source_stat.st_mode) \
+                        and stat.S_ISREG(target_stat.st_mode) and source_stat.st_size == target_stat.st_size:
+                    conflicts.append((FileEntry.from_stat(source_path, source_stat),
+                                      FileEntry.from_stat(target_path, target_stat)))
+
+                else:
+                    free_path = get_free_path(target_path, claimed)
+                    claimed.add(free_path)
+                    operations.append(MergeOperation(MOVE, source_path, free_path))
+
+    # hash all conflicting files at once, so the executor can work on them in parallel
+    work = functools.partial(get_entry_hash_tuple, name=name)
+    hashes = compute_hashes([entry for conflict in conflicts for entry in conflict], work, executor,
+                            cache=cache, algorithm=name)
+
+    for source_entry, target_entry in conflicts:
+        if hashes[source_entry] == hashes[target_entry]:
+            operations.append(MergeOperation(REMOVE, source_entry.path, target_entry.path))
+        else:
+            free_path = get_free_path(target_entry.path, claimed)
+            claimed.add(free_path)
+            operations.append(MergeOperation(MOVE, source_entry.path, free_path))
+
+    return operations
+
+
+def move(source: Path, target: Path):
+    """
+    Move a file or directory, with os.rename where possible.
+    Across devices files are copied with their metadata, directories with everything in them,
+    under a temporary name first, so the target never shows up half written, and the source is removed afterwards.
+    plan_merge only moves directories within a device, but mounts may change between planning and merging.
+
+    :param source: path to move
+    :param target: path to move to, must not exist
+    """
+    try:
+        os.rename(source, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+        # shutil copies in kernel space where it can, e.g. with sendfile on linux
+        temporary = target.with_name(f'.{target.name}.merging')
+        if os.path.isdir(source) and not os.path.islink(source):
+            shutil.copytree(source, temporary, symlinks=True)
+            os.replace(temporary, target)
+            shutil.rmtree(source)
+        else:
+            shutil.copy2(source, temporary, follow_symlinks=False)
+            os.replace(temporary, target)
+            os.unlink(source)
+
+
+def apply_merge_operation(operation: MergeOperation) -> MergeOperation:
+    """
+    Carry out a move or remove operation of a merge, see MergeOperation.
+
+    :param operation: the operation
+    :return: the same operation, once done
+    """
+    if operation.action == MOVE:
+        move(operation.source, operation.target)
+    elif operation.action == REMOVE:
+        os.unlink(operation.source)
+    else:
+        raise ValueError(f'Can not apply "{operation.action}" concurrently.')
+
+    return operation
+
+
+def remove_empty_dirs(root: Path):
+    """
+    Remove a directory and everything below it, as long as it contains nothing but empty directories.
+    Directories with something left in them are kept.
+
+    :param root: directory to clean up
+    """
+    for dirpath, _, _ in os.walk(root, topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            # not empty, something could not be merged
+            pass
+
+
+def merge_folders(source: str | bytes | os.PathLike | Path,
+                  target: str | bytes | os.PathLike | Path,
+                  name: str = 'sha256',
+                  processes: int = 1,
+                  dry_run: bool = False,
+                  print_results: bool = False,
+                  cache: HashCache | None = None) -> list[MergeOperation]:
+    """
+    Merge a directory into another one recursively, see plan_merge. This is destructive: files are moved out of
+    the source, duplicates of files in the target are removed, and the source is removed once it is empty.
+
+    Directories are created first, then files are moved and removed concurrently by a bounded pool of threads,
+    since most of the time is spent waiting on the filesystem.
+
+    :param source: directory to merge
+    :param target: directory to merge into
+    :param name: name of the hash algorithm to compare conflicting files with, see available_algorithms
+    :param processes: how many threads to hash and move files with, a single one does everything in this thread
+    :param dry_run: whether to only plan the merge, without touching anything
+    :param print_results: whether to print the operations as csv, with the action in the first column
+    :param cache: hash cache to consult before hashing a file, None to bypass caching
+    :return: list of the operations that were, or in a dry run would be, carried out
+    """
+    source, target = Path(os.fsdecode(source)).resolve(), Path(os.fsdecode(target)).resolve()
+    if not source.is_dir() or not target.is_dir():
+        raise ValueError(f'Can only merge directories. "{source}" or "{target}" is not a directory.')
+    if source == target or target.is_relative_to(source):
+        raise ValueError(f'Can not merge "{source}" into itself.')
+
+    # the cache must not mix up hashes, if the alias resolves differently on the next run
+    name = resolve_algorithm(name)
+
+    with BoundedExecutor(workers=processes) as executor:
+        operations = plan_merge(source, target, executor, name=name, cache=cache)
+
+        if not dry_run:
+            # planned top down, so parents are created before their children
+            # times of the sources are taken now, moving files out of them changes those
+            source_stats: dict[Path, os.stat_result] = {}
+            for operation in operations:
+                if operation.action == MKDIR:
+                    source_stats[operation.target] = os.stat(operation.source)
+                    operation.target.mkdir()
+
+            # every operation has a distinct source and target, so their order does not matter
+            for _ in executor.map_unordered(apply_merge_operation,
+                                            [operation for operation in operations if operation.action != MKDIR]):
+                pass
+
+            # created directories should look like their sources, like moved files do,
+            # children first, since filling a directory changes its modification time
+            for operation in reversed(operations):
+                if operation.action == MKDIR:
+                    shutil.copystat(operation.source, operation.target)
+                    source_stat = source_stats[operation.target]
+                    os.utime(operation.target, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+            remove_empty_dirs(source)
+
+    if print_results:
+        for operation in operations:
+            print_csv([[operation.source, operation.target]], prefix=operation.action)
+
+    return operations
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    cache = None if args.no_cache else HashCache(args.cache, max_entries=args.cache_size)
+    try:
+        merge_folders(args.source,
+                      args.target,
+                      name=args.algorithm,
+                      processes=args.processes,
+                      dry_run=args.dry_run,
+                      print_results=True,
+                      cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == '__main__':
+    main()
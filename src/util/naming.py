@@ -1,16 +1,39 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
 import sys
 import re
 
 from pathlib import Path
 from string import ascii_letters, digits
+from typing import Callable, Iterable, Iterator
+
+from util.traversal import FileEntry, Visitor, iter_file_tree
 
 POSIX_PORTABLE_FILENAME_CHARACTERS = ascii_letters + digits + '._-'
 
 
+@functools.lru_cache
+def compile_name_validator(allowed_chars: str = POSIX_PORTABLE_FILENAME_CHARACTERS) -> Callable[[str], bool]:
+    """
+    Compile a check for names, that contain characters that are not allowed.
+    The check is a single regex search for the first character outside of the allowed set,
+    so names are scanned in C, and clean names are scanned exactly once.
+
+    :param allowed_chars: string of characters that are allowed in names
+    :return: function taking a name and returning whether it contains characters that are not allowed
+    """
+    if not allowed_chars:
+        # every character offends, so does anything but the empty name
+        return bool
+
+    # escaping keeps characters like ], ^, - and \ literal inside the character class
+    disallowed_char = re.compile(f'[^{re.escape(allowed_chars)}]')
+    return lambda name: disallowed_char.search(name) is not None
+
+
 def parse_args(args: list[str] = None):
     if args is None:
         args = sys.argv[1:]
@@ -37,51 +60,82 @@ def get_offending_paths(root: str | bytes | os.PathLike | Path,
                         include_gitignore: bool = False,
                         regex_flags: list[re.RegexFlag] = None,
                         processes: int = 1,
-                        print_results: bool = False) -> list[Path]:
-
-    """"""
+                        print_results: bool = False,
+                        workers: int = 1,
+                        excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> Iterator[Path]:
+    """
+    Lazily find paths under a directory, whose names contain characters that are not allowed.
+    Parameters largely correspond to the ones for traverse_file_tree.
+
+    :param root: directory under which to search, or a single file to check
+    :param allowed_chars: string of characters that are allowed in names
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
+    :param processes: unused so far
+    :param print_results: unused so far
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :return: iterator over paths with offending names
+    """
 
     # make sure paths are properly resolved and absolute
     root = Path(root).resolve()
-    excluded = [Path(ex).resolve() for ex in []]
 
     # if the passed path does not exist we can't proceed
     if not root.exists():
         raise ValueError(f'{root} does not exist')
 
-    # if the passed path is a file
+    # compiled once per set of allowed characters
+    is_offending = compile_name_validator(allowed_chars)
+
+    # if the passed path is a file, there is nothing to walk, we only check its own name
     if not root.is_dir():
-        file = root
-        # we walk the parent directory instead
-        root = file.parent
-        # but exclude everything except the file itself
-        excluded.extend([path.resolve() for path in root.iterdir()
-                         if not file.samefile(path)])
-
-    # walk the directory
-    for (dirpath, dirnames, filenames) in os.walk(root):
-        # we modify dirnames and filenames in place to limit walk
-        for ex in excluded:
-            # resolve dir and file names
-            dirpaths = [Path(root, dirpath, name) for name in dirnames]
-            filepaths = [Path(root, dirpath, name) for name in filenames]
-
-            # if they are excluded, remove them
-            if ex in dirpaths: dirnames.remove(ex.name)
-            if ex in filepaths: filenames.remove(ex.name)
-
-        # for not excluded names
-        for name in dirnames + filenames:
-            # if a name does not conform, we yield the corresponding path
-            # checking against names is better, because if we have an invalid
-            # subdir name we only yield it once and not also all paths under it
-            if not all([char in allowed_chars for char in name]):
-                offending_path = Path(root, dirpath, name)
-                yield offending_path
-
-
-def main():
-    args = parse_args()
+        if is_offending(root.name):
+            yield root
+        return
+
+    # walk the directory, paths are yielded while the walk is still running
+    for path in iter_file_tree(root=root,
+                               regard_patterns=regard_patterns,
+                               regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                               ignore_patterns=ignore_patterns,
+                               include_gitignore=include_gitignore,
+                               regex_flags=regex_flags,
+                               workers=workers,
+                               excluded_paths=excluded_paths):
+        # if a name does not conform, we yield the corresponding path
+        # checking against names is better, because if we have an invalid
+        # subdir name we only yield it once and not also all paths under it
+        if is_offending(path.name):
+            yield path
+
+
+class OffendingNameVisitor(Visitor):
+    """Collects paths whose names contain characters that are not allowed during a walk, see visit_file_tree."""
+
+    def __init__(self, allowed_chars: str = POSIX_PORTABLE_FILENAME_CHARACTERS):
+        """
+        :param allowed_chars: string of characters that are allowed in names
+        """
+        self.is_offending = compile_name_validator(allowed_chars)
+        self.paths: list[Path] = []
+
+    def visit(self, entry: FileEntry):
+        if self.is_offending(entry.path.name):
+            self.paths.append(entry.path)
+
+    def result(self) -> list[Path]:
+        """
+        :return: list of paths with offending names, in the order they were walked
+        """
+        return self.paths
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
 
     top = args.path
     excluded = [] if args.excluded is None else args.excluded
@@ -89,7 +143,7 @@ def main():
 
     offended = False
     try:
-        for offending_path in get_offending_paths(top, excluded, allowed_chars):
+        for offending_path in get_offending_paths(top, allowed_chars=allowed_chars, excluded_paths=excluded):
             print(offending_path, file=sys.stderr)
             offended = True
     except (KeyboardInterrupt, SystemExit):
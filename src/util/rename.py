@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+import unicodedata
+
+from pathlib import Path
+from collections import defaultdict
+from typing import Callable, Iterable, NamedTuple
+
+from util.duplicates import print_csv
+from util.executor import BoundedExecutor
+from util.naming import POSIX_PORTABLE_FILENAME_CHARACTERS, compile_name_validator
+from util.traversal import iter_file_entries
+
+# letters that don't decompose into a base letter and combining marks, umlauts are commonly written with an e
+TRANSLITERATIONS = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue', 'Ä': 'Ae', 'Ö': 'Oe', 'Ü': 'Ue',
+                                  'ß': 'ss', 'æ': 'ae', 'Æ': 'AE', 'œ': 'oe', 'Œ': 'OE', 'ø': 'o', 'Ø': 'O',
+                                  'ł': 'l', 'Ł': 'L', 'đ': 'd', 'Đ': 'D', 'þ': 'th', 'Þ': 'TH'})
+# what numbers of unique names are written with, if the allowed characters include them
+DECIMAL_DIGITS = '0123456789'
+
+
+def transliterate(name: str) -> str:
+    """
+    Replace accented and special latin letters by their closest ascii counterparts, e.g. 'Größe' becomes 'Groesse'.
+    Other characters are left alone.
+
+    :param name: name to transliterate
+    :return: the transliterated name
+    """
+    name = name.translate(TRANSLITERATIONS)
+    # split accented letters into base letter and combining marks, and drop the marks
+    return ''.join(char for char in unicodedata.normalize('NFKD', name) if not unicodedata.combining(char))
+
+
+# ways to map names to new ones, before remaining characters that are not allowed get replaced
+STRATEGIES: dict[str, Callable[[str], str]] = {
+    'replace': lambda name: name,
+    'transliterate': transliterate,
+    'lowercase': lambda name: transliterate(name).lower(),
+}
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Renames files and directories under a directory, whose names '
+                                                 'include characters that are not in the POSIX portable file name '
+                                                 'character set. Prints the renames as csv, one per line')
+
+    parser.add_argument('path', nargs='?', type=Path, default=os.getcwd(),
+                        help='the path under which to rename, defaults to cwd')
+    parser.add_argument('-r', '--regard', nargs='+', help='only consider files matching these glob patterns')
+    parser.add_argument('-i', '--ignore', nargs='+', help='ignore files and dirs matching these glob patterns')
+    parser.add_argument('-g', '--gitignore', action='store_true', help='respect .gitignore files')
+    parser.add_argument('-e', '--excluded', nargs='+', type=Path, help='exclude these paths')
+    parser.add_argument('-s', '--symbols', help='a string of allowed characters')
+    parser.add_argument('--strategy', choices=STRATEGIES, default='transliterate',
+                        help='how to map names to new ones, defaults to transliterate')
+    parser.add_argument('--replacement', default='_',
+                        help='what to replace remaining characters that are not allowed with, defaults to _')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='only print what would be done')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                        help='how many threads to rename with, defaults to the cpu count')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='how many threads to list directories with, helps on network filesystems')
+
+    return parser.parse_args(args)
+
+
+class RenameOperation(NamedTuple):
+    """Rename source to target, both are in the same directory."""
+    source: Path
+    target: Path
+
+
+def compile_renamer(strategy: str = 'transliterate',
+                    allowed_chars: str = POSIX_PORTABLE_FILENAME_CHARACTERS,
+                    replacement: str = '_') -> Callable[[str], str]:
+    """
+    Compile a function mapping names to names that only contain allowed characters.
+
+    :param strategy: name of the strategy to map names with first, see STRATEGIES
+    :param allowed_chars: string of characters that are allowed in names
+    :param replacement: what to replace characters that are still not allowed afterwards with
+    :return: function taking a name and returning the new one
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Strategy "{strategy}" is not one of {", ".join(STRATEGIES)}.')
+    if compile_name_validator(allowed_chars)(replacement):
+        raise ValueError(f'Replacement "{replacement}" contains characters that are not allowed.')
+
+    map_name = STRATEGIES[strategy]
+    disallowed_char = re.compile(f'[^{re.escape(allowed_chars)}]')
+
+    def rename(name: str) -> str:
+        new_name = disallowed_char.sub(replacement, map_name(name))
+        # e.g. a full width dot decomposes into a plain one, but '.' and '..' name the directory and its parent
+        if not new_name.strip('.'):
+            new_name = replacement + new_name
+        return new_name
+
+    return rename
+
+
+def get_number_digits(allowed_chars: str = POSIX_PORTABLE_FILENAME_CHARACTERS, replacement: str = '_') -> str:
+    """
+    Get the characters to write the numbers of unique names with, so numbered names only contain allowed characters.
+
+    :param allowed_chars: string of characters that are allowed in names
+    :param replacement: fallback if no other character is allowed, it has to be allowed itself
+    :return: the decimal digits if allowed, otherwise the allowed characters but the dot, which starts suffixes
+    """
+    if all(digit in allowed_chars for digit in DECIMAL_DIGITS):
+        return DECIMAL_DIGITS
+    return ''.join(sorted(set(allowed_chars) - {'.'})) or replacement
+
+
+def format_number(number: int, digits: str = DECIMAL_DIGITS) -> str:
+    """
+    Write a positive number with the given digits, in the base of their count, or as a tally if there is just one.
+
+    :param number: the number
+    :param digits: the characters standing for zero, one and so on
+    :return: the written number
+    """
+    if len(digits) == 1:
+        return digits * number
+
+    written = ''
+    while number:
+        number, digit = divmod(number, len(digits))
+        written = digits[digit] + written
+    return written
+
+
+def get_unique_name(name: str, taken: set[str], separator: str = '_', digits: str = DECIMAL_DIGITS) -> str:
+    """
+    Make a name unique within a directory, by appending a number to its stem.
+
+    :param name: the name
+    :param taken: names that exist or are planned to exist in the directory
+    :param separator: what to put between stem and number
+    :param digits: the characters to write the number with, see get_number_digits
+    :return: the name itself if it is not taken, otherwise the first numbered variant that is not
+    """
+    if name not in taken:
+        return name
+
+    # the suffix starts at the first dot that does not start the name, so 'a.tar.gz' becomes 'a_1.tar.gz'
+    dot = name.find('.', 1)
+    stem, suffix = (name[:dot], name[dot:]) if dot > 0 else (name, '')
+
+    i = 1
+    while f'{stem}{separator}{format_number(i, digits)}{suffix}' in taken:
+        i += 1
+    return f'{stem}{separator}{format_number(i, digits)}{suffix}'
+
+
+def plan_renames(paths: Iterable[Path],
+                 rename: Callable[[str], str],
+                 separator: str = '_',
+                 digits: str = DECIMAL_DIGITS) -> list[list[RenameOperation]]:
+    """
+    Plan renames of paths, without touching any of them.
+
+    Collisions are resolved ahead of time, with an index of the names in each affected directory,
+    that is built from a single listing of the directory, so planning stays linear in the number of paths.
+    New names only contain allowed characters, and only names that contain others are renamed,
+    so a new name never clashes with one that is freed up by another rename.
+
+    :param paths: paths to rename, their names contain characters that are not allowed
+    :param rename: function mapping names to new ones, see compile_renamer
+    :param separator: what to put between stem and number, if a new name is taken
+    :param digits: the characters to write that number with, they should be allowed, see get_number_digits
+    :return: batches of renames, one per directory, ordered from the deepest directories up,
+             so children are renamed before their parents, and queued paths stay valid
+    """
+    by_dir: dict[Path, list[Path]] = defaultdict(list)
+    for path in paths:
+        by_dir[path.parent].append(path)
+
+    batches = []
+    for directory, dir_paths in by_dir.items():
+        taken = set(os.listdir(directory))
+
+        batch = []
+        # sorted, so the same tree always gets the same numbers
+        for path in sorted(dir_paths):
+            new_name = rename(path.name)
+            if new_name == path.name:
+                continue
+
+            new_name = get_unique_name(new_name, taken, separator, digits)
+            taken.add(new_name)
+            batch.append(RenameOperation(path, directory / new_name))
+
+        if batch:
+            batches.append(batch)
+
+    batches.sort(key=lambda batch: len(batch[0].source.parts), reverse=True)
+    return batches
+
+
+def apply_rename_batch(batch: list[RenameOperation]) -> list[RenameOperation]:
+    """
+    Carry out the renames of a single directory.
+
+    :param batch: renames within the same directory
+    :return: the same renames, once done
+    :raises FileExistsError: if a target was created since the renames were planned, instead of overwriting it
+    """
+    for source, target in batch:
+        if os.path.lexists(target):
+            raise FileExistsError(f'Can not rename "{source}", "{target}" exists.')
+        os.rename(source, target)
+
+    return batch
+
+
+def rename_offending_paths(root: str | bytes | os.PathLike | Path,
+                           strategy: str = 'transliterate',
+                           allowed_chars: str = POSIX_PORTABLE_FILENAME_CHARACTERS,
+                           replacement: str = '_',
+                           regard_patterns: list[str] = None,
+                           regard_patterns_concern_dirs: bool = False,
+                           ignore_patterns: list[str] = None,
+                           include_gitignore: bool = False,
+                           regex_flags: list[re.RegexFlag] = None,
+                           processes: int = 1,
+                           workers: int = 1,
+                           excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None,
+                           dry_run: bool = False,
+                           print_results: bool = False) -> list[RenameOperation]:
+    """
+    Rename paths under a directory, whose names contain characters that are not allowed, see get_offending_paths.
+    Parameters largely correspond to the ones for traverse_file_tree.
+
+    Renames are batched per directory and carried out from the deepest directories up.
+    Directories at the same depth don't contain one another, so their batches run concurrently.
+
+    :param root: directory under which to rename, it is not renamed itself
+    :param strategy: how to map names to new ones, see STRATEGIES
+    :param allowed_chars: string of characters that are allowed in names
+    :param replacement: what to replace characters that are still not allowed with
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: flags for the pattern lists, like re.IGNORECASE or re.DOTALL
+    :param processes: how many threads to rename with, a single one renames in this thread
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :param dry_run: whether to only plan the renames, without touching anything
+    :param print_results: whether to print the renames as csv, with old and new path
+    :return: list of the renames that were, or in a dry run would be, carried out
+    """
+    rename = compile_renamer(strategy, allowed_chars, replacement)
+    is_offending = compile_name_validator(allowed_chars)
+
+    # names are all we need, so the walk can skip the stat calls
+    offending = (entry.path for entry in iter_file_entries(root=root,
+                                                           regard_patterns=regard_patterns,
+                                                           regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                                           ignore_patterns=ignore_patterns,
+                                                           include_gitignore=include_gitignore,
+                                                           regex_flags=regex_flags,
+                                                           with_stat=False,
+                                                           workers=workers,
+                                                           excluded_paths=excluded_paths)
+                 if is_offending(entry.path.name))
+    # numbered names must not offend either, or the next run would rename them again
+    batches = plan_renames(offending, rename, separator=replacement,
+                           digits=get_number_digits(allowed_chars, replacement))
+
+    if not dry_run:
+        # batches are ordered by depth, a level may only start once the one below it is done
+        levels: dict[int, list[list[RenameOperation]]] = defaultdict(list)
+        for batch in batches:
+            levels[len(batch[0].source.parts)].append(batch)
+
+        with BoundedExecutor(workers=processes, chunksize=1) as executor:
+            for level in levels.values():
+                for _ in executor.map_unordered(apply_rename_batch, level):
+                    pass
+
+    operations = [operation for batch in batches for operation in batch]
+    if print_results:
+        for operation in operations:
+            print_csv([[operation.source, operation.target]])
+
+    return operations
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    rename_offending_paths(args.path,
+                           strategy=args.strategy,
+                           allowed_chars=POSIX_PORTABLE_FILENAME_CHARACTERS if args.symbols is None else args.symbols,
+                           replacement=args.replacement,
+                           regard_patterns=args.regard,
+                           ignore_patterns=args.ignore,
+                           include_gitignore=args.gitignore,
+                           processes=args.processes,
+                           workers=args.workers,
+                           excluded_paths=args.excluded,
+                           dry_run=args.dry_run,
+                           print_results=True)
+
+
+if __name__ == '__main__':
+    main()
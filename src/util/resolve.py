@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import json
+import os
+import re
+import shutil
+import sys
+
+from pathlib import Path
+from collections import defaultdict
+from typing import Callable, Iterable, NamedTuple
+
+from util.algorithms import available_algorithms
+from util.cache import HashCache, DEFAULT_CACHE_PATH
+from util.duplicates import files_are_equal, find_duplicate_files, print_csv, verify_option
+from util.executor import BoundedExecutor
+from util.extents import clone_file
+from util.hashing import get_file_hash
+from util.traversal import FileEntry
+
+# what to replace duplicates with
+DELETE, HARDLINK, REFLINK, SYMLINK = 'delete', 'hardlink', 'reflink', 'symlink'
+ACTIONS = (DELETE, HARDLINK, REFLINK, SYMLINK)
+
+# which file of a group to keep, lower keys win
+KEEP_POLICIES: dict[str, Callable[[FileEntry], tuple]] = {
+    'oldest': lambda entry: (entry.mtime_ns, str(entry.path)),
+    'newest': lambda entry: (-entry.mtime_ns, str(entry.path)),
+    'shortest': lambda entry: (len(str(entry.path)), str(entry.path)),
+}
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Finds duplicate files under a directory, and replaces all but one '
+                                                 'file of each group. Prints the resolutions as csv, one per line')
+
+    parser.add_argument('path', nargs='?', type=Path, default=os.getcwd(),
+                        help='the path under which to search, defaults to cwd')
+    parser.add_argument('-r', '--regard', nargs='+', help='only consider files matching these glob patterns')
+    parser.add_argument('-i', '--ignore', nargs='+', help='ignore files and dirs matching these glob patterns')
+    parser.add_argument('-g', '--gitignore', action='store_true', help='respect .gitignore files')
+    parser.add_argument('-a', '--algorithm', choices=available_algorithms(), default='sha256', metavar='ALGORITHM',
+                        help='hash algorithm to use, defaults to sha256')
+    parser.add_argument('--verify', type=verify_option, metavar='bytes|ALGORITHM',
+                        help='confirm duplicates by comparing bytes, or by hashing with another algorithm')
+    parser.add_argument('-p', '--processes', type=int, default=os.cpu_count(),
+                        help='how many threads to hash and resolve with, defaults to the cpu count')
+
+    resolve_group = parser.add_argument_group('resolution')
+    resolve_group.add_argument('--action', choices=ACTIONS, default=DELETE,
+                               help='what to replace duplicates with, defaults to delete')
+    resolve_group.add_argument('--keep', choices=KEEP_POLICIES, default='oldest',
+                               help='which file of a group to keep, defaults to oldest')
+    resolve_group.add_argument('--prefer', metavar='REGEX',
+                               help='keep files with paths matching this regex, if a group has any')
+    resolve_group.add_argument('-n', '--dry-run', action='store_true', help='only print what would be done')
+    resolve_group.add_argument('--journal', type=Path,
+                               help='log progress to this file, so an interrupted run can be resumed or rolled back')
+    resolve_group.add_argument('--resume', action='store_true',
+                               help='finish the run logged in the journal, instead of searching again')
+    resolve_group.add_argument('--rollback', action='store_true',
+                               help='undo the unfinished run logged in the journal')
+
+    cache_group = parser.add_argument_group('hash cache')
+    cache_group.add_argument('--cache', type=Path, default=DEFAULT_CACHE_PATH,
+                             help=f'where to keep the hash cache, defaults to {DEFAULT_CACHE_PATH}')
+    cache_group.add_argument('--no-cache', action='store_true', help='bypass the hash cache')
+
+    args = parser.parse_args(args)
+    if (args.resume or args.rollback) and args.journal is None:
+        parser.error('--resume and --rollback need a --journal')
+
+    return args
+
+
+class Resolution(NamedTuple):
+    """
+    Replace the duplicate at path by the given action, with keeper being the file of its group that is kept.
+    Size and modification times are the ones the files had when the resolution was planned, if known,
+    files that don't match them anymore changed since they were found, and are not touched.
+    """
+    action: str
+    path: Path
+    keeper: Path
+    size: int | None = None
+    mtime_ns: int | None = None
+    keeper_mtime_ns: int | None = None
+
+
+def get_backup_path(path: Path) -> Path:
+    """
+    Get the path a duplicate is moved to while it is being replaced, until the run is committed.
+
+    :param path: path of the duplicate
+    :return: hidden path next to it
+    """
+    return path.with_name(f'.{path.name}.resolving')
+
+
+def is_unchanged(resolution: Resolution, verify: str | None = None) -> bool:
+    """
+    Check that the duplicate and the kept file of a resolution are still the ones that were planned with.
+
+    :param resolution: the resolution to check
+    :param verify: 'bytes' to compare both files byte by byte as well, or the name of a hash algorithm to compare
+                   their hashes, see find_duplicate_files
+    :return: whether both files still have the planned size and modification times, and the same content if verified
+    """
+    try:
+        if resolution.size is not None:
+            for path, mtime_ns in ((resolution.path, resolution.mtime_ns),
+                                   (resolution.keeper, resolution.keeper_mtime_ns)):
+                stat = os.lstat(path)
+                if stat.st_size != resolution.size or stat.st_mtime_ns != mtime_ns:
+                    return False
+
+        if verify == 'bytes':
+            return files_are_equal(resolution.path, resolution.keeper)
+        if verify is not None:
+            return get_file_hash(resolution.path, name=verify) == get_file_hash(resolution.keeper, name=verify)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def choose_keeper(entries: list[FileEntry], keep: str = 'oldest', prefer: re.Pattern | None = None) -> FileEntry:
+    """
+    Choose the file of a group of duplicates that is kept.
+
+    :param entries: entries of the files in the group, with stat info
+    :param keep: name of the policy to choose with, see KEEP_POLICIES
+    :param prefer: if files match this pattern, the keeper is chosen among them
+    :return: entry of the file to keep
+    """
+    if prefer is not None:
+        entries = [entry for entry in entries if prefer.search(str(entry.path))] or entries
+
+    return min(entries, key=KEEP_POLICIES[keep])
+
+
+def plan_resolutions(duplicates: dict[str, list[Path]],
+                     executor: BoundedExecutor,
+                     action: str = DELETE,
+                     keep: str = 'oldest',
+                     prefer: re.Pattern | None = None) -> list[Resolution]:
+    """
+    Plan how to resolve groups of duplicates, without touching any of them.
+
+    Links and clones can't span devices, so for those actions groups are split up by device first,
+    and each part keeps a file of its own. Files that vanished since they were found are left out,
+    and groups or parts that are left with a single file are not resolved at all.
+
+    :param duplicates: map of file hashes to lists of files that are duplicates of one another
+    :param executor: executor to stat the files with
+    :param action: what to replace duplicates with, see ACTIONS
+    :param keep: name of the policy to choose the kept file with, see KEEP_POLICIES
+    :param prefer: if files of a group match this pattern, the kept file is chosen among them
+    :return: list of resolutions, one for every file that is not kept
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Action "{action}" is not one of {", ".join(ACTIONS)}.')
+    if keep not in KEEP_POLICIES:
+        raise ValueError(f'Keep policy "{keep}" is not one of {", ".join(KEEP_POLICIES)}.')
+
+    def stat(path: Path) -> FileEntry | None:
+        try:
+            return FileEntry.from_path(path, follow_symlinks=False)
+        except FileNotFoundError:
+            return None
+
+    entries = {entry.path: entry
+               for entry in executor.map_unordered(stat, [path for paths in duplicates.values() for path in paths])
+               if entry is not None}
+
+    resolutions = []
+    for paths in duplicates.values():
+        parts: dict[int | None, list[FileEntry]] = defaultdict(list)
+        for path in paths:
+            entry = entries.get(path)
+            if entry is not None:
+                parts[entry.dev if action in (HARDLINK, REFLINK) else None].append(entry)
+
+        for part in parts.values():
+            # nothing left to be a duplicate of
+            if len(part) < 2:
+                continue
+            keeper = choose_keeper(part, keep=keep, prefer=prefer)
+            resolutions.extend(Resolution(action, entry.path, keeper.path, entry.size, entry.mtime_ns, keeper.mtime_ns)
+                               for entry in part if entry is not keeper)
+
+    return resolutions
+
+
+def apply_resolution(resolution: Resolution, verify: str | None = None) -> tuple[Resolution, bool]:
+    """
+    Replace a duplicate, see Resolution. The duplicate is moved to its backup path first, and only removed on commit,
+    see commit_resolution. Links and clones are created under a temporary name and renamed into place,
+    so the path never holds a half written file. Before that, both files are checked to be unchanged,
+    see is_unchanged, otherwise the resolution is skipped.
+
+    Applying a resolution is idempotent, so runs that were interrupted at any point can simply be applied again.
+
+    :param resolution: the resolution to apply
+    :param verify: how to confirm the files are still duplicates, see is_unchanged
+    :return: tuple of the same resolution, once done, and whether it was applied rather than skipped
+    :raises OSError: if the link or clone can't be created, the duplicate is restored first
+    """
+    action, path, keeper = resolution[:3]
+    backup = get_backup_path(path)
+
+    # already moved aside, if this is a resumed run
+    if not os.path.lexists(backup):
+        if action == DELETE and not os.path.lexists(path):
+            return resolution, True
+        if not is_unchanged(resolution, verify):
+            return resolution, False
+        os.rename(path, backup)
+
+    if action == DELETE or os.path.lexists(path):
+        return resolution, True
+
+    temporary = path.with_name(f'.{path.name}.linking')
+    if os.path.lexists(temporary):
+        os.unlink(temporary)
+
+    try:
+        if action == HARDLINK:
+            os.link(keeper, temporary)
+        elif action == SYMLINK:
+            os.symlink(keeper.resolve(), temporary)
+        else:
+            clone_file(keeper, temporary)
+            # the clone should look like the file it replaces
+            shutil.copystat(backup, temporary)
+    except OSError:
+        # e.g. the filesystem does not support reflinks, put the duplicate back, instead of leaving it half resolved
+        if os.path.lexists(temporary):
+            os.unlink(temporary)
+        os.replace(backup, path)
+        raise
+
+    os.replace(temporary, path)
+    return resolution, True
+
+
+def commit_resolution(resolution: Resolution) -> Resolution:
+    """
+    Remove the backup of a duplicate, once it was replaced, see apply_resolution.
+
+    :param resolution: the applied resolution
+    :return: the same resolution, once done
+    """
+    backup = get_backup_path(resolution.path)
+    if os.path.lexists(backup):
+        os.unlink(backup)
+    return resolution
+
+
+def rollback_resolution(resolution: Resolution) -> Resolution:
+    """
+    Restore a duplicate from its backup, undoing apply_resolution, if it was not committed yet.
+
+    :param resolution: the resolution to undo
+    :return: the same resolution, once done
+    """
+    backup = get_backup_path(resolution.path)
+    if os.path.lexists(backup):
+        os.replace(backup, resolution.path)
+    return resolution
+
+
+class ResolutionJournal:
+    """
+    Append-only log of a resolution run, so it can be resumed or rolled back after an interruption.
+
+    The plan is logged completely before anything is touched, and applied resolutions are logged in batches.
+    Since applying a resolution is idempotent, and duplicates are only moved to backups until the run is committed,
+    the plan alone suffices to resume or roll back, the logged progress just saves work.
+    Every line is a json object, paths are stored as strings and survive names that are not valid unicode.
+    """
+
+    def __init__(self, path: str | bytes | os.PathLike | Path):
+        """
+        :param path: where the journal is stored
+        """
+        self.path = Path(os.fsdecode(path))
+
+    def _append(self, records: Iterable[dict]):
+        with self.path.open('a') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def log_plan(self, resolutions: list[Resolution]):
+        """
+        Start a new run, replacing whatever was logged before.
+
+        :param resolutions: all resolutions of the run
+        """
+        self.path.unlink(missing_ok=True)
+        self._append({'action': action, 'path': os.fsdecode(path), 'keeper': os.fsdecode(keeper),
+                      'size': size, 'mtime_ns': mtime_ns, 'keeper_mtime_ns': keeper_mtime_ns}
+                     for action, path, keeper, size, mtime_ns, keeper_mtime_ns in resolutions)
+
+    def log_applied(self, resolutions: list[Resolution]):
+        """
+        Log that resolutions were applied.
+
+        :param resolutions: the applied resolutions
+        """
+        self._append({'applied': os.fsdecode(resolution.path)} for resolution in resolutions)
+
+    def log_committed(self):
+        """Log that the run was committed, so there is nothing left to resume or roll back."""
+        self._append([{'committed': True}])
+
+    def read(self) -> tuple[list[Resolution], set[Path], bool]:
+        """
+        Read the logged run.
+
+        :return: tuple of the planned resolutions, the paths of applied ones, and whether the run was committed
+        """
+        resolutions, applied, committed = [], set(), False
+        with self.path.open() as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut short, if we were killed while writing it
+                    continue
+
+                if 'applied' in record:
+                    applied.add(Path(record['applied']))
+                elif 'committed' in record:
+                    committed = True
+                else:
+                    resolutions.append(Resolution(record['action'], Path(record['path']), Path(record['keeper']),
+                                                  record.get('size'), record.get('mtime_ns'),
+                                                  record.get('keeper_mtime_ns')))
+
+        return resolutions, applied, committed
+
+
+def run_resolutions(resolutions: list[Resolution],
+                    processes: int = 1,
+                    journal: ResolutionJournal | None = None,
+                    applied: set[Path] = frozenset(),
+                    batch_size: int = 256,
+                    verify: str | None = None) -> list[Resolution]:
+    """
+    Apply resolutions concurrently, and commit them once all are applied.
+
+    :param resolutions: resolutions to apply
+    :param processes: how many threads to apply them with, a single one does everything in this thread
+    :param journal: journal to log progress to, None to not log anything
+    :param applied: paths of resolutions that are known to be applied already, e.g. from a journal
+    :param batch_size: how many applied resolutions to log at once
+    :param verify: how to confirm the files are still duplicates before replacing them, see is_unchanged
+    :return: list of the resolutions that were skipped, as their files changed since they were planned
+    """
+    skipped = []
+    with BoundedExecutor(workers=processes) as executor:
+        batch = []
+        for resolution, done in executor.map_unordered(functools.partial(apply_resolution, verify=verify),
+                                                       [resolution for resolution in resolutions
+                                                        if resolution.path not in applied]):
+            if not done:
+                skipped.append(resolution)
+                continue
+
+            batch.append(resolution)
+            if journal is not None and len(batch) >= batch_size:
+                journal.log_applied(batch)
+                batch.clear()
+
+        if journal is not None:
+            journal.log_applied(batch)
+
+        # only now that everything is in place, the backups can go
+        for _ in executor.map_unordered(commit_resolution, resolutions):
+            pass
+
+    if journal is not None:
+        journal.log_committed()
+    return skipped
+
+
+def print_resolutions(resolutions: list[Resolution], skipped: list[Resolution] = ()):
+    """
+    Print resolutions as csv, with the action in the first column, the duplicate in the second,
+    and the kept file in the third, and warn about skipped ones.
+
+    :param resolutions: the resolutions that were, or would be, applied
+    :param skipped: the resolutions that were skipped, as their files changed
+    """
+    for resolution in resolutions:
+        print_csv([[resolution.path, resolution.keeper]], prefix=resolution.action)
+    for resolution in skipped:
+        print('WARNING: skipped', resolution.action, 'of', resolution.path,
+              'as it or', resolution.keeper, 'changed since they were found', file=sys.stderr)
+
+
+def resolve_duplicates(duplicates: dict[str, list[Path]],
+                       action: str = DELETE,
+                       keep: str = 'oldest',
+                       prefer: str | re.Pattern | None = None,
+                       processes: int = 1,
+                       dry_run: bool = False,
+                       print_results: bool = False,
+                       journal: str | bytes | os.PathLike | Path | None = None,
+                       verify: str | None = None) -> list[Resolution]:
+    """
+    Replace all but one file of each group of duplicates, e.g. the ones found by find_duplicate_files.
+    Files that vanished since they were found are left out, and those that changed in size or modification time
+    are skipped and reported, see is_unchanged. Pass verify to compare the content again as well.
+
+    :param duplicates: map of file hashes to lists of files that are duplicates of one another
+    :param action: 'delete' to remove duplicates, or 'hardlink', 'reflink' or 'symlink' to replace them by one
+    :param keep: which file of a group to keep, see KEEP_POLICIES
+    :param prefer: if files of a group match this regex, the kept file is chosen among them
+    :param processes: how many threads to stat and replace files with, a single one does everything in this thread
+    :param dry_run: whether to only plan the resolutions, without touching anything
+    :param print_results: whether to print the resolutions as csv, with the action in the first column,
+                          the duplicate in the second, and the kept file in the third
+    :param journal: path to log progress to, so an interrupted run can be resumed or rolled back,
+                    see resume_resolutions and rollback_resolutions
+    :param verify: 'bytes' to compare files byte by byte before replacing them, or the name of a hash algorithm
+                   to compare their hashes, see find_duplicate_files
+    :return: list of the resolutions that were, or in a dry run would be, applied
+    """
+    if isinstance(prefer, str):
+        prefer = re.compile(prefer)
+
+    with BoundedExecutor(workers=processes) as executor:
+        resolutions = plan_resolutions(duplicates, executor, action=action, keep=keep, prefer=prefer)
+
+    skipped = []
+    if not dry_run:
+        journal = ResolutionJournal(journal) if journal is not None else None
+        if journal is not None:
+            journal.log_plan(resolutions)
+
+        skipped = run_resolutions(resolutions, processes=processes, journal=journal, verify=verify)
+        skipped_paths = {resolution.path for resolution in skipped}
+        resolutions = [resolution for resolution in resolutions if resolution.path not in skipped_paths]
+
+    if print_results:
+        print_resolutions(resolutions, skipped)
+
+    return resolutions
+
+
+def resume_resolutions(journal: str | bytes | os.PathLike | Path,
+                       processes: int = 1,
+                       print_results: bool = False,
+                       verify: str | None = None) -> list[Resolution]:
+    """
+    Finish an interrupted run of resolve_duplicates.
+
+    :param journal: path of the journal of the run
+    :param processes: how many threads to replace files with
+    :param print_results: whether to print the resolutions, see print_resolutions
+    :param verify: how to confirm the files are still duplicates before replacing them, see resolve_duplicates
+    :return: list of the resolutions of the run that were applied, empty if it was committed already
+    """
+    journal = ResolutionJournal(journal)
+    resolutions, applied, committed = journal.read()
+    if committed:
+        return []
+
+    skipped = run_resolutions(resolutions, processes=processes, journal=journal, applied=applied, verify=verify)
+    skipped_paths = {resolution.path for resolution in skipped}
+    resolutions = [resolution for resolution in resolutions if resolution.path not in skipped_paths]
+
+    if print_results:
+        print_resolutions(resolutions, skipped)
+
+    return resolutions
+
+
+def rollback_resolutions(journal: str | bytes | os.PathLike | Path,
+                         processes: int = 1) -> tuple[list[Resolution], list[Resolution]]:
+    """
+    Undo an interrupted run of resolve_duplicates, restoring all duplicates it replaced.
+    Committed runs can't be rolled back, their backups are gone. The same goes for resolutions of a run
+    that was interrupted while committing, once their backups were removed.
+
+    :param journal: path of the journal of the run
+    :param processes: how many threads to restore files with
+    :return: tuple of the resolutions that were undone, and those that could not be, as their backups are gone,
+             both empty if the run was committed already
+    """
+    journal = ResolutionJournal(journal)
+    resolutions, applied, committed = journal.read()
+    if committed:
+        return [], []
+
+    # backups only go away in the commit pass, which starts once all resolutions were applied and logged,
+    # so an applied resolution without a backup was committed
+    lost = [resolution for resolution in resolutions
+            if resolution.path in applied and not os.path.lexists(get_backup_path(resolution.path))]
+    lost_paths = {resolution.path for resolution in lost}
+    restored = [resolution for resolution in resolutions if resolution.path not in lost_paths]
+
+    with BoundedExecutor(workers=processes) as executor:
+        for _ in executor.map_unordered(rollback_resolution, restored):
+            pass
+
+    # the run is over, there is nothing left to resume
+    journal.log_committed()
+    return restored, lost
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    if args.rollback:
+        restored, lost = rollback_resolutions(args.journal, processes=args.processes)
+        for resolution in restored:
+            print_csv([[resolution.path, resolution.keeper]], prefix=resolution.action)
+        for resolution in lost:
+            print('WARNING: could not roll back', resolution.action, 'of', resolution.path, file=sys.stderr)
+        if lost:
+            sys.exit(1)
+    elif args.resume:
+        resume_resolutions(args.journal, processes=args.processes, print_results=True, verify=args.verify)
+    else:
+        cache = None if args.no_cache else HashCache(args.cache)
+        try:
+            duplicates = find_duplicate_files(args.path,
+                                              regard_patterns=args.regard,
+                                              ignore_patterns=args.ignore,
+                                              include_gitignore=args.gitignore,
+                                              name=args.algorithm,
+                                              processes=args.processes,
+                                              cache=cache,
+                                              verify=args.verify)
+        finally:
+            if cache is not None:
+                cache.close()
+
+        resolve_duplicates(duplicates,
+                           action=args.action,
+                           keep=args.keep,
+                           prefer=args.prefer,
+                           processes=args.processes,
+                           dry_run=args.dry_run,
+                           print_results=True,
+                           journal=args.journal,
+                           verify=args.verify)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+# name of the logger timers are logged to at debug level as they stop, so stages can be followed while a run is going on
+# json, logging and threading are only imported once stats are collected, every command imports this module on startup
+LOGGER_NAME = 'fileutils.stats'
+
+
+class Stats:
+    """
+    Counters and timers of a run, see collect_stats.
+
+    Counting is thread safe, so walks and hashing in threads are counted as well,
+    but counts made in worker processes of the process backend are lost.
+    Timers of work that runs in several threads at once add up, so they can exceed the wall time of the run.
+    """
+
+    def __init__(self, hook: Callable[[str, float], None] | None = None):
+        """
+        :param hook: called with name and seconds whenever a timer stops, e.g. to report progress
+        """
+        self.counters: dict[str, int] = defaultdict(int)
+        self.timers: dict[str, float] = defaultdict(float)
+        self.hook = hook
+
+        import logging
+        import threading
+
+        self._logger = logging.getLogger(LOGGER_NAME)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        """
+        Add to a counter.
+
+        :param name: name of the counter
+        :param n: how much to add
+        """
+        with self._lock:
+            self.counters[name] += n
+
+    def add_time(self, name: str, seconds: float):
+        """
+        Add to a timer, and report it to the hook and the log.
+
+        :param name: name of the timer
+        :param seconds: how long the timed work took
+        """
+        with self._lock:
+            self.timers[name] += seconds
+
+        self._logger.debug('%s took %.3f s', name, seconds)
+        if self.hook is not None:
+            self.hook(name, seconds)
+
+    def as_dict(self) -> dict[str, dict[str, int | float]]:
+        """
+        :return: dict with the counters and the timers in seconds, sorted by name
+        """
+        with self._lock:
+            return {'counters': dict(sorted(self.counters.items())),
+                    'timers': {name: round(seconds, 6) for name, seconds in sorted(self.timers.items())}}
+
+    def to_json(self) -> str:
+        """
+        :return: the counters and timers as json, see as_dict
+        """
+        import json
+
+        return json.dumps(self.as_dict(), indent=2)
+
+
+# the stats that are being collected, None if there are none, see collect_stats
+_active: Stats | None = None
+
+
+def count(name: str, n: int = 1):
+    """
+    Add to a counter, if stats are being collected, otherwise this costs next to nothing.
+
+    :param name: name of the counter
+    :param n: how much to add
+    """
+    if _active is not None:
+        _active.count(name, n)
+
+
+def is_collecting() -> bool:
+    """
+    Check whether stats are being collected, to skip work that only serves them otherwise.
+
+    :return: whether there are active stats
+    """
+    return _active is not None
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    Time the wrapped block, if stats are being collected.
+
+    :param name: name of the timer
+    """
+    stats = _active
+    if stats is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_stats(hook: Callable[[str, float], None] | None = None) -> Iterator[Stats]:
+    """
+    Collect counters and timers of everything that runs within the block, in all threads.
+
+    Counted are e.g. directories listed, entries pruned by each pattern, files and bytes hashed, and cache hits,
+    timed are the stages of walks and of the duplicate search.
+
+    :param hook: called with name and seconds whenever a timer stops, see Stats
+    :return: the stats, they are complete once the block is left
+    """
+    global _active
+    previous, _active = _active, Stats(hook)
+    try:
+        yield _active
+    finally:
+        _active = previous
@@ -0,0 +1,218 @@
+import os
+import sys
+
+from array import array
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Iterator
+
+# marks empty slots of the table, and the end of the chain of files of a group
+_NONE = -1
+# the table is grown once it is filled beyond this, so probe sequences stay short
+_MAX_LOAD = 0.5
+
+
+class HashStore(Mapping):
+    """
+    Compact map of file hashes to the files that produced them, see get_dir_hash_map.
+
+    A dict of hex strings to lists of Path objects costs several hundred bytes per file,
+    most of it in Path objects and hex strings. Here a file costs a few packed integers and its name:
+    digests are stored once per distinct hash, as raw bytes in a single buffer.
+    Paths are split into a table of distinct directories and names, that are stored back to back in a shared buffer.
+    Files with the same hash are chained through an array of indices.
+    Hashes are found through an open addressing table of group indices, that lives in a packed array as well.
+
+    This is a read only mapping of hex digests to lists of paths, so it can be used in place of the dict it replaces.
+    Raw digests work as keys as well. Lists of paths are created on access, so changing them does not change the store.
+    """
+
+    __slots__ = ('digest_size', 'digests', 'heads', 'sizes', 'table',
+                 'next_files', 'file_dirs', 'name_ends', 'names', 'dirs', 'dir_indices')
+
+    def __init__(self):
+        # known once the first hash is added, all hashes in a store have the same size
+        self.digest_size: int | None = None
+
+        # per group of files with the same hash: its digest, the file added last, and how many files it has
+        # indices of files and groups are 32 bit, which leaves room for two billion files
+        self.digests = bytearray()
+        self.heads = array('i')
+        self.sizes = array('I')
+        # slots hold group indices, the size is always a power of two, so probing can mask instead of taking modulo
+        self.table = array('i', [_NONE]) * 8
+
+        # per file: the file with the same hash that was added before it, its directory, and where its name ends
+        self.next_files = array('i')
+        self.file_dirs = array('I')
+        self.name_ends = array('Q')
+        self.names = bytearray()
+
+        # directories are shared by many files, so they are kept once
+        self.dirs: list[str] = []
+        self.dir_indices: dict[str, int] = {}
+
+    def _to_digest(self, file_hash: str | bytes) -> bytes:
+        return bytes.fromhex(file_hash) if isinstance(file_hash, str) else bytes(file_hash)
+
+    def _find(self, digest: bytes) -> tuple[int, int]:
+        """
+        Probe the table for a digest.
+
+        :param digest: the raw digest
+        :return: tuple of the slot, and the group it holds, or _NONE and the empty slot the digest would go into
+        """
+        mask = len(self.table) - 1
+        size = self.digest_size
+        slot = hash(digest) & mask
+
+        while (group := self.table[slot]) != _NONE:
+            if self.digests[group * size:(group + 1) * size] == digest:
+                return slot, group
+            slot = (slot + 1) & mask
+
+        return slot, _NONE
+
+    def _grow(self):
+        """Double the size of the table, and insert all groups again."""
+        self.table = array('i', [_NONE]) * (2 * len(self.table))
+        mask = len(self.table) - 1
+        size = self.digest_size
+
+        for group in range(len(self.heads)):
+            slot = hash(bytes(self.digests[group * size:(group + 1) * size])) & mask
+            while self.table[slot] != _NONE:
+                slot = (slot + 1) & mask
+            self.table[slot] = group
+
+    def add(self, path: str | bytes | os.PathLike | Path, file_hash: str | bytes):
+        """
+        Add a file to the group of its hash.
+
+        :param path: path of the file
+        :param file_hash: hex digest, or raw digest, of the file
+        """
+        digest = self._to_digest(file_hash)
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != self.digest_size:
+            raise ValueError(f'Hash "{file_hash}" does not have {self.digest_size} bytes like the others.')
+
+        dirpath, name = os.path.split(os.fsdecode(path))
+        dir_index = self.dir_indices.get(dirpath)
+        if dir_index is None:
+            dir_index = self.dir_indices[dirpath] = len(self.dirs)
+            self.dirs.append(dirpath)
+
+        file = len(self.file_dirs)
+        self.file_dirs.append(dir_index)
+        # encoded with surrogateescape, so names that are not valid utf-8 come back unchanged
+        self.names += os.fsencode(name)
+        self.name_ends.append(len(self.names))
+
+        slot, group = self._find(digest)
+        if group == _NONE:
+            group = len(self.heads)
+            self.table[slot] = group
+            self.digests += digest
+            self.heads.append(file)
+            self.sizes.append(1)
+            self.next_files.append(_NONE)
+
+            if len(self.heads) > _MAX_LOAD * len(self.table):
+                self._grow()
+        else:
+            # pushed to the front of the chain, which is reversed when it is read, see _get_group_paths
+            self.next_files.append(self.heads[group])
+            self.heads[group] = file
+            self.sizes[group] += 1
+
+    def get_path(self, file: int) -> Path:
+        """
+        :param file: index of the file, in the order files were added
+        :return: path of the file
+        """
+        start = self.name_ends[file - 1] if file else 0
+        name = os.fsdecode(bytes(self.names[start:self.name_ends[file]]))
+        return Path(os.path.join(self.dirs[self.file_dirs[file]], name))
+
+    def _get_group_paths(self, group: int) -> list[Path]:
+        paths = []
+        file = self.heads[group]
+        while file != _NONE:
+            paths.append(self.get_path(file))
+            file = self.next_files[file]
+        # chains start at the file that was added last
+        paths.reverse()
+        return paths
+
+    def iter_groups(self, min_size: int = 1) -> Iterator[tuple[str, list[Path]]]:
+        """
+        Iterate over the groups of files with the same hash, skipping small ones without creating their paths.
+
+        :param min_size: how many files a group needs to have at least, e.g. 2 for groups of duplicates
+        :return: iterator over tuples of hex digest and paths, in the order the hashes were first added
+        """
+        size = self.digest_size
+        for group in range(len(self.heads)):
+            if self.sizes[group] >= min_size:
+                yield self.digests[group * size:(group + 1) * size].hex(), self._get_group_paths(group)
+
+    def group_size(self, file_hash: str | bytes) -> int:
+        """
+        :param file_hash: hex digest, or raw digest
+        :return: how many files have that hash, 0 if none does
+        """
+        digest = self._to_digest(file_hash)
+        if len(digest) != self.digest_size:
+            return 0
+        _, group = self._find(digest)
+        return 0 if group == _NONE else self.sizes[group]
+
+    @property
+    def file_count(self) -> int:
+        """
+        :return: how many files were added, unlike len, which counts distinct hashes
+        """
+        return len(self.file_dirs)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        :return: how many bytes the store takes up, directories included
+        """
+        buffers = (self.digests, self.heads, self.sizes, self.table,
+                   self.next_files, self.file_dirs, self.name_ends, self.names)
+        return sum(sys.getsizeof(buffer) for buffer in buffers) \
+            + sum(sys.getsizeof(dirpath) for dirpath in self.dirs) + sys.getsizeof(self.dir_indices)
+
+    def __getitem__(self, file_hash: str | bytes) -> list[Path]:
+        try:
+            digest = self._to_digest(file_hash)
+        except (TypeError, ValueError):
+            raise KeyError(file_hash) from None
+
+        if self.digest_size is None or len(digest) != self.digest_size:
+            raise KeyError(file_hash)
+
+        _, group = self._find(digest)
+        if group == _NONE:
+            raise KeyError(file_hash)
+        return self._get_group_paths(group)
+
+    def __contains__(self, file_hash) -> bool:
+        try:
+            return self.group_size(file_hash) > 0
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self) -> Iterator[str]:
+        size = self.digest_size
+        for group in range(len(self.heads)):
+            yield self.digests[group * size:(group + 1) * size].hex()
+
+    def __len__(self) -> int:
+        return len(self.heads)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({len(self)} hashes, {self.file_count} files)'
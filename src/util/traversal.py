@@ -1,11 +1,19 @@
+import argparse
+import functools
 import os
 import re
+import stat
+import sys
 
 from pathlib import Path
 from functools import reduce
+from collections import defaultdict
+from typing import Callable, Iterable, Iterator, NamedTuple
 
 from fnmatch import translate
 
+from util import stats
+
 
 def gitignore_to_glob_pattern(root: str, pattern: str) -> str:
     """
@@ -33,7 +41,7 @@ def gitignore_to_glob_pattern(root: str, pattern: str) -> str:
     if relative_to_root:
         return root + pattern
     else:
-        return root + '**' + pattern
+        return root + '**' + os.sep + pattern
 
 
 def translate_glob_patterns(patterns: list[str] | None) -> list[str]:
@@ -64,10 +72,14 @@ def translate_glob_patterns(patterns: list[str] | None) -> list[str]:
             # we could lstrip from part 1 or rstrip from part 3, but ending on / limits to directories,
             # so we take the leading / from the next pattern instead of the trailing from last
             #
-            # TLDR; we lstrip('/') on parts EXCEPT the first
+            # simply dropping it would let r'/path/to/**/foo' match '/path/to/barfoo' though, so we remember
+            # that the '**' was followed by a separator, and make it match whole path components only
+            #
+            # TLDR; we lstrip('/') on parts EXCEPT the first, and remember whether we did
 
             first_iteration = i == 0
-            translated_part = part.lstrip('/') if not first_iteration else part
+            whole_components = not first_iteration and part.startswith(('/', os.sep))
+            translated_part = part.lstrip('/' + os.sep) if not first_iteration else part
 
             # TODO
             #  if fnmatch.translate accounts for os.sep, we want to strip os.sep, not '/'
@@ -89,13 +101,17 @@ def translate_glob_patterns(patterns: list[str] | None) -> list[str]:
             # fnmatch appends r'\Z' (matches end of string) to the end, so we strip that off the parts
             translated_part = translated_part.rstrip(r'\Z')
 
+            # now we want to combine this into the full pattern again,
+            # '**' should match everything, also past directory borders, so we join with r'.*'
+            # fnmatch wraps patterns in r'(s:<pattern>)', to avoid adding matching groups (?), we just copy that behaviour
+            # if a separator followed the '**', it may only match whole components, including none at all
+            if not first_iteration:
+                translated_parts.append(escape(rf'(?s:.*{os.sep})?') if whole_components else r'(?s:.*)')
+
             # part should have been appropriately translated now
             translated_parts.append(translated_part)
 
-        # now we want to combine this into the full pattern again,
-        # '**' should match everything, also past directory borders, so we join with r'.*'
-        # fnmatch wraps patterns in r'(s:<pattern>)', to avoid adding matching groups (?), we just copy that behaviour
-        translated_pattern = r'(?s:.*)'.join(translated_parts)
+        translated_pattern = ''.join(translated_parts)
 
         # since we want to exclude longer matches, but have a trailing seperator be optional for matching directories,
         # we append rf'{os.sep}?' to the pattern, to optionally match a single seperator
@@ -131,24 +147,552 @@ def compile_glob_patterns(patterns: list[str] | None, regex_flags: list[re.Regex
     # so now there is a dedicated function translate_glob_patterns
 
     translated_patterns = translate_glob_patterns(patterns)
-    # TODO remove after debug
-    print(translated_patterns)
     compiled_patterns = [re.compile(translated_pattern, flags=flags) for translated_pattern in translated_patterns]
 
     return compiled_patterns
 
 
+def compile_combined_glob_pattern(patterns: list[str] | None,
+                                  regex_flags: list[re.RegexFlag] = None) -> re.Pattern | None:
+    """
+    Take a list of glob-style patterns and compile them into a single regex, that matches if any of them matches.
+    Checking a path against the combined regex costs a single search call, no matter how many patterns there are.
+    The alternatives are named p0, p1, ... after the index of their pattern, so match.lastgroup tells which one matched.
+
+    :param patterns: list of glob-style patterns to convert to a regex
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into the regex
+    :return: compiled regex, corresponding to the alternation of the passed glob style patterns, None if there are none
+    """
+    if not patterns:
+        return None
+
+    flags = reduce(lambda x, y: x | y, regex_flags) if regex_flags is not None else 0
+
+    # each translated pattern is anchored at the end by itself, so we only need to group them
+    # the named group closes after any group fnmatch put inside, so it is the last one
+    translated_patterns = translate_glob_patterns(patterns)
+    combined_pattern = '|'.join(f'(?P<p{i}>{translated_pattern})'
+                                for i, translated_pattern in enumerate(translated_patterns))
+
+    return re.compile(combined_pattern, flags=flags)
+
+
+def read_gitignore(dirpath: str | os.PathLike) -> list[tuple[str, bool]]:
+    """
+    Read the .gitignore file in a directory, and translate its rules into absolute glob patterns.
+    See also https://git-scm.com/docs/gitignore
+
+    :param dirpath: directory containing the .gitignore file
+    :return: list of tuples of glob pattern and whether the rule is negated, i.e. re-includes matches, in file order
+    """
+    rules = []
+    with Path(dirpath, '.gitignore').open() as ignore_file:
+        for line in ignore_file:
+            # ignore empty lines and comments
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+
+            # a leading '!' negates the rule, a leading backslash escapes a literal '!' or '#'
+            negated = line.startswith('!')
+            if negated or line.startswith(('\\!', '\\#')):
+                line = line[1:]
+
+            rules.append((gitignore_to_glob_pattern(str(dirpath), line), negated))
+
+    return rules
+
+
+class GitignoreScope:
+    """
+    The gitignore rules that apply within a directory, i.e. those of its own and its ancestors .gitignore files.
+
+    Scopes are immutable, entering a directory with a .gitignore creates a child scope, and leaving it drops that,
+    so entries are only ever matched against the rules of their own ancestors.
+    Like with git, deeper rules take precedence over shallower ones, and later rules over earlier ones in a file.
+    Dir only rules (trailing slash) need paths of directories to be passed with a trailing separator.
+    """
+
+    __slots__ = ('rules', 'pattern', 'negated')
+
+    def __init__(self, rules: tuple[tuple[str, bool], ...] = (), regex_flags: list[re.RegexFlag] = None):
+        """
+        :param rules: tuples of absolute glob pattern and whether the rule is negated, in order of increasing precedence
+        :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into the regex
+        """
+        self.rules = rules
+        self.negated = [negated for _, negated in rules]
+        self.pattern = None
+
+        if rules:
+            flags = reduce(lambda x, y: x | y, regex_flags) if regex_flags is not None else 0
+            translated_patterns = translate_glob_patterns([glob_pattern for glob_pattern, _ in rules])
+            # rules are absolute, so all alternatives are anchored at the start, and the first one that matches wins
+            # we put the rule with the highest precedence first, and name the groups to find out which one matched
+            self.pattern = re.compile('|'.join(f'(?P<r{i}>{translated_pattern})'
+                                               for i, translated_pattern in reversed(list(enumerate(translated_patterns)))),
+                                      flags=flags)
+
+    def push(self, rules: list[tuple[str, bool]], regex_flags: list[re.RegexFlag] = None) -> 'GitignoreScope':
+        """
+        Create the scope of a subdirectory, that adds rules of its own.
+
+        :param rules: the rules of the subdirectory, see read_gitignore
+        :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into the regex
+        :return: the new scope, or this one if there are no new rules
+        """
+        return GitignoreScope(self.rules + tuple(rules), regex_flags) if rules else self
+
+    def is_ignored(self, path: str) -> bool:
+        """
+        Check whether a path is ignored, costs a single match call.
+
+        :param path: absolute path, with a trailing separator for directories
+        :return: whether the deciding rule ignores the path
+        """
+        if self.pattern is None:
+            return False
+
+        match = self.pattern.match(path)
+        # the named group closes after any group fnmatch put inside, so it is the last one
+        return match is not None and not self.negated[int(match.lastgroup[1:])]
+
+
+class FileEntry(NamedTuple):
+    """
+    Light record of a file tree entry, filled from the data os.scandir already fetched,
+    so consumers don't have to stat the path again.
+    Type flags don't follow symlinks, a symlink is neither a file nor a directory.
+    Size, modification time and device are None, if the entry was created without stat info.
+    """
+    path: Path
+    is_dir: bool
+    is_file: bool
+    is_symlink: bool
+    size: int | None
+    mtime_ns: int | None
+    inode: int | None
+    dev: int | None
+
+    @classmethod
+    def from_stat(cls, path: Path, stat_result: os.stat_result) -> 'FileEntry':
+        """
+        Create an entry from a path and a stat result for it.
+
+        :param path: path of the entry
+        :param stat_result: result of os.stat or os.lstat on the path
+        :return: the corresponding entry
+        """
+        mode = stat_result.st_mode
+        return cls(path=path,
+                   is_dir=stat.S_ISDIR(mode),
+                   is_file=stat.S_ISREG(mode),
+                   is_symlink=stat.S_ISLNK(mode),
+                   size=stat_result.st_size,
+                   mtime_ns=stat_result.st_mtime_ns,
+                   inode=stat_result.st_ino,
+                   dev=stat_result.st_dev)
+
+    @classmethod
+    def from_path(cls, path: str | bytes | os.PathLike | Path, follow_symlinks: bool = True) -> 'FileEntry':
+        """
+        Create an entry by calling stat on a path.
+
+        :param path: path of the entry
+        :param follow_symlinks: whether to describe the target of a symlink instead of the link itself
+        :return: the corresponding entry
+        """
+        path = Path(path)
+        return cls.from_stat(path, path.stat() if follow_symlinks else path.lstat())
+
+    @classmethod
+    def from_dir_entry(cls, dir_entry: os.DirEntry, with_stat: bool = True) -> 'FileEntry':
+        """
+        Create an entry from a DirEntry produced by os.scandir.
+
+        :param dir_entry: the DirEntry
+        :param with_stat: whether to fill in size, modification time and device,
+                          this costs an lstat call per entry on POSIX systems, but is free on Windows
+        :return: the corresponding entry
+        """
+        if with_stat:
+            return cls.from_stat(Path(dir_entry.path), dir_entry.stat(follow_symlinks=False))
+
+        # type flags and inode number come with the directory listing on POSIX systems
+        return cls(path=Path(dir_entry.path),
+                   is_dir=dir_entry.is_dir(follow_symlinks=False),
+                   is_file=dir_entry.is_file(follow_symlinks=False),
+                   is_symlink=dir_entry.is_symlink(),
+                   size=None,
+                   mtime_ns=None,
+                   inode=dir_entry.inode(),
+                   dev=None)
+
+
+def scan_directory(dirpath: str,
+                   gitignore_scope: GitignoreScope,
+                   regard_pattern: re.Pattern | None = None,
+                   regard_patterns_concern_dirs: bool = False,
+                   ignore_pattern: re.Pattern | None = None,
+                   include_gitignore: bool = False,
+                   regex_flags: list[re.RegexFlag] = None,
+                   with_stat: bool = True,
+                   excluded_paths: frozenset[str] = frozenset(),
+                   ignore_patterns: list[str] = None) -> tuple[list[FileEntry], list[tuple[str, GitignoreScope]]]:
+    """
+    List a single directory and apply the traversal rules to its contents, see iter_file_entries.
+    This is the unit of work of a walk, it only depends on its arguments, so directories can be scanned concurrently.
+
+    :param dirpath: directory to list
+    :param gitignore_scope: the gitignore rules of the ancestors of the directory
+    :param regard_pattern: combined regard pattern, see compile_combined_glob_pattern
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_pattern: combined ignore pattern, see compile_combined_glob_pattern
+    :param include_gitignore: whether to respect a .gitignore file in the directory
+    :param regex_flags: list of regex flags, used to compile gitignore rules
+    :param with_stat: whether entries should carry size, modification time and device, see FileEntry.from_dir_entry
+    :param excluded_paths: set of absolute paths of files or directories to exclude, as strings
+    :param ignore_patterns: the glob patterns ignore_pattern was compiled from, only used to name them in stats
+    :return: tuple of the entries that were not ignored, and the subdirs to descend into along with their scope
+    """
+
+    # unreadable directories are skipped, just like os.walk does by default
+    try:
+        with os.scandir(dirpath) as scandir_iterator:
+            dir_entries = {dir_entry.name: dir_entry for dir_entry in scandir_iterator}
+    except OSError:
+        stats.count('walk:unreadable_dirs')
+        return [], []
+
+    stats.count('walk:dirs_listed')
+    stats.count('walk:entries_listed', len(dir_entries))
+    collecting = stats.is_collecting()
+
+    # symlinks to directories count as directories, like with os.walk, they are just not descended into
+    dirnames, filenames = [], []
+    for name, dir_entry in dir_entries.items():
+        try:
+            is_dir = dir_entry.is_dir()
+        except OSError:
+            is_dir = False
+        (dirnames if is_dir else filenames).append(name)
+
+    # if include_gitignore is set and a .gitignore file is found, its rules apply to this dir and everything
+    # below it, the new patterns only match under this dir, because dirpath is prepended to them
+    if include_gitignore and '.gitignore' in filenames:
+        gitignore_scope = gitignore_scope.push(read_gitignore(dirpath), regex_flags)
+
+    # exclude files that don't match any regard pattern, if there are regard patterns
+    if regard_pattern is not None:
+        listed = len(dirnames) + len(filenames)
+
+        # match against the unresolved file name
+        filenames = [filename for filename in filenames if regard_pattern.search(filename)]
+
+        if regard_patterns_concern_dirs:
+            # do the same thing for directories, dirs need trailing slash
+            dirnames = [dirname for dirname in dirnames if regard_pattern.search(dirname + os.sep)]
+
+        stats.count('walk:pruned:regard', listed - len(dirnames) - len(filenames))
+
+    # exclude files and dirs that match any ignore pattern
+    if ignore_pattern is not None:
+        if collecting:
+            count_pruned_by_pattern(dirpath, dirnames, filenames, ignore_pattern.search,
+                                    lambda i: f'walk:pruned:ignore:{ignore_patterns[i] if ignore_patterns else i}')
+
+        # match against the unresolved path, dirs need trailing slash
+        dirnames = [dirname for dirname in dirnames
+                    if not ignore_pattern.search(os.path.join(dirpath, dirname) + os.sep)]
+        filenames = [filename for filename in filenames
+                     if not ignore_pattern.search(os.path.join(dirpath, filename))]
+
+    # exclude specific paths, a set lookup per entry costs the same, no matter how many paths are excluded
+    if excluded_paths:
+        listed = len(dirnames) + len(filenames)
+        dirnames = [dirname for dirname in dirnames if os.path.join(dirpath, dirname) not in excluded_paths]
+        filenames = [filename for filename in filenames if os.path.join(dirpath, filename) not in excluded_paths]
+        stats.count('walk:pruned:excluded', listed - len(dirnames) - len(filenames))
+
+    # exclude files and dirs that are ignored by the gitignore rules of their ancestors
+    if gitignore_scope.pattern is not None:
+        if collecting:
+            # negated rules that decide an entry keep it, so only ignoring ones are counted
+            count_pruned_by_pattern(dirpath, dirnames, filenames, gitignore_scope.pattern.match,
+                                    lambda i: None if gitignore_scope.negated[i]
+                                    else f'walk:pruned:gitignore:{gitignore_scope.rules[i][0]}')
+
+        dirnames = [dirname for dirname in dirnames
+                    if not gitignore_scope.is_ignored(os.path.join(dirpath, dirname) + os.sep)]
+        filenames = [filename for filename in filenames
+                     if not gitignore_scope.is_ignored(os.path.join(dirpath, filename))]
+
+    # collect the entries that have not been ignored
+    entries, subdirs = [], []
+    for name in dirnames + filenames:
+        # entries can vanish between listing and stat
+        try:
+            entry = FileEntry.from_dir_entry(dir_entries[name], with_stat=with_stat)
+        except OSError:
+            continue
+
+        entries.append(entry)
+
+        # symlinked dirs are not descended into
+        if entry.is_dir:
+            subdirs.append((dir_entries[name].path, gitignore_scope))
+
+    return entries, subdirs
+
+
+def count_pruned_by_pattern(dirpath: str,
+                            dirnames: list[str],
+                            filenames: list[str],
+                            match: Callable[[str], re.Match | None],
+                            counter_name: Callable[[int], str | None]):
+    """
+    Count the entries of a directory that a combined pattern matches, by the alternative that matched them.
+    This matches every entry once more, so it is only done while stats are collected.
+
+    :param dirpath: the directory
+    :param dirnames: names of its subdirectories
+    :param filenames: names of everything else in it
+    :param match: search or match method of the combined pattern, with alternatives named by their index
+    :param counter_name: function taking the index of the alternative and returning the name of its counter,
+                         or None if matches of that alternative don't prune anything
+    """
+    paths = [os.path.join(dirpath, dirname) + os.sep for dirname in dirnames]
+    paths.extend(os.path.join(dirpath, filename) for filename in filenames)
+
+    for path in paths:
+        matched = match(path)
+        if matched is not None and (name := counter_name(int(matched.lastgroup[1:]))) is not None:
+            stats.count(name)
+
+
+def compile_directory_scan(regard_patterns: list[str] = None,
+                           regard_patterns_concern_dirs: bool = False,
+                           ignore_patterns: list[str] = None,
+                           include_gitignore: bool = False,
+                           regex_flags: list[re.RegexFlag] = None,
+                           with_stat: bool = True,
+                           excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None
+                           ) -> Callable[[str, GitignoreScope], tuple[list[FileEntry], list]]:
+    """
+    Compile the traversal rules into the unit of work of a walk, see scan_directory.
+    Every kind of walk scans with this, so they all apply the same rules.
+    Parameters correspond to the ones for iter_file_entries.
+
+    :return: scan_directory, with everything but the directory and its gitignore scope applied
+    """
+    # regard and ignore patterns are assumed to be glob/fnmatch style strings
+    # we translate them to regexes and combine them into one regex each, compiled with the appropriate regex flags
+    return functools.partial(scan_directory,
+                             regard_pattern=compile_combined_glob_pattern(regard_patterns, regex_flags),
+                             regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                             ignore_pattern=compile_combined_glob_pattern(ignore_patterns, regex_flags),
+                             include_gitignore=include_gitignore,
+                             regex_flags=regex_flags,
+                             with_stat=with_stat,
+                             excluded_paths=frozenset(str(Path(path).resolve()) for path in excluded_paths or ()),
+                             ignore_patterns=ignore_patterns)
+
+
+def iter_file_entries(root: str | bytes | os.PathLike | Path,
+                      regard_patterns: list[str] = None,
+                      regard_patterns_concern_dirs: bool = False,
+                      ignore_patterns: list[str] = None,
+                      include_gitignore: bool = False,
+                      regex_flags: list[re.RegexFlag] = None,
+                      with_stat: bool = True,
+                      workers: int = 1,
+                      excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> Iterator[FileEntry]:
+    """
+    Lazily traverse a file tree according to specified parameters, see traverse_file_tree.
+    Entries are yielded as soon as their directory has been listed, so consumers can start working during the walk.
+    Entry paths are absolute, but symlinks are not resolved, and symlinked directories are not descended into.
+
+    With more than one worker, directories are listed by a pool of threads, that take them from a shared queue.
+    This helps on network filesystems, where listing a directory mostly means waiting on round trips.
+    The entries are the same as with a single worker, but they are yielded in no particular order.
+
+    :param root: directory under which to start
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param with_stat: whether entries should carry size, modification time and device, see FileEntry.from_dir_entry
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :return: iterator over entries for all paths under root in accordance with the passed rules
+    """
+
+    # resolve the starting point, symlinks are not followed, so paths below it stay resolved
+    root = Path(root).resolve()
+
+    # guard against non-directory starting points
+    if not root.is_dir():
+        raise NotADirectoryError(f'{root} is not a directory')
+
+    scan = compile_directory_scan(regard_patterns=regard_patterns,
+                                  regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                  ignore_patterns=ignore_patterns,
+                                  include_gitignore=include_gitignore,
+                                  regex_flags=regex_flags,
+                                  with_stat=with_stat,
+                                  excluded_paths=excluded_paths)
+
+    if workers > 1:
+        yield from iter_scanned_entries_concurrently(scan, str(root), workers)
+        return
+
+    # directories that still have to be listed, popped from the end for a depth first walk
+    # each one comes with the gitignore scope of its parent, so leaving a directory drops its rules
+    stack = [(str(root), GitignoreScope())]
+
+    # iterate over the file tree
+    while stack:
+        entries, subdirs = scan(*stack.pop())
+        yield from entries
+
+        # the last pushed dir is popped first, so we push in reverse to descend in listing order
+        stack.extend(reversed(subdirs))
+
+
+def distinct_roots(roots: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path]) -> list[Path]:
+    """
+    Resolve the starting points of a walk over several trees, dropping those that lie within another one,
+    so no entry is walked twice.
+
+    :param roots: a directory, or several
+    :return: the resolved directories, sorted, none of them below another
+    """
+    if isinstance(roots, (str, bytes, os.PathLike)):
+        roots = [roots]
+
+    distinct: list[Path] = []
+    # sorted, an ancestor always comes before its descendants
+    for root in sorted({Path(os.fsdecode(root)).resolve() for root in roots}):
+        if not distinct or not root.is_relative_to(distinct[-1]):
+            distinct.append(root)
+
+    return distinct
+
+
+def iter_entries_under_roots(roots: str | bytes | os.PathLike | Path | Iterable[str | bytes | os.PathLike | Path],
+                             regard_patterns: list[str] = None,
+                             regard_patterns_concern_dirs: bool = False,
+                             ignore_patterns: list[str] = None,
+                             include_gitignore: bool = False,
+                             regex_flags: list[re.RegexFlag] = None,
+                             with_stat: bool = True,
+                             workers: int = 1,
+                             excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> Iterator[FileEntry]:
+    """
+    Traverse several file trees one after another, see iter_file_entries, whose parameters these are.
+    Roots that lie within another root are skipped, see distinct_roots.
+
+    :param roots: a directory, or several, under which to start
+    :return: iterator over entries for all paths under the roots in accordance with the passed rules
+    """
+    roots = distinct_roots(roots)
+
+    # fail before walking anything, not after the first few trees
+    for root in roots:
+        if not root.is_dir():
+            raise NotADirectoryError(f'{root} is not a directory')
+
+    for root in roots:
+        yield from iter_file_entries(root,
+                                     regard_patterns=regard_patterns,
+                                     regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                     ignore_patterns=ignore_patterns,
+                                     include_gitignore=include_gitignore,
+                                     regex_flags=regex_flags,
+                                     with_stat=with_stat,
+                                     workers=workers,
+                                     excluded_paths=excluded_paths)
+
+
+def iter_scanned_entries_concurrently(scan: Callable[[str, GitignoreScope], tuple[list[FileEntry], list]],
+                                      root: str,
+                                      workers: int) -> Iterator[FileEntry]:
+    """
+    Walk a file tree by scanning directories in a thread pool, see iter_file_entries.
+
+    :param scan: scan_directory, with everything but the directory and its gitignore scope applied
+    :param root: directory under which to start
+    :param workers: how many threads to list directories with
+    :return: iterator over entries in no particular order
+    """
+    # concurrent.futures pulls in logging and threading, single threaded walks don't need to pay for that on startup
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {executor.submit(scan, root, GitignoreScope())}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                # queue up the subdirs before yielding, so the workers don't idle while the consumer works
+                pending.update(executor.submit(scan, *subdir) for subdir in subdirs)
+                yield from entries
+    finally:
+        # if the consumer stops early, there is no need to finish the walk
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_file_tree(root: str | bytes | os.PathLike | Path,
+                   regard_patterns: list[str] = None,
+                   regard_patterns_concern_dirs: bool = False,
+                   ignore_patterns: list[str] = None,
+                   include_gitignore: bool = False,
+                   regex_flags: list[re.RegexFlag] = None,
+                   workers: int = 1,
+                   excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> Iterator[Path]:
+    """
+    Lazily traverse a file tree according to specified parameters, see iter_file_entries and traverse_file_tree.
+    Yielded paths are absolute, but symlinks are not resolved.
+
+    :param root: directory under which to start
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :return: iterator over all paths under root in accordance with the passed rules
+    """
+    # paths alone don't need stat info
+    for entry in iter_file_entries(root=root,
+                                   regard_patterns=regard_patterns,
+                                   regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                   ignore_patterns=ignore_patterns,
+                                   include_gitignore=include_gitignore,
+                                   regex_flags=regex_flags,
+                                   with_stat=False,
+                                   workers=workers,
+                                   excluded_paths=excluded_paths):
+        yield entry.path
+
+
 def traverse_file_tree(root: str | bytes | os.PathLike | Path,
                        regard_patterns: list[str] = None,
                        regard_patterns_concern_dirs: bool = False,
                        ignore_patterns: list[str] = None,
                        include_gitignore: bool = False,
-                       regex_flags: list[re.RegexFlag] = None) -> set[Path]:
+                       regex_flags: list[re.RegexFlag] = None,
+                       workers: int = 1,
+                       excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> set[Path]:
     """
     Traverse a file tree according to specified parameters.
     Returns fully resolved paths.
-    Beware, gitignore inclusions has strict limitations with regard to supported patterns.
-    So far no negation is possible.
+    Rules of .gitignore files only apply under their own directory, negation with '!' and dir only rules are supported.
+
+    Prefer iter_file_tree for large trees, this collects the whole tree in memory before returning.
 
     :param root: directory under which to start
     :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
@@ -156,94 +700,145 @@ def traverse_file_tree(root: str | bytes | os.PathLike | Path,
     :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
     :param include_gitignore: whether to include .gitignore files in the ignore_patterns
     :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
     :return: the set of all paths under root in accordance with the passed rules
     """
+    return {path.resolve() for path in iter_file_tree(root=root,
+                                                      regard_patterns=regard_patterns,
+                                                      regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                                      ignore_patterns=ignore_patterns,
+                                                      include_gitignore=include_gitignore,
+                                                      regex_flags=regex_flags,
+                                                      workers=workers,
+                                                      excluded_paths=excluded_paths)}
 
-    # resolve the starting point
-    root = Path(root).resolve()
 
-    # guard against non-directory starting points
-    if not root.is_dir():
-        raise NotADirectoryError(f'{root} is not a directory')
+class Visitor:
+    """
+    An analysis that runs during a walk, see visit_file_tree.
+    Subclasses override visit, which is called with every entry of the walk, and result, which is called after it.
+    Visitors are called in the thread that consumes the walk, so they don't need to be thread safe.
+    """
 
-    # initialize the result set
-    paths = set()
+    # whether entries need size, modification time and device, if no visitor does, the walk skips the stat calls
+    needs_stat: bool = False
 
-    # regard and ignore patterns are assumed to be glob/fnmatch style strings
-    # we translate them to regexes and compile them with the appropriate regex flags
-    regard_patterns: list[re.Pattern] = compile_glob_patterns(regard_patterns, regex_flags)
-    ignore_patterns: list[re.Pattern] = compile_glob_patterns(ignore_patterns, regex_flags)
+    def visit(self, entry: FileEntry):
+        """
+        Look at a single entry of the walk.
 
-    # iterate over the file tree
-    for (dirpath, dirnames, filenames) in os.walk(root):
-        # lists must be modified in place
-
-        # if include_gitignore is set and a .gitignore file is found, include
-        # its contents in our ignore patterns, we ensure that the new patterns
-        # only match under this dir by prepending dirpath to them
-        # see also https://git-scm.com/docs/gitignore
-        if include_gitignore and '.gitignore' in filenames:
-            with Path(dirpath, '.gitignore').open() as ignore_file:
-                new_patterns = []
-                for line in ignore_file:
-                    # contrary to normal gitignore interpretation rules (as far as I understand them),
-                    # we will ONLY MATCH UNDER the current dir, and not up to the repository root
-                    # also NO UNIGNORING PATHS with '!' is possible
-
-                    # ignore empty lines and comments
-                    line = line.strip()
-                    if line == '' or line.startswith('#'):
-                        continue
-
-                    new_pattern = gitignore_to_glob_pattern(dirpath, line)
-                    new_patterns.append(new_pattern)
-
-            ignore_patterns.extend(compile_glob_patterns(new_patterns, regex_flags))
-
-        # exclude files don't match any regard pattern, if there are regard patterns
-        if regard_patterns:
-            # regard patterns don't concern directories
-            # get files that do not match any regard pattern
-            files_to_remove = []
-            for filename in filenames:
-                # match against the unresolved file name and mark it for removal
-                if not any([pattern.search(filename) for pattern in regard_patterns]):
-                    files_to_remove.append(filename)
-
-            # remove those files
-            for filename in files_to_remove: filenames.remove(filename)
-
-            # this might be a pretty roundabout way of doing it, but editing lists while you are
-            # iterating over them is almost never a good idea, and seldom necessary, so I don't
-
-            if regard_patterns_concern_dirs:
-                # TODO this logic should probably be extracted to a separate function
-                #   removing stuff from a list in this fashion happens four times in here
-                # do the same thing for directories
-                dirs_to_remove = []
-                for dirname in dirnames:
-                    # match against the unresolved dir name  and mark it for removal
-                    # dirs need trailing slash
-                    if not any([pattern.search(dirname + os.sep) for pattern in regard_patterns]):
-                        dirs_to_remove.append(dirname)
-
-                # remove those dirs
-                for dirname in dirs_to_remove: dirnames.remove(dirname)
-
-        # exclude files and dirs that match any ignore pattern
-        for ignore_pattern in ignore_patterns:
-            # match against the unresolved dir name  and mark it for removal
-            # dirs need trailing slash
-            dirs_to_remove = [dirname for dirname in dirnames
-                              if ignore_pattern.search(os.path.join(dirpath, dirname) + os.sep)]
-
-            files_to_remove = [filename for filename in filenames
-                               if ignore_pattern.search(os.path.join(dirpath, filename))]
-
-            for dirname in dirs_to_remove: dirnames.remove(dirname)
-            for filename in files_to_remove: filenames.remove(filename)
-
-        # include the paths that have not been ignored
-        paths.update([Path(dirpath, fn).resolve() for fn in dirnames + filenames])
-
-    return paths
+        :param entry: the entry, with stat info if needs_stat is set
+        """
+        raise NotImplementedError
+
+    def result(self):
+        """
+        Finish the analysis, once the walk is done.
+
+        :return: the result of the analysis
+        """
+        raise NotImplementedError
+
+
+class SizeHistogramVisitor(Visitor):
+    """
+    Counts regular files and their bytes by size class.
+    Class n holds files of 2 ** (n - 1) up to 2 ** n - 1 bytes, empty files are in class 0.
+    """
+
+    needs_stat = True
+
+    def __init__(self):
+        self.counts: dict[int, int] = defaultdict(int)
+        self.sizes: dict[int, int] = defaultdict(int)
+
+    def visit(self, entry: FileEntry):
+        if entry.is_file:
+            size_class = entry.size.bit_length()
+            self.counts[size_class] += 1
+            self.sizes[size_class] += entry.size
+
+    def result(self) -> dict[int, tuple[int, int]]:
+        """
+        :return: map of size classes to tuples of the number of files and their total size, ordered by size class
+        """
+        return {size_class: (self.counts[size_class], self.sizes[size_class]) for size_class in sorted(self.counts)}
+
+
+def visit_file_tree(root: str | bytes | os.PathLike | Path,
+                    visitors: Iterable[Visitor],
+                    regard_patterns: list[str] = None,
+                    regard_patterns_concern_dirs: bool = False,
+                    ignore_patterns: list[str] = None,
+                    include_gitignore: bool = False,
+                    regex_flags: list[re.RegexFlag] = None,
+                    workers: int = 1,
+                    excluded_paths: Iterable[str | bytes | os.PathLike | Path] = None) -> list:
+    """
+    Run several analyses in a single walk of a file tree, see iter_file_entries.
+    Every entry is created once from the data os.scandir fetched, and handed to all visitors in turn,
+    so e.g. a naming audit and a hash collection don't have to walk the tree twice.
+
+    :param root: directory under which to start
+    :param visitors: the analyses to run, see Visitor
+    :param regard_patterns: list of glob style patterns of files to include in the results, if set others are ignored
+    :param regard_patterns_concern_dirs: whether regard_patterns concern directories as well
+    :param ignore_patterns: list of glob style patterns of files or directories to exclude from the results
+    :param include_gitignore: whether to include .gitignore files in the ignore_patterns
+    :param regex_flags: list of regex flags, will be reduced to a single flag and compiled into regexes
+    :param workers: how many threads to list directories with
+    :param excluded_paths: files or directories to exclude, they are resolved, so they only match resolved paths
+    :return: list of the results of the visitors, in the order they were passed
+    """
+    visitors = list(visitors)
+
+    # bind the methods once, instead of looking them up for every entry
+    visits = [visitor.visit for visitor in visitors]
+    for entry in iter_file_entries(root=root,
+                                   regard_patterns=regard_patterns,
+                                   regard_patterns_concern_dirs=regard_patterns_concern_dirs,
+                                   ignore_patterns=ignore_patterns,
+                                   include_gitignore=include_gitignore,
+                                   regex_flags=regex_flags,
+                                   with_stat=any(visitor.needs_stat for visitor in visitors),
+                                   workers=workers,
+                                   excluded_paths=excluded_paths):
+        for visit in visits:
+            visit(entry)
+
+    return [visitor.result() for visitor in visitors]
+
+
+def parse_args(args: list[str] = None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Prints paths under a directory, one per line')
+
+    parser.add_argument('path', nargs='?', type=Path, default=os.getcwd(),
+                        help='the path under which to search, defaults to cwd')
+    parser.add_argument('-r', '--regard', nargs='+', help='only consider files matching these glob patterns')
+    parser.add_argument('-i', '--ignore', nargs='+', help='ignore files and dirs matching these glob patterns')
+    parser.add_argument('-g', '--gitignore', action='store_true', help='respect .gitignore files')
+    parser.add_argument('-e', '--excluded', nargs='+', type=Path, help='exclude these paths')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='how many threads to list directories with, helps on network filesystems')
+
+    return parser.parse_args(args)
+
+
+def main(args: list[str] = None):
+    args = parse_args(args)
+
+    for path in iter_file_tree(args.path,
+                               regard_patterns=args.regard,
+                               ignore_patterns=args.ignore,
+                               include_gitignore=args.gitignore,
+                               workers=args.workers,
+                               excluded_paths=args.excluded):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from util.aio import HASHED, LISTED, ahash_map, atraverse
+from util.cache import HashCache
+from util.hashing import get_dir_hash_map
+from util.traversal import iter_file_entries
+
+
+async def collect(walk) -> list:
+    return [entry async for entry in walk]
+
+
+def make_tree(root, dirs: int = 10, files: int = 5):
+    for i in range(dirs):
+        directory = root / f'dir{i}'
+        directory.mkdir()
+        for j in range(files):
+            (directory / f'file{j}').write_bytes(f'{i % 3} {j}'.encode())
+
+
+class TestATraverse:
+    def test_yields_same_entries_as_iter_file_entries(self, file_tree_with_gitignore):
+        options = dict(include_gitignore=True, ignore_patterns=['*another*'])
+        entries = asyncio.run(collect(atraverse(file_tree_with_gitignore, **options)))
+        assert sorted(entries) == sorted(iter_file_entries(file_tree_with_gitignore, **options))
+
+    def test_backpressure_pauses_listing(self, tmp_path):
+        make_tree(tmp_path, dirs=50, files=1)
+        listed = []
+
+        async def consume_one():
+            walk = atraverse(tmp_path, concurrency=2, max_pending=1, progress=listed.append)
+            await anext(walk)
+            # give the listers plenty of time, they should wait on the consumer anyway
+            await asyncio.sleep(0.2)
+            await walk.aclose()
+
+        asyncio.run(consume_one())
+        # the one being consumed, the one waiting, and one per lister that waits to hand over its directory
+        assert len(listed) <= 4
+        assert all(event.event == LISTED for event in listed)
+
+    def test_leaving_early_stops_listing(self, tmp_path):
+        make_tree(tmp_path, dirs=50, files=1)
+        listed = []
+
+        async def take_first():
+            walk = atraverse(tmp_path, max_pending=1, progress=listed.append)
+            async for _ in walk:
+                break
+            await walk.aclose()
+            count = len(listed)
+            await asyncio.sleep(0.1)
+            return count
+
+        assert asyncio.run(take_first()) == len(listed)
+
+    def test_root_must_be_a_directory(self, tmp_path):
+        (tmp_path / 'file').touch()
+        with pytest.raises(NotADirectoryError):
+            asyncio.run(collect(atraverse(tmp_path / 'file')))
+
+
+class TestAHashMap:
+    def test_same_hashes_as_get_dir_hash_map(self, tmp_path):
+        make_tree(tmp_path)
+        hash_map = asyncio.run(ahash_map(tmp_path, hash_concurrency=3))
+        expected = get_dir_hash_map(tmp_path)
+        assert {file_hash: sorted(paths) for file_hash, paths in hash_map.items()} \
+            == {file_hash: sorted(paths) for file_hash, paths in expected.items()}
+
+    def test_reports_progress(self, tmp_path):
+        make_tree(tmp_path, dirs=3, files=2)
+        events = []
+        asyncio.run(ahash_map(tmp_path, progress=events.append))
+
+        assert [event.event for event in events].count(LISTED) == 4
+        hashed = [event for event in events if event.event == HASHED]
+        assert len(hashed) == 6
+        assert hashed[-1].files == 6 and hashed[-1].bytes == 6 * 3
+
+    def test_uses_the_cache(self, tmp_path):
+        make_tree(tmp_path, dirs=2, files=2)
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            first = asyncio.run(ahash_map(tmp_path, ignore_patterns=['cache.sqlite*'], cache=cache))
+            events = []
+            second = asyncio.run(ahash_map(tmp_path, ignore_patterns=['cache.sqlite*'], cache=cache,
+                                           progress=events.append))
+
+        assert {file_hash: sorted(paths) for file_hash, paths in first.items()} \
+            == {file_hash: sorted(paths) for file_hash, paths in second.items()}
+        assert not [event for event in events if event.event == HASHED]
+
+    def test_cancellation(self, tmp_path):
+        make_tree(tmp_path, dirs=20, files=20)
+
+        async def cancel_soon():
+            task = asyncio.create_task(ahash_map(tmp_path, hash_concurrency=2, max_pending=1))
+            await asyncio.sleep(0)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_soon())
+
+    def test_unknown_algorithm_raises(self, tmp_path):
+        make_tree(tmp_path, dirs=1, files=1)
+        with pytest.raises(ValueError):
+            asyncio.run(ahash_map(tmp_path, name='no such algorithm'))
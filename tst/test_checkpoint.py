@@ -0,0 +1,114 @@
+import pytest
+
+from util import duplicates
+from util.cache import HashCache
+from util.checkpoint import ScanCheckpoint, iter_checkpointed_entries
+from util.duplicates import get_duplicate_map
+from util.hashing import get_dir_hash_map
+from util.traversal import iter_file_entries
+
+
+def make_tree(root, dirs: int = 10, files: int = 5):
+    for i in range(dirs):
+        directory = root / 'tree' / f'dir{i}' / 'sub'
+        directory.mkdir(parents=True)
+        for j in range(files):
+            (directory / f'file{j}').write_bytes(f'{i % 3} {j}'.encode() * 100)
+    return root / 'tree'
+
+
+def interrupt_walk(root, path, stop_after: int, **options):
+    """Walk part of a tree, and leave the checkpoint behind, like a killed run would."""
+    checkpoint = ScanCheckpoint(path, interval=0)
+    walk = iter_checkpointed_entries(root, checkpoint, **options)
+    for _ in range(stop_after):
+        next(walk)
+    walk.close()
+    checkpoint.connection.close()
+
+
+class TestCheckpointedWalk:
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_resumed_walk_yields_every_entry_once(self, tmp_path, workers):
+        root = make_tree(tmp_path)
+        interrupt_walk(root, tmp_path / 'checkpoint', 17, workers=workers)
+
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            _, frontier = checkpoint.read_walk()
+            assert frontier
+            entries = list(iter_checkpointed_entries(root, checkpoint, workers=workers))
+            assert checkpoint.walked
+
+        assert sorted(entries) == sorted(iter_file_entries(root))
+
+    def test_several_roots_are_resumed(self, tmp_path):
+        roots = [make_tree(tmp_path / 'a', dirs=3), make_tree(tmp_path / 'b', dirs=3)]
+        interrupt_walk(roots, tmp_path / 'checkpoint', 5)
+
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            entries = list(iter_checkpointed_entries(roots, checkpoint))
+
+        assert sorted(entries) == sorted(list(iter_file_entries(roots[0])) + list(iter_file_entries(roots[1])))
+
+    def test_gitignore_scopes_survive(self, tmp_path, file_tree_with_gitignore):
+        options = dict(include_gitignore=True)
+        interrupt_walk(file_tree_with_gitignore, tmp_path / 'checkpoint', 2, **options)
+
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            entries = list(iter_checkpointed_entries(file_tree_with_gitignore, checkpoint, **options))
+
+        assert sorted(entries) == sorted(iter_file_entries(file_tree_with_gitignore, **options))
+
+    def test_finished_walk_is_not_listed_again(self, tmp_path, monkeypatch):
+        root = make_tree(tmp_path, dirs=2)
+        with ScanCheckpoint(tmp_path / 'checkpoint') as checkpoint:
+            expected = list(iter_checkpointed_entries(root, checkpoint))
+
+        monkeypatch.setattr('os.scandir', None)
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            assert list(iter_checkpointed_entries(root, checkpoint)) == expected
+
+    def test_other_options_can_not_be_resumed(self, tmp_path):
+        root = make_tree(tmp_path, dirs=2)
+        interrupt_walk(root, tmp_path / 'checkpoint', 1)
+
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            with pytest.raises(ValueError):
+                next(iter_checkpointed_entries(root, checkpoint, ignore_patterns=['*file0']))
+
+    def test_checkpoint_is_started_over_unless_resumed(self, tmp_path):
+        root = make_tree(tmp_path, dirs=2)
+        interrupt_walk(root, tmp_path / 'checkpoint', 1)
+
+        with ScanCheckpoint(tmp_path / 'checkpoint') as checkpoint:
+            assert checkpoint.read_walk() == ([], [])
+            assert not checkpoint.walked
+
+
+class TestCheckpointedHashing:
+    def test_resumed_scan_does_not_hash_again(self, tmp_path, monkeypatch):
+        root = make_tree(tmp_path)
+        with ScanCheckpoint(tmp_path / 'checkpoint') as checkpoint:
+            expected = get_duplicate_map(root, checkpoint=checkpoint, partial_size=16)
+
+        def fail(*args, **kwargs):
+            raise AssertionError('hashed again')
+
+        monkeypatch.setattr(duplicates, 'get_entry_hash_tuple', fail)
+        monkeypatch.setattr(duplicates, 'get_partial_entry_hash_tuple', fail)
+        with ScanCheckpoint(tmp_path / 'checkpoint', resume=True) as checkpoint:
+            assert get_duplicate_map(root, checkpoint=checkpoint, partial_size=16) == expected
+
+    def test_hashes_are_passed_on_to_the_cache(self, tmp_path):
+        root = make_tree(tmp_path, dirs=2)
+        with HashCache(tmp_path / 'cache') as cache, ScanCheckpoint(tmp_path / 'checkpoint') as checkpoint:
+            hash_map = get_dir_hash_map(root, cache=cache, checkpoint=checkpoint)
+            assert len(cache) == len(checkpoint) == hash_map.file_count
+
+    def test_cli_removes_the_checkpoint_once_done(self, tmp_path, capsys):
+        root = make_tree(tmp_path, dirs=4)
+        with pytest.raises(SystemExit):
+            duplicates.main([str(root), '--no-cache', '--checkpoint', str(tmp_path / 'checkpoint')])
+
+        assert capsys.readouterr().out
+        assert not (tmp_path / 'checkpoint').exists()
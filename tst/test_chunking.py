@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from util import chunking
+from util.chunking import find_candidates_python, find_similar_files, iter_chunks
+
+
+def random_bytes(size: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+class TestIterChunks:
+    def test_chunks_cover_the_file(self, tmp_path):
+        data = random_bytes(300_000, 0)
+        (tmp_path / 'file').write_bytes(data)
+
+        chunks = list(iter_chunks(tmp_path / 'file', min_size=1024, avg_size=4096, max_size=16384))
+        assert sum(chunk.size for chunk in chunks) == len(data)
+        assert all(chunk.offset == sum(other.size for other in chunks[:i]) for i, chunk in enumerate(chunks))
+        assert all(1024 <= chunk.size <= 16384 for chunk in chunks[:-1])
+
+    def test_boundaries_do_not_depend_on_the_block_size(self, tmp_path):
+        (tmp_path / 'file').write_bytes(random_bytes(200_000, 1))
+        options = dict(min_size=512, avg_size=2048, max_size=8192)
+
+        expected = list(iter_chunks(tmp_path / 'file', **options))
+        for block_size in (1000, 4096, 65536):
+            assert list(iter_chunks(tmp_path / 'file', block_size=block_size, **options)) == expected
+
+    def test_runs_without_cut_points_are_cut_at_max_size(self, tmp_path):
+        (tmp_path / 'file').write_bytes(bytes(50_000))
+        sizes = [chunk.size for chunk in iter_chunks(tmp_path / 'file', min_size=1024, avg_size=4096,
+                                                     max_size=8192, block_size=3000)]
+        assert sizes == [8192] * 6 + [50_000 - 6 * 8192]
+
+    def test_insertion_only_changes_nearby_chunks(self, tmp_path):
+        data = random_bytes(500_000, 2)
+        (tmp_path / 'original').write_bytes(data)
+        (tmp_path / 'edited').write_bytes(data[:250_000] + b'inserted' + data[250_000:])
+
+        original = {chunk.digest for chunk in iter_chunks(tmp_path / 'original')}
+        edited = {chunk.digest for chunk in iter_chunks(tmp_path / 'edited')}
+        assert len(original - edited) <= 2 and len(edited - original) <= 2
+
+    def test_chunk_sizes_must_be_ordered(self, tmp_path):
+        (tmp_path / 'file').touch()
+        with pytest.raises(ValueError):
+            list(iter_chunks(tmp_path / 'file', min_size=4096, avg_size=4096))
+
+    def test_numpy_finds_the_same_candidates(self):
+        pytest.importorskip('numpy')
+        data = random_bytes(100_000, 3)
+        for context in (0, 31):
+            assert chunking.find_candidates_numpy(data, context, 1 << 22) \
+                == find_candidates_python(data, context, 1 << 22)
+
+
+class TestFindSimilarFiles:
+    def test_edited_copies_are_similar(self, tmp_path):
+        data = random_bytes(400_000, 4)
+        (tmp_path / 'original').write_bytes(data)
+        (tmp_path / 'edited').write_bytes(data[:100_000] + random_bytes(20_000, 5) + data[100_000:])
+        (tmp_path / 'unrelated').write_bytes(random_bytes(400_000, 6))
+
+        similar = find_similar_files(tmp_path, min_file_size=1)
+        assert [(pair.path.name, pair.other.name) for pair in similar] == [('edited', 'original')]
+        assert 0.8 < similar[0].ratio < 1
+
+    def test_ratio_and_size_thresholds(self, tmp_path):
+        data = random_bytes(200_000, 7)
+        (tmp_path / 'a').write_bytes(data)
+        (tmp_path / 'b').write_bytes(data[:100_000] + random_bytes(100_000, 8))
+        (tmp_path / 'c').write_bytes(data)
+
+        # b shares half of a, less the chunk the change falls into
+        similar = find_similar_files(tmp_path, min_file_size=1, min_ratio=0.4)
+        assert {(pair.path.name, pair.other.name) for pair in similar} == {('a', 'b'), ('a', 'c'), ('b', 'c')}
+        assert [(pair.path.name, pair.other.name, pair.ratio)
+                for pair in find_similar_files(tmp_path, min_file_size=1, min_ratio=0.9)] == [('a', 'c', 1.0)]
+        assert find_similar_files(tmp_path, min_file_size=300_000) == []
+
+    def test_hardlinks_are_not_similar(self, tmp_path):
+        (tmp_path / 'file').write_bytes(random_bytes(100_000, 9))
+        (tmp_path / 'link').hardlink_to(tmp_path / 'file')
+        assert find_similar_files(tmp_path, min_file_size=1) == []
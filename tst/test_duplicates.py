@@ -0,0 +1,340 @@
+import pytest
+
+from util import duplicates as duplicates_module
+from util.algorithms import ALGORITHMS, available_algorithms, new_hash, resolve_algorithm
+from util.cache import HashCache
+from util.duplicates import find_duplicate_files, main
+from util.index import DuplicateIndex
+from util.hashing import get_file_hash, get_partial_entry_hash, get_partial_file_hash
+from util.traversal import FileEntry
+
+
+class TestFindDuplicateFiles:
+    def test_finds_small_duplicates(self, tmp_path):
+        (tmp_path / 'a').write_bytes(b'same')
+        (tmp_path / 'b').write_bytes(b'same')
+        (tmp_path / 'c').write_bytes(b'diff')
+
+        duplicates = find_duplicate_files(tmp_path)
+        assert [sorted(file_list) for file_list in duplicates.values()] == [[tmp_path / 'a', tmp_path / 'b']]
+        assert get_file_hash(tmp_path / 'a') in duplicates
+
+    def test_large_files_with_same_head_and_tail_are_not_duplicates(self, tmp_path):
+        head, tail = b'h' * 8192, b't' * 8192
+        (tmp_path / 'a').write_bytes(head + b'a' * 10000 + tail)
+        (tmp_path / 'b').write_bytes(head + b'b' * 10000 + tail)
+        (tmp_path / 'c').write_bytes(head + b'a' * 10000 + tail)
+
+        duplicates = find_duplicate_files(tmp_path)
+        assert len(duplicates) == 1
+        assert sorted(next(iter(duplicates.values()))) == [tmp_path / 'a', tmp_path / 'c']
+        assert get_file_hash(tmp_path / 'a') in duplicates
+
+    def test_size_groups_with_colliding_partial_hashes_are_kept_apart(self, tmp_path):
+        head, tail = b'h' * 8192, b't' * 8192
+        (tmp_path / 'a1').write_bytes(head + b'x' * 100 + tail)
+        (tmp_path / 'a2').write_bytes(head + b'x' * 100 + tail)
+        (tmp_path / 'b1').write_bytes(head + b'y' * 200 + tail)
+        (tmp_path / 'b2').write_bytes(head + b'y' * 200 + tail)
+
+        duplicates = find_duplicate_files(tmp_path)
+        assert sorted(sorted(file_list) for file_list in duplicates.values()) \
+            == [[tmp_path / 'a1', tmp_path / 'a2'], [tmp_path / 'b1', tmp_path / 'b2']]
+
+    def test_files_that_can_not_be_hashed_are_dropped(self, tmp_path, monkeypatch):
+        for name in ('a', 'b', 'gone'):
+            (tmp_path / name).write_bytes(b'x' * 20000)
+        (tmp_path / 'small').write_bytes(b'same')
+        (tmp_path / 'small_gone').write_bytes(b'same')
+
+        get_entry_hash_tuple = duplicates_module.get_entry_hash_tuple
+        get_partial_entry_hash_tuple = duplicates_module.get_partial_entry_hash_tuple
+
+        # as if the files vanished between the walk and the hash
+        def vanish(work):
+            def hash_tuple(entry, **kwargs):
+                if entry.path.name.endswith('gone'):
+                    raise FileNotFoundError(entry.path)
+                return work(entry, **kwargs)
+            return hash_tuple
+
+        monkeypatch.setattr(duplicates_module, 'get_entry_hash_tuple', vanish(get_entry_hash_tuple))
+        monkeypatch.setattr(duplicates_module, 'get_partial_entry_hash_tuple', vanish(get_partial_entry_hash_tuple))
+
+        duplicates = find_duplicate_files(tmp_path)
+        assert [sorted(file_list) for file_list in duplicates.values()] == [[tmp_path / 'a', tmp_path / 'b']]
+
+    def test_unique_sizes_are_not_reported(self, tmp_path):
+        (tmp_path / 'a').write_bytes(b'a')
+        (tmp_path / 'b').write_bytes(b'bb')
+        assert find_duplicate_files(tmp_path) == {}
+
+
+class TestPartialFileHash:
+    def test_partial_hash_of_small_file_is_full_hash(self, tmp_path):
+        file = tmp_path / 'small'
+        file.write_bytes(b'x' * 100)
+        assert get_partial_file_hash(file, size=64) == get_file_hash(file)
+
+    def test_partial_hash_ignores_middle(self, tmp_path):
+        (tmp_path / 'a').write_bytes(b'h' * 64 + b'a' * 64 + b't' * 64)
+        (tmp_path / 'b').write_bytes(b'h' * 64 + b'b' * 64 + b't' * 64)
+        assert get_partial_file_hash(tmp_path / 'a', size=64) == get_partial_file_hash(tmp_path / 'b', size=64)
+
+    def test_partial_hash_of_file_that_shrunk(self, tmp_path):
+        file = tmp_path / 'shrinking'
+        file.write_bytes(b'x' * 1000)
+        entry = FileEntry.from_path(file)
+        file.write_bytes(b'x' * 10)
+
+        # head and tail are read from the file as it is now, both are all of it
+        expected = new_hash('sha256')
+        expected.update(b'x' * 20)
+        assert get_partial_entry_hash(entry, size=64) == expected.hexdigest()
+
+
+class TestHashCache:
+    def test_cached_hash_is_used_for_unchanged_files(self, tmp_path):
+        file = tmp_path / 'file'
+        file.write_bytes(b'content')
+
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            cache.put(FileEntry.from_path(file), 'sha256', 'cached')
+            assert cache.get(FileEntry.from_path(file), 'sha256') == 'cached'
+            assert cache.get(FileEntry.from_path(file), 'md5') is None
+
+    def test_changed_file_invalidates_entry(self, tmp_path):
+        file = tmp_path / 'file'
+        file.write_bytes(b'content')
+
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            cache.put(FileEntry.from_path(file), 'sha256', 'cached')
+            file.write_bytes(b'changed content')
+            assert cache.get(FileEntry.from_path(file), 'sha256') is None
+
+    def test_cache_persists_and_can_be_rebuilt(self, tmp_path):
+        file = tmp_path / 'file'
+        file.write_bytes(b'content')
+
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            cache.put(FileEntry.from_path(file), 'sha256', 'cached')
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            assert cache.get(FileEntry.from_path(file), 'sha256') == 'cached'
+        with HashCache(tmp_path / 'cache.sqlite', rebuild=True) as cache:
+            assert cache.get(FileEntry.from_path(file), 'sha256') is None
+
+    def test_least_recently_used_entries_are_evicted(self, tmp_path):
+        files = [tmp_path / str(i) for i in range(3)]
+        for file in files:
+            file.write_bytes(file.name.encode())
+
+        with HashCache(tmp_path / 'cache.sqlite', max_entries=2) as cache:
+            for file in files:
+                cache.put(FileEntry.from_path(file), 'sha256', file.name)
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            assert len(cache) == 2
+
+    def test_duplicates_are_found_with_cache(self, tmp_path):
+        root = tmp_path / 'root'
+        root.mkdir()
+        (root / 'a').write_bytes(b'same')
+        (root / 'b').write_bytes(b'same')
+
+        with HashCache(tmp_path / 'cache.sqlite') as cache:
+            first = find_duplicate_files(root, cache=cache)
+            assert len(cache) == 2
+            second = find_duplicate_files(root, cache=cache)
+        assert first.keys() == second.keys()
+
+
+class TestDuplicateBackends:
+    def test_backends_find_same_duplicates(self, tmp_path):
+        for i in range(10):
+            (tmp_path / f'small_{i}').write_bytes(bytes([i % 3]))
+            (tmp_path / f'large_{i}').write_bytes(bytes([i % 2]) * 20000)
+
+        serial = find_duplicate_files(tmp_path)
+        threaded = find_duplicate_files(tmp_path, processes=3, backend='thread')
+        forked = find_duplicate_files(tmp_path, processes=3, backend='process')
+
+        def normalize(duplicates):
+            return {file_hash: sorted(file_list) for file_hash, file_list in duplicates.items()}
+
+        assert len(serial) == 5
+        assert normalize(serial) == normalize(threaded) == normalize(forked)
+
+    def test_per_device_scheduling_finds_same_duplicates(self, tmp_path):
+        for i in range(10):
+            (tmp_path / f'small_{i}').write_bytes(bytes([i % 3]))
+            (tmp_path / f'large_{i}').write_bytes(bytes([i % 2]) * 20000)
+
+        def normalize(duplicates):
+            return {file_hash: sorted(file_list) for file_hash, file_list in duplicates.items()}
+
+        expected = normalize(find_duplicate_files(tmp_path))
+        dev = tmp_path.stat().st_dev
+        assert normalize(find_duplicate_files(tmp_path, processes=2, per_device=True)) == expected
+        assert normalize(find_duplicate_files(tmp_path, device_workers={dev: 3}, order='offset')) == expected
+
+
+class TestMultipleRoots:
+    def test_duplicates_across_roots_are_found(self, tmp_path):
+        for name in ('a/one', 'b/two', 'b/sub/three'):
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).write_bytes(b'same')
+
+        duplicates = find_duplicate_files([tmp_path / 'a', tmp_path / 'b', tmp_path / 'b' / 'sub'])
+        assert [sorted(file_list) for file_list in duplicates.values()] \
+            == [sorted(path.resolve() for path in tmp_path.glob('**/*') if path.is_file())]
+
+    def test_index_is_kept_per_set_of_roots(self, tmp_path):
+        for name in ('a/one', 'a/two', 'b/three'):
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).write_bytes(b'same')
+
+        with DuplicateIndex(tmp_path / 'index.sqlite') as index:
+            find_duplicate_files([tmp_path / 'a', tmp_path / 'b'], index=index)
+            assert len(index.get([tmp_path / 'b', tmp_path / 'a'], 'sha256')) == 1
+            assert index.get(tmp_path / 'a', 'sha256') == {}
+
+    def test_roots_may_be_an_iterator(self, tmp_path):
+        for name in ('a/one', 'b/two'):
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).write_bytes(b'same')
+
+        with DuplicateIndex(tmp_path / 'index.sqlite') as index:
+            duplicates = find_duplicate_files((tmp_path / name for name in 'ab'), index=index)
+            assert len(duplicates) == 1
+            assert index.get([tmp_path / 'a', tmp_path / 'b'], 'sha256') == duplicates
+
+    def test_cli_takes_several_paths_and_device_workers(self, tmp_path, capsys):
+        for name in ('a/one', 'b/two'):
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).write_bytes(b'same')
+
+        with pytest.raises(SystemExit) as exit_info:
+            main([str(tmp_path / 'a'), str(tmp_path / 'b'), '--no-cache', '--device-workers', f'{tmp_path}=1'])
+        assert exit_info.value.code == 1
+        assert capsys.readouterr().out.count('"') == 4
+
+        with pytest.raises(SystemExit) as exit_info:
+            main([str(tmp_path), '--device-workers', f'{tmp_path}=none'])
+        assert exit_info.value.code == 2
+
+
+class TestFileHashIO:
+    def test_io_modes_agree(self, tmp_path, monkeypatch):
+        file = tmp_path / 'file'
+        file.write_bytes(bytes(range(256)) * 1000)
+
+        # make the file count as large enough to be mapped
+        monkeypatch.setattr('util.hashing.MMAP_THRESHOLD', 1)
+
+        expected = get_file_hash(file)
+        assert get_file_hash(file, block_size=1000) == expected
+        assert get_file_hash(file, use_mmap=True) == expected
+        assert get_file_hash(file, drop_page_cache=True) == expected
+
+    def test_empty_file_is_not_mapped(self, tmp_path, monkeypatch):
+        file = tmp_path / 'empty'
+        file.touch()
+        monkeypatch.setattr('util.hashing.MMAP_THRESHOLD', 0)
+        assert get_file_hash(file, use_mmap=True) == get_file_hash(file)
+
+
+class TestHashAlgorithms:
+    def test_fast_algorithm_is_always_available(self):
+        assert resolve_algorithm('fast') in available_algorithms()
+        assert new_hash('fast').hexdigest()
+
+    def test_registered_algorithm_is_used(self, tmp_path, monkeypatch):
+        # register through monkeypatch, so the registry is restored afterwards
+        monkeypatch.setitem(ALGORITHMS, 'constant', ConstantHash)
+        (tmp_path / 'a').write_bytes(b'a')
+        (tmp_path / 'b').write_bytes(b'b')
+
+        # a hash that collides for everything finds false duplicates, unless they are verified
+        assert len(find_duplicate_files(tmp_path, name='constant')) == 1
+        assert find_duplicate_files(tmp_path, name='constant', verify='bytes') == {}
+        assert find_duplicate_files(tmp_path, name='constant', verify='sha256') == {}
+
+    def test_verified_duplicates_are_keyed_on_verifying_hash(self, tmp_path):
+        (tmp_path / 'a').write_bytes(b'same')
+        (tmp_path / 'b').write_bytes(b'same')
+
+        duplicates = find_duplicate_files(tmp_path, name='fast', verify='sha256')
+        assert list(duplicates) == [get_file_hash(tmp_path / 'a')]
+
+    def test_cli_rejects_unknown_verify_option(self, tmp_path, capsys):
+        with pytest.raises(SystemExit) as exit_info:
+            main([str(tmp_path), '--no-cache', '--verify', 'shaa256'])
+        assert exit_info.value.code == 2
+        assert 'shaa256' in capsys.readouterr().err
+
+        with pytest.raises(SystemExit) as exit_info:
+            main([str(tmp_path), '--no-cache', '--verify', 'bytes'])
+        assert exit_info.value.code == 0
+
+
+class ConstantHash:
+    digest_size = 1
+
+    def update(self, data):
+        pass
+
+    def hexdigest(self):
+        return '00'
+
+
+class TestHardlinks:
+    def test_hardlinks_are_not_duplicates(self, tmp_path):
+        (tmp_path / 'original').write_bytes(b'content')
+        (tmp_path / 'link').hardlink_to(tmp_path / 'original')
+
+        hardlinks = {}
+        assert find_duplicate_files(tmp_path, hardlinks=hardlinks) == {}
+        assert [sorted(paths) for paths in hardlinks.values()] == [[tmp_path / 'link', tmp_path / 'original']]
+
+    def test_hardlinked_inode_is_reported_once_among_duplicates(self, tmp_path):
+        (tmp_path / 'original').write_bytes(b'content')
+        (tmp_path / 'link').hardlink_to(tmp_path / 'original')
+        (tmp_path / 'copy').write_bytes(b'content')
+
+        duplicates = find_duplicate_files(tmp_path)
+        file_list, = duplicates.values()
+        assert len(file_list) == 2
+        assert tmp_path / 'copy' in file_list
+
+
+class TestDuplicateIndex:
+    def test_only_changed_groups_are_reported(self, tmp_path, capsys):
+        tree = tmp_path / 'tree'
+        tree.mkdir()
+        (tree / 'a').write_bytes(b'same')
+        (tree / 'b').write_bytes(b'same')
+
+        with DuplicateIndex(tmp_path / 'index.sqlite') as index:
+            find_duplicate_files(tree, print_results=True, index=index)
+            assert capsys.readouterr().out.startswith('"+"')
+
+            # nothing changed, so nothing is reported
+            find_duplicate_files(tree, print_results=True, index=index)
+            assert capsys.readouterr().out == ''
+
+            (tree / 'b').write_bytes(b'diff')
+            (tree / 'c').write_bytes(b'other')
+            (tree / 'd').write_bytes(b'other')
+            find_duplicate_files(tree, print_results=True, index=index)
+            lines = capsys.readouterr().out.splitlines()
+            assert [line[:3] for line in lines] == ['"-"', '"+"']
+            assert str(tree / 'c') in lines[1]
+
+    def test_index_persists(self, tmp_path):
+        (tmp_path / 'a').write_bytes(b'same')
+        (tmp_path / 'b').write_bytes(b'same')
+
+        with DuplicateIndex(tmp_path / 'index.sqlite') as index:
+            duplicates = find_duplicate_files(tmp_path, index=index)
+        with DuplicateIndex(tmp_path / 'index.sqlite') as index:
+            assert index.get(tmp_path, 'sha256') == {file_hash: sorted(files)
+                                                      for file_hash, files in duplicates.items()}
@@ -0,0 +1,101 @@
+import pytest
+
+from pathlib import Path
+
+from util.executor import BoundedExecutor, DeviceExecutor, create_executor
+from util.traversal import FileEntry
+
+
+def square(x):
+    return x * x
+
+
+class TestBoundedExecutor:
+    @pytest.mark.parametrize('backend', ['thread', 'process'])
+    def test_maps_all_items(self, backend):
+        with BoundedExecutor(workers=2, backend=backend, chunksize=3) as executor:
+            assert sorted(executor.map_unordered(square, range(20))) == [x * x for x in range(20)]
+
+    def test_single_worker_runs_in_process(self):
+        with BoundedExecutor(workers=1) as executor:
+            assert list(executor.map_unordered(square, range(5))) == [0, 1, 4, 9, 16]
+            assert executor._executor is None
+
+    def test_input_is_consumed_lazily(self):
+        consumed = []
+
+        def items():
+            for i in range(1000):
+                consumed.append(i)
+                yield i
+
+        with BoundedExecutor(workers=2, chunksize=1, max_in_flight=4) as executor:
+            results = executor.map_unordered(square, items())
+            next(results)
+            assert len(consumed) < 1000
+
+    @pytest.mark.parametrize('backend', ['thread', 'process'])
+    def test_submitted_items_are_all_handed_out(self, backend):
+        with BoundedExecutor(workers=2, backend=backend, chunksize=3, max_in_flight=6) as executor:
+            results = [result for x in range(20) for result in executor.submit(square, x)]
+            # the window only holds two chunks, so results come in while items are still being submitted
+            assert results
+            assert sorted(results + list(executor.drain())) == [x * x for x in range(20)]
+
+    def test_unknown_backend_is_rejected(self):
+        with pytest.raises(ValueError):
+            BoundedExecutor(backend='carrier pigeon')
+
+
+def make_entry(dev: int, inode: int) -> FileEntry:
+    return FileEntry(Path(f'/dev{dev}/file{inode}'), False, True, False, 1, 0, inode, dev)
+
+
+def get_inode(entry: FileEntry) -> tuple[int, int]:
+    return entry.dev, entry.inode
+
+
+class TestDeviceExecutor:
+    def test_files_of_a_device_are_read_by_inode(self):
+        entries = [make_entry(dev, inode) for inode in (5, 3, 9, 1) for dev in (1, 2)]
+        read = []
+
+        def read_entry(entry: FileEntry) -> tuple[int, int]:
+            read.append(get_inode(entry))
+            return get_inode(entry)
+
+        with DeviceExecutor(workers=1, chunksize=1) as executor:
+            assert sorted(executor.map_unordered(read_entry, entries)) == sorted(map(get_inode, entries))
+
+        # devices are worked on at the same time, but each one goes through its files in order
+        for dev in (1, 2):
+            assert [inode for device, inode in read if device == dev] == [1, 3, 5, 9]
+        assert not executor.lanes
+
+    def test_devices_get_their_own_number_of_workers(self):
+        entries = [make_entry(dev, inode) for inode in range(10) for dev in (1, 2)]
+        executor = DeviceExecutor(workers=2, device_workers={1: 1})
+        try:
+            assert sorted(executor.map_unordered(get_inode, entries)) == sorted(map(get_inode, entries))
+            assert executor.lanes[1].workers == 1 and executor.lanes[2].workers == 2
+        finally:
+            executor.shutdown()
+
+    def test_groups_and_other_items_are_scheduled(self):
+        groups = [('hash', [make_entry(1, 2), make_entry(1, 1)]), ('other', [make_entry(2, 1)])]
+        with DeviceExecutor(workers=2) as executor:
+            assert sorted(executor.map_unordered(len, groups + [[], 'abc'])) == [0, 2, 2, 3]
+
+    def test_single_device_with_single_worker_runs_in_process(self):
+        with DeviceExecutor(order='none') as executor:
+            entries = [make_entry(1, inode) for inode in (3, 1, 2)]
+            assert list(executor.map_unordered(get_inode, entries)) == [(1, 3), (1, 1), (1, 2)]
+            assert executor.lanes[1]._executor is None
+
+    def test_unknown_order_is_rejected(self):
+        with pytest.raises(ValueError):
+            DeviceExecutor(order='alphabetical')
+
+    def test_device_workers_imply_per_device_scheduling(self):
+        assert type(create_executor(workers=2)) is BoundedExecutor
+        assert isinstance(create_executor(workers=2, device_workers={1: 1}), DeviceExecutor)
@@ -0,0 +1,40 @@
+import json
+import subprocess
+import sys
+
+from pathlib import Path
+
+from main import main, parse_args
+
+
+class TestMain:
+    def test_command_arguments_are_passed_on(self):
+        args = parse_args(['walk', '--help'])
+        assert args.command == 'walk' and args.args == ['--help']
+
+    def test_walk(self, tmp_path, monkeypatch, capsys):
+        (tmp_path / 'file').touch()
+        monkeypatch.setattr(sys, 'argv', ['main.py', 'walk', str(tmp_path)])
+
+        main()
+        assert capsys.readouterr().out.splitlines() == [str(tmp_path.resolve() / 'file')]
+
+    def test_stats(self, tmp_path, monkeypatch, capsys):
+        (tmp_path / 'file.pyc').touch()
+        (tmp_path / 'file').touch()
+        monkeypatch.setattr(sys, 'argv', ['main.py', '--stats', 'walk', str(tmp_path), '-i', '*.pyc'])
+
+        main()
+        stats = json.loads(capsys.readouterr().err)
+        assert stats['counters']['walk:dirs_listed'] == 1
+        assert stats['counters']['walk:pruned:ignore:*.pyc'] == 1
+
+    def test_walk_without_stats_does_not_import_logging(self, tmp_path):
+        # a fresh interpreter, this one has logging imported already
+        script = '\n'.join(['import runpy, sys',
+                             'sys.argv = ["main.py", "walk", sys.argv[1]]',
+                             'runpy.run_path("main.py", run_name="__main__")',
+                             'print("logging" in sys.modules, file=sys.stderr)'])
+        result = subprocess.run([sys.executable, '-c', script, str(tmp_path)], capture_output=True, text=True,
+                                cwd=Path(sys.modules['main'].__file__).parent)
+        assert result.stderr.strip() == 'False'
@@ -0,0 +1,99 @@
+import errno
+import os
+
+from util import merge
+from util.merge import merge_folders, move, MKDIR, MOVE, REMOVE
+
+
+def build(root, files):
+    for name, content in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+
+class TestMergeFolders:
+    def test_merges_recursively(self, tmp_path):
+        source, target = tmp_path / 'source', tmp_path / 'target'
+        build(source, {'new': b'new', 'same': b'same', 'conflict': b'ours', 'sub/deep/file': b'deep', 'only/file': b'x'})
+        build(target, {'same': b'same', 'conflict': b'them', 'sub/other': b'other'})
+
+        operations = merge_folders(source, target)
+
+        assert not source.exists()
+        assert (target / 'new').read_bytes() == b'new'
+        assert (target / 'same').read_bytes() == b'same'
+        assert (target / 'conflict').read_bytes() == b'them'
+        assert (target / 'conflict_0').read_bytes() == b'ours'
+        assert (target / 'sub' / 'deep' / 'file').read_bytes() == b'deep'
+        assert (target / 'only' / 'file').read_bytes() == b'x'
+
+        # the directory missing in the target is moved at once
+        assert (MOVE, source.resolve() / 'only', target.resolve() / 'only') in operations
+        assert [operation.action for operation in operations].count(REMOVE) == 1
+        assert MKDIR not in [operation.action for operation in operations]
+
+    def test_numbered_names_do_not_collide(self, tmp_path):
+        source, target = tmp_path / 'source', tmp_path / 'target'
+        build(source, {'a': b'ours', 'a_0': b'also ours'})
+        build(target, {'a': b'them'})
+
+        merge_folders(source, target, processes=4)
+        assert sorted(file.read_bytes() for file in target.iterdir()) == [b'also ours', b'ours', b'them']
+
+    def test_dry_run_changes_nothing(self, tmp_path, capsys):
+        source, target = tmp_path / 'source', tmp_path / 'target'
+        build(source, {'same': b'same', 'new': b'new'})
+        build(target, {'same': b'same'})
+
+        operations = merge_folders(source, target, dry_run=True, print_results=True)
+
+        assert sorted(operation.action for operation in operations) == [MOVE, REMOVE]
+        assert sorted(file.name for file in source.iterdir()) == ['new', 'same']
+        assert [file.name for file in target.iterdir()] == ['same']
+        assert len(capsys.readouterr().out.splitlines()) == 2
+
+    def test_directories_are_not_moved_onto_mounts_in_the_target(self, tmp_path, monkeypatch):
+        source, target = tmp_path / 'source', tmp_path / 'target'
+        build(source, {'mnt/dir/sub/file': b'x'})
+        build(target, {'mnt/other': b'y'})
+        for directory, mtime in ((source / 'mnt' / 'dir', 10 ** 9), (source / 'mnt' / 'dir' / 'sub', 2 * 10 ** 9)):
+            directory.chmod(0o750)
+            os.utime(directory, ns=(mtime, mtime))
+
+        # pretend the existing subdirectory of the target is mounted from another device
+        lstat, mount = os.lstat, os.fspath(target.resolve() / 'mnt')
+
+        def lstat_with_mount(path):
+            result = lstat(path)
+            if os.fspath(path) == mount:
+                fields = list(result)
+                # st_dev
+                fields[2] += 1
+                return os.stat_result(fields)
+            return result
+
+        monkeypatch.setattr(merge.os, 'lstat', lstat_with_mount)
+        operations = merge_folders(source, target)
+
+        assert (MKDIR, source.resolve() / 'mnt' / 'dir', target.resolve() / 'mnt' / 'dir') in operations
+        assert (MKDIR, source.resolve() / 'mnt' / 'dir' / 'sub', target.resolve() / 'mnt' / 'dir' / 'sub') \
+            in operations
+        assert (target / 'mnt' / 'dir' / 'sub' / 'file').read_bytes() == b'x'
+        # created directories keep the mode and times of their sources
+        for directory, mtime in ((target / 'mnt' / 'dir', 10 ** 9), (target / 'mnt' / 'dir' / 'sub', 2 * 10 ** 9)):
+            assert directory.stat().st_mode & 0o777 == 0o750
+            assert directory.stat().st_mtime_ns == mtime
+
+    def test_directories_are_copied_across_devices(self, tmp_path, monkeypatch):
+        build(tmp_path / 'source', {'file': b'x', 'sub/file': b'y'})
+
+        def rename_across_devices(source, target):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        monkeypatch.setattr(merge.os, 'rename', rename_across_devices)
+        move(tmp_path / 'source', tmp_path / 'target')
+
+        assert not (tmp_path / 'source').exists()
+        assert (tmp_path / 'target' / 'sub' / 'file').read_bytes() == b'y'
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['target']
@@ -0,0 +1,29 @@
+from util.naming import compile_name_validator, get_offending_paths
+
+
+class TestNameValidator:
+    def test_posix_portable_names(self):
+        is_offending = compile_name_validator()
+        assert not is_offending('file-name_1.txt')
+        assert is_offending('file name')
+        assert is_offending('umlaut_ä')
+
+    def test_special_characters_are_literal(self):
+        is_offending = compile_name_validator('a]^-\\')
+        assert not is_offending('a]^-\\')
+        assert is_offending('b')
+
+    def test_nothing_allowed(self):
+        assert compile_name_validator('')('a')
+
+
+class TestGetOffendingPaths:
+    def test_offending_names_and_exclusions(self, tmp_path):
+        (tmp_path / 'bad dir').mkdir()
+        (tmp_path / 'bad dir' / 'fine').touch()
+        (tmp_path / 'excluded dir').mkdir()
+        (tmp_path / 'excluded dir' / 'bad name').touch()
+        (tmp_path / 'good').touch()
+
+        offending = set(get_offending_paths(tmp_path, excluded_paths=[tmp_path / 'excluded dir']))
+        assert offending == {tmp_path.resolve() / 'bad dir'}
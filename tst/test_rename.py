@@ -0,0 +1,67 @@
+from util.naming import compile_name_validator
+from util.rename import rename_offending_paths, compile_renamer, get_unique_name, format_number
+
+
+class TestRenamer:
+    def test_strategies(self):
+        assert compile_renamer('replace')('Größe 1.txt') == 'Gr__e_1.txt'
+        assert compile_renamer('transliterate')('Größe 1.txt') == 'Groesse_1.txt'
+        assert compile_renamer('transliterate')('café') == 'cafe'
+        assert compile_renamer('lowercase')('Größe 1.txt') == 'groesse_1.txt'
+        assert [compile_renamer()(name) for name in ('．', '‥', '..\u0301', '')] == ['_.', '_..', '_..', '_']
+
+    def test_unique_name(self):
+        assert get_unique_name('a.tar.gz', {'a.tar.gz', 'a_1.tar.gz'}) == 'a_2.tar.gz'
+        assert get_unique_name('.hidden', {'.hidden'}) == '.hidden_1'
+
+    def test_format_number(self):
+        assert [format_number(i) for i in (1, 9, 10, 123)] == ['1', '9', '10', '123']
+        assert [format_number(i, 'ab') for i in (1, 2, 3, 4)] == ['b', 'ba', 'bb', 'baa']
+        assert format_number(3, '_') == '___'
+
+
+class TestRenameOffendingPaths:
+    def test_renames_bottom_up_without_collisions(self, tmp_path):
+        (tmp_path / 'bad dir' / 'bad dir').mkdir(parents=True)
+        (tmp_path / 'bad dir' / 'bad dir' / 'bad file').write_text('deep')
+        (tmp_path / 'bad_file').write_text('existing')
+        (tmp_path / 'bad file').write_text('new')
+        (tmp_path / 'bad?file').write_text('newer')
+
+        rename_offending_paths(tmp_path, processes=4)
+
+        assert (tmp_path / 'bad_dir' / 'bad_dir' / 'bad_file').read_text() == 'deep'
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['bad_dir', 'bad_file', 'bad_file_1', 'bad_file_2']
+        assert (tmp_path / 'bad_file').read_text() == 'existing'
+
+    def test_names_that_become_dots_are_not_renamed_onto_directories(self, tmp_path):
+        (tmp_path / 'dir').mkdir()
+        for name in ('．', '‥', 'bad file', 'bad?file'):
+            (tmp_path / 'dir' / name).write_text(name)
+
+        operations = rename_offending_paths(tmp_path / 'dir')
+
+        assert all(operation.target.parent == tmp_path / 'dir' for operation in operations)
+        assert sorted(path.name for path in (tmp_path / 'dir').iterdir()) == ['_.', '_..', 'bad_file', 'bad_file_1']
+        assert (tmp_path / 'dir' / '_..').read_text() == '‥'
+
+    def test_dry_run_changes_nothing(self, tmp_path, capsys):
+        (tmp_path / 'bad name').touch()
+
+        operations = rename_offending_paths(tmp_path, dry_run=True, print_results=True)
+
+        assert [operation.target.name for operation in operations] == ['bad_name']
+        assert (tmp_path / 'bad name').exists()
+        assert len(capsys.readouterr().out.splitlines()) == 1
+
+    def test_numbered_names_only_contain_allowed_characters(self, tmp_path):
+        allowed_chars = 'abcdefghijklmnopqrstuvwxyz_'
+        for name in ('bad_file', 'bad file', 'bad?file', 'bad!file'):
+            (tmp_path / name).touch()
+
+        operations = rename_offending_paths(tmp_path, allowed_chars=allowed_chars)
+
+        assert len(operations) == 3
+        assert not any(compile_name_validator(allowed_chars)(path.name) for path in tmp_path.iterdir())
+        # a second run has nothing left to do
+        assert rename_offending_paths(tmp_path, allowed_chars=allowed_chars) == []
@@ -0,0 +1,137 @@
+import errno
+import os
+
+import pytest
+
+from util import resolve
+from util.resolve import resolve_duplicates, resume_resolutions, rollback_resolutions, apply_resolution, \
+    commit_resolution, ResolutionJournal, get_backup_path, DELETE, HARDLINK, REFLINK, SYMLINK
+
+
+def make_duplicates(root, names):
+    for i, name in enumerate(names):
+        (root / name).write_bytes(b'same')
+        # oldest first
+        os.utime(root / name, ns=(i * 10 ** 9, i * 10 ** 9))
+    return {'hash': [root / name for name in names]}
+
+
+class TestResolveDuplicates:
+    def test_delete_keeps_oldest(self, tmp_path):
+        duplicates = make_duplicates(tmp_path, ['a', 'b', 'c'])
+        resolutions = resolve_duplicates(duplicates, action=DELETE, keep='oldest', processes=2)
+
+        assert sorted(resolution.path.name for resolution in resolutions) == ['b', 'c']
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['a']
+
+    def test_prefer_overrides_policy(self, tmp_path):
+        duplicates = make_duplicates(tmp_path, ['a', 'keep_me', 'c'])
+        resolve_duplicates(duplicates, keep='newest', prefer='keep')
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['keep_me']
+
+    def test_hardlink_and_symlink(self, tmp_path):
+        hardlinked = tmp_path / 'hardlinked'
+        hardlinked.mkdir()
+        resolve_duplicates(make_duplicates(hardlinked, ['a', 'b']), action=HARDLINK)
+        assert (hardlinked / 'a').stat().st_ino == (hardlinked / 'b').stat().st_ino
+
+        symlinked = tmp_path / 'symlinked'
+        symlinked.mkdir()
+        resolve_duplicates(make_duplicates(symlinked, ['a', 'b']), action=SYMLINK, keep='newest')
+        assert (symlinked / 'a').is_symlink() and (symlinked / 'a').read_bytes() == b'same'
+        assert sorted(file.name for file in symlinked.iterdir()) == ['a', 'b']
+
+    def test_vanished_files_are_skipped(self, tmp_path):
+        duplicates = make_duplicates(tmp_path, ['a', 'b', 'c'])
+        duplicates['other'] = make_duplicates(tmp_path, ['d', 'e'])['hash']
+        (tmp_path / 'a').unlink()
+        (tmp_path / 'e').unlink()
+
+        resolutions = resolve_duplicates(duplicates)
+        assert [(resolution.path.name, resolution.keeper.name) for resolution in resolutions] == [('c', 'b')]
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['b', 'd']
+
+    def test_changed_files_are_skipped(self, tmp_path, capsys):
+        duplicates = make_duplicates(tmp_path, ['a', 'b', 'c'])
+        resolutions = resolve_duplicates(duplicates, dry_run=True)
+
+        # edited between planning and applying, the size stays the same
+        (tmp_path / 'b').write_bytes(b'edit')
+        os.utime(tmp_path / 'b', ns=(resolutions[0].mtime_ns, resolutions[0].mtime_ns))
+        journal = ResolutionJournal(tmp_path.parent / f'{tmp_path.name}.journal')
+        journal.log_plan(resolutions)
+
+        assert resume_resolutions(journal.path, print_results=True, verify='bytes') == resolutions[1:]
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['a', 'b']
+        assert (tmp_path / 'b').read_bytes() == b'edit'
+        assert 'WARNING: skipped' in capsys.readouterr().err
+
+    def test_changed_keeper_is_not_linked(self, tmp_path):
+        duplicates = make_duplicates(tmp_path, ['a', 'b'])
+        resolutions = resolve_duplicates(duplicates, action=HARDLINK, dry_run=True)
+
+        (tmp_path / 'a').write_bytes(b'changed')
+        assert apply_resolution(resolutions[0]) == (resolutions[0], False)
+        assert (tmp_path / 'b').read_bytes() == b'same'
+
+    def test_failed_clone_restores_the_duplicate(self, tmp_path, monkeypatch):
+        duplicates = make_duplicates(tmp_path, ['a', 'b'])
+
+        def clone_unsupported(source, target):
+            open(target, 'wb').close()
+            raise OSError(errno.EOPNOTSUPP, 'Operation not supported', str(target))
+
+        monkeypatch.setattr(resolve, 'clone_file', clone_unsupported)
+        with pytest.raises(OSError):
+            resolve_duplicates(duplicates, action=REFLINK)
+
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['a', 'b']
+        assert (tmp_path / 'b').read_bytes() == b'same'
+
+    def test_dry_run_changes_nothing(self, tmp_path, capsys):
+        duplicates = make_duplicates(tmp_path, ['a', 'b'])
+        resolve_duplicates(duplicates, dry_run=True, print_results=True)
+
+        assert sorted(file.name for file in tmp_path.iterdir()) == ['a', 'b']
+        assert capsys.readouterr().out.startswith('"delete"')
+
+
+class TestResolutionJournal:
+    def interrupted_run(self, tmp_path):
+        tree = tmp_path / 'tree'
+        tree.mkdir()
+        journal = ResolutionJournal(tmp_path / 'journal')
+
+        resolutions = resolve_duplicates(make_duplicates(tree, ['a', 'b', 'c']), action=HARDLINK, dry_run=True)
+        journal.log_plan(resolutions)
+        # killed after applying the first resolution
+        apply_resolution(resolutions[0])
+        journal.log_applied(resolutions[:1])
+        return tree, journal, resolutions
+
+    def test_resume_finishes_run(self, tmp_path):
+        tree, journal, resolutions = self.interrupted_run(tmp_path)
+
+        assert resume_resolutions(journal.path) == resolutions
+        assert sorted(file.name for file in tree.iterdir()) == ['a', 'b', 'c']
+        assert len({file.stat().st_ino for file in tree.iterdir()}) == 1
+        # committed runs are done
+        assert resume_resolutions(journal.path) == []
+
+    def test_rollback_restores_files(self, tmp_path):
+        tree, journal, resolutions = self.interrupted_run(tmp_path)
+        assert get_backup_path(resolutions[0].path).exists()
+
+        assert rollback_resolutions(journal.path) == (resolutions, [])
+        assert sorted(file.name for file in tree.iterdir()) == ['a', 'b', 'c']
+        assert len({file.stat().st_ino for file in tree.iterdir()}) == 3
+
+    def test_rollback_reports_committed_resolutions(self, tmp_path):
+        tree, journal, resolutions = self.interrupted_run(tmp_path)
+        apply_resolution(resolutions[1])
+        journal.log_applied(resolutions[1:])
+        # killed while committing
+        commit_resolution(resolutions[0])
+
+        assert rollback_resolutions(journal.path) == (resolutions[1:], resolutions[:1])
+        assert len({file.stat().st_ino for file in tree.iterdir()}) == 2
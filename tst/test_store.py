@@ -0,0 +1,97 @@
+import hashlib
+import os
+import tracemalloc
+
+from collections import defaultdict
+from pathlib import Path
+
+import pytest
+
+from util.store import HashStore
+
+
+def digest(i: int) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+def make_files(count: int, distinct: int) -> list[tuple[Path, str]]:
+    return [(Path(f'/data/dir{i % 100}/file{i}.txt'), digest(i % distinct)) for i in range(count)]
+
+
+class TestHashStore:
+    def test_behaves_like_a_dict_of_lists(self):
+        files = make_files(1000, 300)
+        store, expected = HashStore(), defaultdict(list)
+        for path, file_hash in files:
+            store.add(path, file_hash)
+            expected[file_hash].append(path)
+
+        assert len(store) == len(expected) == 300
+        assert store.file_count == 1000
+        assert list(store) == list(expected)
+        assert dict(store.items()) == expected
+        assert store == expected
+
+    def test_raw_digests_work_as_keys(self):
+        store = HashStore()
+        store.add('/a', digest(0))
+        assert store[bytes.fromhex(digest(0))] == [Path('/a')]
+        assert bytes.fromhex(digest(0)) in store
+
+    def test_missing_keys(self):
+        store = HashStore()
+        assert digest(0) not in store
+        assert store.get(digest(0)) is None
+
+        store.add('/a', digest(0))
+        assert digest(1) not in store and 'not hex' not in store and 'abcd' not in store
+        with pytest.raises(KeyError):
+            store[digest(1)]
+
+    def test_digests_must_have_the_same_size(self):
+        store = HashStore()
+        store.add('/a', digest(0))
+        with pytest.raises(ValueError):
+            store.add('/b', hashlib.md5(b'').hexdigest())
+
+    def test_names_round_trip(self):
+        store = HashStore()
+        # not valid utf-8, so it is decoded with surrogates
+        odd_name = os.fsdecode(b'caf\xe9')
+        for path in (Path('/'), Path('/top'), Path('/dir') / odd_name, Path('/dir/a b ü')):
+            store.add(path, digest(0))
+        assert store[digest(0)] == [Path('/'), Path('/top'), Path('/dir') / odd_name, Path('/dir/a b ü')]
+
+    def test_iter_groups_skips_small_groups(self):
+        store = HashStore()
+        for path, file_hash in make_files(10, 8):
+            store.add(path, file_hash)
+
+        groups = dict(store.iter_groups(min_size=2))
+        assert set(groups) == {digest(0), digest(1)}
+        assert store.group_size(digest(0)) == 2 and store.group_size(digest(7)) == 1
+
+    def test_takes_a_fraction_of_the_memory_of_a_dict(self):
+        # a few directories deep, and one in four files is a duplicate
+        raw = [(f'/home/user/photos/2023/album{i % 100}/IMG_{i:06d}.jpg',
+                hashlib.sha256(str(i * 3 // 4).encode()).digest()) for i in range(5000)]
+
+        tracemalloc.start()
+        try:
+            # what get_dir_hash_map used to return, hex strings and paths are fresh objects for every file
+            expected = defaultdict(list)
+            for path, file_digest in raw:
+                expected[file_digest.hex()].append(Path(path))
+            dict_size, _ = tracemalloc.get_traced_memory()
+            del expected
+
+            baseline, _ = tracemalloc.get_traced_memory()
+            store = HashStore()
+            for path, file_digest in raw:
+                store.add(path, file_digest.hex())
+            store_size = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+
+        assert store_size * 5 < dict_size
+        assert abs(store.nbytes - store_size) < store_size / 10
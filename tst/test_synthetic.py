@@ -0,0 +1,40 @@
+import os
+
+from bench.synthetic import TreeSpec, generate_tree
+from util.duplicates import find_duplicate_files
+from util.naming import get_offending_paths
+from util.traversal import traverse_file_tree
+
+SPEC = TreeSpec(depth=2, fanout=3, files_per_dir=5, mean_size=256, duplicate_ratio=0.3, hardlink_ratio=0.1,
+                gitignore_density=0.5, offending_ratio=0.2)
+
+
+class TestGenerateTree:
+    def test_counts_match_the_spec(self, tmp_path):
+        counts = generate_tree(tmp_path / 'tree', SPEC)['counts']
+        assert counts['dirs'] == SPEC.dir_count == 13
+        assert counts['files'] == SPEC.file_count == 65
+
+        files = [file for _, _, files in os.walk(tmp_path / 'tree') for file in files]
+        assert len(files) == counts['files'] + counts['gitignores'] + 1
+
+    def test_same_spec_gives_same_tree(self, tmp_path):
+        generate_tree(tmp_path / 'a', SPEC)
+        generate_tree(tmp_path / 'b', SPEC)
+        assert {path.relative_to(tmp_path / 'a') for path in traverse_file_tree(tmp_path / 'a')} \
+            == {path.relative_to(tmp_path / 'b') for path in traverse_file_tree(tmp_path / 'b')}
+
+    def test_tree_is_reused(self, tmp_path):
+        generate_tree(tmp_path / 'tree', SPEC)
+        (tmp_path / 'tree' / 'marker').touch()
+
+        generate_tree(tmp_path / 'tree', SPEC)
+        assert (tmp_path / 'tree' / 'marker').exists()
+
+        generate_tree(tmp_path / 'tree', SPEC._replace(seed=1))
+        assert not (tmp_path / 'tree' / 'marker').exists()
+
+    def test_duplicates_and_offending_names_are_found(self, tmp_path):
+        counts = generate_tree(tmp_path / 'tree', SPEC)['counts']
+        assert find_duplicate_files(tmp_path / 'tree')
+        assert len(list(get_offending_paths(tmp_path / 'tree'))) == counts['offending']
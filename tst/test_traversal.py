@@ -1,6 +1,10 @@
 import sys
 
-from util.traversal import traverse_file_tree, translate_glob_patterns, compile_glob_patterns
+from util.traversal import traverse_file_tree, iter_file_tree, iter_file_entries, FileEntry, \
+    translate_glob_patterns, compile_glob_patterns, compile_combined_glob_pattern, visit_file_tree, \
+    SizeHistogramVisitor, distinct_roots, iter_entries_under_roots
+from util.hashing import HashVisitor, get_file_hash
+from util.naming import OffendingNameVisitor
 
 
 class TestFileTreeTraversal:
@@ -106,3 +110,165 @@ class TestGlobPatterns:
         pattern = compile_glob_patterns(['/path/to/foo'])[0]
         assert pattern.match('/path/to/foo')
         assert not pattern.match('/path/to/foobar')
+
+    def test_combined_pattern_matches_any_pattern(self):
+        pattern = compile_combined_glob_pattern(['/path/to/foo', '/path/*/bar'])
+        assert pattern.match('/path/to/foo')
+        assert pattern.match('/path/to/bar')
+        assert not pattern.match('/path/to/baz')
+
+    def test_combined_pattern_of_no_patterns_is_none(self):
+        assert compile_combined_glob_pattern([]) is None
+
+
+class TestIterFileTree:
+    def test_yields_same_paths_as_traverse_file_tree(self, file_tree_with_gitignore):
+        results = set(iter_file_tree(file_tree_with_gitignore, include_gitignore=True))
+        assert results == traverse_file_tree(file_tree_with_gitignore, include_gitignore=True)
+
+    def test_is_lazy(self, file_tree):
+        paths = iter_file_tree(file_tree)
+        assert next(paths).parent == file_tree.resolve()
+
+
+class TestIterFileEntries:
+    def test_entries_carry_stat_info(self, tmp_path):
+        (tmp_path / 'file').write_bytes(b'content')
+        (tmp_path / 'dir').mkdir()
+
+        entries = {entry.path.name: entry for entry in iter_file_entries(tmp_path)}
+        assert entries['file'].is_file and not entries['file'].is_dir
+        assert entries['file'].size == len(b'content')
+        assert entries['file'] == FileEntry.from_path(tmp_path / 'file')
+        assert entries['dir'].is_dir and not entries['dir'].is_file
+
+    def test_symlinked_dirs_are_yielded_but_not_descended_into(self, tmp_path):
+        # creating symlinks needs privileges on windows, skip there
+        if sys.platform.startswith('win'):
+            print('\nSKIPPED ON WINDOWS\n')
+            return
+
+        (tmp_path / 'dir').mkdir()
+        (tmp_path / 'dir' / 'file').touch()
+        (tmp_path / 'link').symlink_to(tmp_path / 'dir')
+
+        paths = {entry.path for entry in iter_file_entries(tmp_path)}
+        assert tmp_path / 'link' in paths
+        assert tmp_path / 'link' / 'file' not in paths
+
+
+class TestGitignoreScopes:
+    def test_negation_reincludes_files(self, tmp_path):
+        (tmp_path / '.gitignore').write_text('*.log\n!keep.log\n')
+        (tmp_path / 'drop.log').touch()
+        (tmp_path / 'keep.log').touch()
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'drop.log' not in results
+        assert tmp_path / 'keep.log' in results
+
+    def test_later_rules_take_precedence(self, tmp_path):
+        (tmp_path / '.gitignore').write_text('!keep.log\n*.log\n')
+        (tmp_path / 'keep.log').touch()
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'keep.log' not in results
+
+    def test_deeper_gitignore_takes_precedence(self, tmp_path):
+        (tmp_path / '.gitignore').write_text('*.log\n')
+        (tmp_path / 'sub').mkdir()
+        (tmp_path / 'sub' / '.gitignore').write_text('!keep.log\n')
+        (tmp_path / 'sub' / 'keep.log').touch()
+        (tmp_path / 'sub' / 'drop.log').touch()
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'sub' / 'keep.log' in results
+        assert tmp_path / 'sub' / 'drop.log' not in results
+
+    def test_rules_dont_apply_to_sibling_dirs(self, tmp_path):
+        for sibling in ('a', 'b'):
+            (tmp_path / sibling).mkdir()
+            (tmp_path / sibling / 'file').touch()
+        (tmp_path / 'a' / '.gitignore').write_text('file\n')
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'a' / 'file' not in results
+        assert tmp_path / 'b' / 'file' in results
+
+    def test_dir_only_rules_keep_files(self, tmp_path):
+        (tmp_path / '.gitignore').write_text('build/\n')
+        (tmp_path / 'build').touch()
+        (tmp_path / 'sub').mkdir()
+        (tmp_path / 'sub' / 'build').mkdir()
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'build' in results
+        assert tmp_path / 'sub' / 'build' not in results
+
+    def test_unanchored_rules_match_whole_names_only(self, tmp_path):
+        (tmp_path / '.gitignore').write_text('file\n')
+        (tmp_path / 'file').touch()
+        (tmp_path / 'other_file').touch()
+
+        results = traverse_file_tree(tmp_path, include_gitignore=True)
+        assert tmp_path / 'file' not in results
+        assert tmp_path / 'other_file' in results
+
+
+class TestConcurrentTraversal:
+    def test_workers_yield_same_paths_as_serial_walk(self, file_tree_with_gitignore):
+        serial = traverse_file_tree(file_tree_with_gitignore, include_gitignore=True, ignore_patterns=['*_glob_*'])
+        concurrent = traverse_file_tree(file_tree_with_gitignore, include_gitignore=True, ignore_patterns=['*_glob_*'],
+                                        workers=4)
+        assert serial == concurrent
+
+    def test_workers_yield_same_entries_as_serial_walk(self, file_tree):
+        serial = list(iter_file_entries(file_tree, regard_patterns=['not_ignored_*']))
+        concurrent = list(iter_file_entries(file_tree, regard_patterns=['not_ignored_*'], workers=4))
+        assert sorted(serial) == sorted(concurrent)
+
+
+class TestMultipleRoots:
+    def test_nested_and_repeated_roots_are_dropped(self, tmp_path):
+        (tmp_path / 'a' / 'b').mkdir(parents=True)
+        (tmp_path / 'c').mkdir()
+        assert distinct_roots([tmp_path / 'c', tmp_path / 'a' / 'b', str(tmp_path / 'a'), tmp_path / 'c']) \
+            == [tmp_path.resolve() / 'a', tmp_path.resolve() / 'c']
+        assert distinct_roots(tmp_path) == [tmp_path.resolve()]
+
+    def test_entries_of_all_roots_are_yielded_once(self, tmp_path):
+        for name in ('a/x', 'a/sub/y', 'b/z'):
+            (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+            (tmp_path / name).touch()
+
+        entries = list(iter_entries_under_roots([tmp_path / 'b', tmp_path / 'a', tmp_path / 'a' / 'sub']))
+        expected = list(iter_file_entries(tmp_path / 'a')) + list(iter_file_entries(tmp_path / 'b'))
+        assert sorted(entries) == sorted(expected)
+
+
+class TestVisitFileTree:
+    def test_analyses_share_one_walk(self, tmp_path):
+        (tmp_path / 'bad name').write_bytes(b'same')
+        (tmp_path / 'good').write_bytes(b'same')
+        (tmp_path / 'empty').touch()
+
+        offending, histogram, hashes = visit_file_tree(tmp_path, [OffendingNameVisitor(),
+                                                                  SizeHistogramVisitor(),
+                                                                  HashVisitor()])
+
+        assert offending == [tmp_path.resolve() / 'bad name']
+        assert histogram == {0: (1, 0), 3: (2, 8)}
+        assert sorted(hashes[get_file_hash(tmp_path / 'good')]) == [tmp_path.resolve() / 'bad name',
+                                                                    tmp_path.resolve() / 'good']
+
+    def test_files_are_hashed_while_walking(self, tmp_path):
+        for i in range(10):
+            (tmp_path / f'file{i}').write_bytes(b'same')
+
+        visitor = HashVisitor()
+        for i, entry in enumerate(iter_file_entries(tmp_path), start=1):
+            visitor.visit(entry)
+            # nothing is kept around to be hashed at the end
+            assert visitor.register.file_count == i
+
+        assert len(visitor.result()[get_file_hash(tmp_path / 'file0')]) == 10